@@ -0,0 +1,210 @@
+"""Benchmarks of the Lambda handlers against a moto backed bucket and catalog.
+
+Skipped unless BENCHMARK=1. Every scenario runs at the library sizes of
+BENCHMARK_SIZES (videos in the bucket, 1000 and 10000 by default, 100000
+takes long under moto) and reports latency percentiles, AWS calls per
+service, peak Python memory and payload size. Cold starts of the functions
+are measured in fresh interpreters and must also fit COLD_START_BUDGET_MS.
+
+Results are compared with baselines.json, a scenario fails when its API
+calls grew or when its median latency, peak memory or payload grew beyond
+the tolerances. Latency baselines depend on the machine, BENCHMARK_UPDATE=1
+records the results of the run as the new baselines.
+"""
+import importlib
+import importlib.util
+import json
+import os
+import sys
+import time
+import tracemalloc
+from collections import Counter
+
+import boto3
+import pytest
+from moto import mock_aws
+
+from tests.unit.conftest import AWS_ENVIRONMENT, BUCKET, LAMBDA_ROOT, LAYER_MODULES, LAYER_PATH, \
+    PROCESS_VIDEO_MODULES, create_catalog
+
+BASELINES_PATH = os.path.join(os.path.dirname(__file__), "baselines.json")
+
+SIZES = [int(size) for size in os.environ.get("BENCHMARK_SIZES", "1000,10000").split(",")]
+REPEATS = int(os.environ.get("BENCHMARK_REPEATS", "5"))
+
+# Allowed growth over the baseline, as a fraction of it
+LATENCY_TOLERANCE = float(os.environ.get("BENCHMARK_LATENCY_TOLERANCE", "0.5"))
+MEMORY_TOLERANCE = 0.25
+# Latency growth always allowed, scenarios of a few milliseconds are mostly noise
+LATENCY_SLACK_MS = float(os.environ.get("BENCHMARK_LATENCY_SLACK_MS", "5"))
+PAYLOAD_TOLERANCE = 0.05
+
+# Absolute ceiling of the median cold start (init plus first clients), whatever the baseline
+COLD_START_BUDGET_MS = float(os.environ.get("COLD_START_BUDGET_MS", "500"))
+
+# Videos are spread over this many folders
+FOLDERS = 20
+
+results = {}
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "benchmark: handler benchmark, run with BENCHMARK=1")
+
+def pytest_collection_modifyitems(config, items):
+    if os.environ.get("BENCHMARK") == "1":
+        return
+    skip = pytest.mark.skip(reason="benchmarks run with BENCHMARK=1")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip)
+
+def percentile(samples, fraction):
+    """Nearest rank percentile"""
+    ordered = sorted(samples)
+    return ordered[max(0, min(len(ordered) - 1, round(fraction * len(ordered)) - 1))]
+
+class Library:
+    """A bucket of size videos cataloged by ProcessVideoFunction, with both handlers loaded"""
+
+    def __init__(self, size):
+        self.size = size
+        self.calls = Counter()
+        self.process_video = importlib.import_module("index")
+        spec = importlib.util.spec_from_file_location(
+            "generate_url_pre_index", os.path.join(LAMBDA_ROOT, "generate_url_pre", "index.py")
+        )
+        self.generate_url_pre = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(self.generate_url_pre)
+        # Clients are shared by the modules of the layer path
+        aws_clients = importlib.import_module("aws_clients")
+        for service_name in ("s3", "dynamodb"):
+            aws_clients.client(service_name).meta.events.register("before-call", self.count_call)
+
+    def count_call(self, model, **kwargs):
+        self.calls[model.service_model.service_name] += 1
+
+    def measure(self, name, run, repeats=REPEATS):
+        """Time repeats runs, then measure the peak memory of one more run"""
+        latencies = []
+        for _ in range(repeats):
+            self.calls.clear()
+            started = time.perf_counter()
+            payload = run()
+            latencies.append((time.perf_counter() - started) * 1000)
+        calls = dict(self.calls)
+
+        tracemalloc.start()
+        try:
+            run()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        return self.record(name, latencies, calls, payload, peak)
+
+    def record(self, name, latencies, calls, payload, peak_memory):
+        return record_result(f"{name}[{self.size}]", latencies, calls, payload, peak_memory)
+
+def record_result(key, latencies, calls, payload, peak_memory):
+    result = {
+        "p50_ms": round(percentile(latencies, 0.5), 2),
+        "p95_ms": round(percentile(latencies, 0.95), 2),
+        "p99_ms": round(percentile(latencies, 0.99), 2),
+        "calls": calls,
+        "payload_bytes": payload,
+        "peak_memory_bytes": peak_memory,
+    }
+    results[key] = result
+    return result
+
+def seed_bucket(size):
+    s3 = boto3.client("s3")
+    for i in range(size):
+        s3.put_object(Bucket=BUCKET, Key=f"folder{i % FOLDERS:02d}/video{i:06d}.mp4", Body=b"\0" * 16)
+
+@pytest.fixture(scope="module", params=SIZES, ids=lambda size: f"{size}")
+def library(request):
+    """Library shared by the scenarios of a size, cataloged by a full rescan"""
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        for name, value in AWS_ENVIRONMENT.items():
+            monkeypatch.setenv(name, value)
+        monkeypatch.setenv("LOG_LEVEL", "WARNING")
+        monkeypatch.syspath_prepend(LAYER_PATH)
+        monkeypatch.syspath_prepend(os.path.join(LAMBDA_ROOT, "generate_url_pre"))
+        monkeypatch.syspath_prepend(os.path.join(LAMBDA_ROOT, "process_video"))
+        for module in PROCESS_VIDEO_MODULES + LAYER_MODULES:
+            sys.modules.pop(module, None)
+
+        with mock_aws():
+            create_catalog()
+            seed_bucket(request.param)
+            library = Library(request.param)
+
+            started = time.perf_counter()
+            response = library.process_video.handler({"fullRescan": True}, None)
+            library.record("catalog_build", [(time.perf_counter() - started) * 1000],
+                           dict(library.calls), len(response["body"]), None)
+            assert json.loads(response["body"])["videoCount"] == request.param
+            yield library
+
+        for module in PROCESS_VIDEO_MODULES + LAYER_MODULES:
+            sys.modules.pop(module, None)
+
+def load_baselines():
+    if not os.path.exists(BASELINES_PATH):
+        return {}
+    with open(BASELINES_PATH) as baselines_file:
+        return json.load(baselines_file)
+
+def regressions(key, result, baseline):
+    """Describe how a result regressed from its baseline"""
+    found = []
+    for service, count in result["calls"].items():
+        if count > baseline["calls"].get(service, 0):
+            found.append(f"{service} calls {baseline['calls'].get(service, 0)} -> {count}")
+    for metric, tolerance, slack in (("p50_ms", LATENCY_TOLERANCE, LATENCY_SLACK_MS),
+                                     ("peak_memory_bytes", MEMORY_TOLERANCE, 0),
+                                     ("payload_bytes", PAYLOAD_TOLERANCE, 0)):
+        if result[metric] is None or baseline.get(metric) is None:
+            continue
+        if result[metric] > baseline[metric] * (1 + tolerance) + slack:
+            found.append(f"{metric} {baseline[metric]} -> {result[metric]}")
+    return [f"{key}: {regression}" for regression in found]
+
+def check_budget(key, result):
+    assert result["p50_ms"] <= COLD_START_BUDGET_MS, \
+        f"{key}: p50_ms {result['p50_ms']} over the {COLD_START_BUDGET_MS} ms budget"
+
+@pytest.fixture
+def check_baseline():
+    """Fail when a recorded result regressed from its baseline"""
+    baselines = load_baselines()
+
+    def check(name, library=None):
+        key = f"{name}[{library.size}]" if library else name
+        if os.environ.get("BENCHMARK_UPDATE") == "1" or key not in baselines:
+            return
+        found = regressions(key, results[key], baselines[key])
+        assert not found, "\n".join(found)
+    return check
+
+def pytest_sessionfinish(session):
+    if results and os.environ.get("BENCHMARK_UPDATE") == "1":
+        baselines = load_baselines()
+        baselines.update(results)
+        with open(BASELINES_PATH, "w") as baselines_file:
+            json.dump(dict(sorted(baselines.items())), baselines_file, indent=2)
+            baselines_file.write("\n")
+
+def pytest_terminal_summary(terminalreporter):
+    if not results:
+        return
+    terminalreporter.section("handler benchmarks")
+    terminalreporter.write_line(f"{'scenario':44} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} "
+                                f"{'calls':>24} {'payload':>10} {'peak mem':>12}")
+    for key, result in sorted(results.items()):
+        calls = ", ".join(f"{service} {count}" for service, count in sorted(result["calls"].items()))
+        terminalreporter.write_line(
+            f"{key:44} {result['p50_ms']:>10} {result['p95_ms']:>10} {result['p99_ms']:>10} "
+            f"{calls:>24} {str(result['payload_bytes']):>10} {str(result['peak_memory_bytes']):>12}"
+        )
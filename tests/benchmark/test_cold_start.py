@@ -0,0 +1,52 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from tests.benchmark.conftest import REPEATS, check_budget, record_result
+from tests.unit.conftest import AWS_ENVIRONMENT, LAMBDA_ROOT, LAYER_PATH
+
+pytestmark = pytest.mark.benchmark
+
+# Imports the handler and runs what its first request needs (building clients,
+# loading credentials) in a fresh interpreter, as the init phase and the first
+# invocation of a new sandbox
+COLD_START = """
+import json, sys, time
+started = time.perf_counter()
+import index
+for statement in sys.argv[1:]:
+    exec(statement)
+print(json.dumps({"ms": (time.perf_counter() - started) * 1000}))
+"""
+
+def cold_start(function, statements):
+    environment = {
+        **os.environ,
+        **AWS_ENVIRONMENT,
+        "PYTHONPATH": os.pathsep.join([os.path.join(LAMBDA_ROOT, function), LAYER_PATH]),
+        "LOG_LEVEL": "WARNING",
+    }
+    latencies = []
+    for _ in range(REPEATS):
+        output = subprocess.run(
+            [sys.executable, "-c", COLD_START, *statements],
+            env=environment, capture_output=True, text=True, check=True
+        ).stdout
+        latencies.append(json.loads(output.splitlines()[-1])["ms"])
+    return latencies
+
+@pytest.mark.parametrize("name, function, statements", [
+    ("generate_url_pre_download_url", "generate_url_pre",
+     ["index.presigned_urls.generate_presigned_url('get_object', Params={'Bucket': 'bucket', 'Key': 'a.mp4'})"]),
+    ("generate_url_pre_list", "generate_url_pre", ["index.dynamodb.meta"]),
+    ("process_video", "process_video", ["index.s3_client.meta", "index.dynamodb.meta"]),
+    ("auth", "auth", []),
+])
+def test_cold_start(name, function, statements, check_baseline):
+    key = f"cold_start_{name}"
+    result = record_result(key, cold_start(function, statements), {}, None, None)
+    check_budget(key, result)
+    check_baseline(key)
@@ -0,0 +1,90 @@
+import itertools
+import json
+
+import boto3
+import pytest
+
+from tests.unit.conftest import BUCKET
+
+pytestmark = pytest.mark.benchmark
+
+def playlist_size():
+    return boto3.client("s3").head_object(Bucket=BUCKET, Key="playlist.m3u")["ContentLength"]
+
+def test_catalog_build(library, check_baseline):
+    # Measured once by the library fixture, from an empty catalog
+    check_baseline("catalog_build", library)
+
+def test_full_rescan_of_unchanged_library(library, check_baseline):
+    def run():
+        response = library.process_video.handler({"fullRescan": True}, None)
+        assert response["statusCode"] == 200
+        return playlist_size()
+
+    library.measure("process_video_full_rescan", run, repeats=3)
+    check_baseline("process_video_full_rescan", library)
+
+def test_upload_event(library, check_baseline):
+    uploads = itertools.count()
+
+    def run():
+        key = f"uploads/new{next(uploads):06d}.mp4"
+        boto3.client("s3").put_object(Bucket=BUCKET, Key=key, Body=b"\0" * 16)
+        response = library.process_video.handler({"Records": [{
+            "eventName": "ObjectCreated:Put",
+            "eventTime": "2024-01-01T00:00:00.000Z",
+            "s3": {"bucket": {"name": BUCKET}, "object": {"key": key, "size": 16}}
+        }]}, None)
+        assert response["statusCode"] == 200
+        return playlist_size()
+
+    library.measure("process_video_upload_event", run)
+    check_baseline("process_video_upload_event", library)
+
+def list_request():
+    return {"httpMethod": "GET", "queryStringParameters": {"action": "list", "limit": "100"}}
+
+def test_list_first_page(library, check_baseline):
+    def run():
+        # Every run reads the catalog as after a catalog update
+        library.generate_url_pre.list_cache.clear()
+        response = library.generate_url_pre.handler(list_request(), None)
+        assert len(json.loads(response["body"])["files"]) == 100
+        return len(response["body"])
+
+    library.measure("generate_url_pre_list", run)
+    check_baseline("generate_url_pre_list", library)
+
+def test_list_first_page_cached(library, check_baseline):
+    def run():
+        response = library.generate_url_pre.handler(list_request(), None)
+        return len(response["body"])
+
+    library.measure("generate_url_pre_list_cached", run)
+    check_baseline("generate_url_pre_list_cached", library)
+
+def test_download_url(library, check_baseline):
+    def run():
+        response = library.generate_url_pre.handler({"httpMethod": "GET", "queryStringParameters": {
+            "action": "get_download_url", "key": "folder00/video000000.mp4"
+        }}, None)
+        assert response["statusCode"] == 200
+        return len(response["body"])
+
+    library.measure("generate_url_pre_download_url", run)
+    check_baseline("generate_url_pre_download_url", library)
+
+def test_batch_download_urls(library, check_baseline):
+    keys = [f"folder{i % 20:02d}/video{i:06d}.mp4" for i in range(100)]
+
+    def run():
+        response = library.generate_url_pre.handler({
+            "httpMethod": "POST",
+            "queryStringParameters": {"action": "get_download_urls"},
+            "body": {"keys": keys}
+        }, None)
+        assert response["statusCode"] == 200
+        return len(response["body"])
+
+    library.measure("generate_url_pre_batch_download_urls", run)
+    check_baseline("generate_url_pre_batch_download_urls", library)
@@ -0,0 +1,115 @@
+import importlib
+import os
+import sys
+
+import boto3
+import pytest
+from moto import mock_aws
+
+LAMBDA_ROOT = os.path.join(os.path.dirname(__file__), "..", "..", "video_content_delivery", "src", "lambda")
+# Python path of the layer shared by every function
+LAYER_PATH = os.path.join(LAMBDA_ROOT, "..", "layers", "common", "python")
+
+BUCKET = "video-content-delivery-bucket"
+TABLE = "listOfVideoFiles"
+
+# Modules of the process_video asset. Clients are built on first use, the
+# modules are imported again for every test to reset their caches and state
+PROCESS_VIDEO_MODULES = ("index", "mp4_metadata", "reconcile")
+# Modules of the generate_url_pre asset
+GENERATE_URL_PRE_MODULES = ("index", "cloudfront_cookies")
+# Modules of the common layer, aws_clients caches the clients built inside the moto mock
+LAYER_MODULES = ("aws_clients", "catalog", "lambda_logging", "lambda_metrics", "presigned_urls")
+
+# Environment of the functions, with credentials for moto
+AWS_ENVIRONMENT = {
+    "AWS_DEFAULT_REGION": "eu-west-1",
+    "AWS_ACCESS_KEY_ID": "testing",
+    "AWS_SECRET_ACCESS_KEY": "testing",
+    "TABLE_NAME": TABLE,
+    "BUCKET_NAME": BUCKET,
+}
+
+def create_catalog():
+    """Create the video bucket and the catalog table with its indexes"""
+    boto3.client("s3").create_bucket(Bucket=BUCKET, CreateBucketConfiguration={"LocationConstraint": "eu-west-1"})
+    boto3.client("dynamodb").create_table(
+        TableName=TABLE,
+        KeySchema=[{"AttributeName": "videoList", "KeyType": "HASH"},
+                   {"AttributeName": "Date", "KeyType": "RANGE"}],
+        AttributeDefinitions=[{"AttributeName": name, "AttributeType": "S"}
+                              for name in ("videoList", "Date", "catalog", "folder", "uploadDate")],
+        BillingMode="PAY_PER_REQUEST",
+        GlobalSecondaryIndexes=[
+            {"IndexName": index_name,
+             "KeySchema": [{"AttributeName": partition, "KeyType": "HASH"},
+                           {"AttributeName": "uploadDate", "KeyType": "RANGE"}],
+             "Projection": {"ProjectionType": "ALL"}}
+            for index_name, partition in (("byUploadDate", "catalog"), ("byFolder", "folder"))
+        ]
+    )
+
+@pytest.fixture
+def aws_catalog(monkeypatch):
+    """Video bucket and catalog table with its indexes, backed by moto"""
+    for name, value in AWS_ENVIRONMENT.items():
+        monkeypatch.setenv(name, value)
+
+    with mock_aws():
+        create_catalog()
+        yield
+
+@pytest.fixture
+def process_video(aws_catalog, monkeypatch):
+    """Import a module of the process_video asset inside the moto mock"""
+    monkeypatch.syspath_prepend(LAYER_PATH)
+    monkeypatch.syspath_prepend(os.path.join(LAMBDA_ROOT, "process_video"))
+    for module in PROCESS_VIDEO_MODULES + LAYER_MODULES:
+        sys.modules.pop(module, None)
+    yield importlib.import_module
+    for module in PROCESS_VIDEO_MODULES + LAYER_MODULES:
+        sys.modules.pop(module, None)
+
+@pytest.fixture
+def generate_url_pre(aws_catalog, monkeypatch):
+    """Import a module of the generate_url_pre asset inside the moto mock"""
+    monkeypatch.syspath_prepend(LAYER_PATH)
+    monkeypatch.syspath_prepend(os.path.join(LAMBDA_ROOT, "generate_url_pre"))
+    for module in GENERATE_URL_PRE_MODULES + LAYER_MODULES:
+        sys.modules.pop(module, None)
+    yield importlib.import_module
+    for module in GENERATE_URL_PRE_MODULES + LAYER_MODULES:
+        sys.modules.pop(module, None)
+
+@pytest.fixture
+def package_hls(aws_catalog, monkeypatch):
+    """Import the module of the HLS packaging function inside the moto mock"""
+    monkeypatch.syspath_prepend(LAYER_PATH)
+    monkeypatch.syspath_prepend(os.path.join(LAMBDA_ROOT, "package_hls"))
+    for module in ("index",) + LAYER_MODULES:
+        sys.modules.pop(module, None)
+    yield importlib.import_module
+    for module in ("index",) + LAYER_MODULES:
+        sys.modules.pop(module, None)
+
+@pytest.fixture
+def auth(monkeypatch):
+    """Import the module of the authorizer with an empty decision cache"""
+    monkeypatch.syspath_prepend(LAYER_PATH)
+    monkeypatch.syspath_prepend(os.path.join(LAMBDA_ROOT, "auth"))
+    for module in ("index",) + LAYER_MODULES:
+        sys.modules.pop(module, None)
+    yield importlib.import_module
+    for module in ("index",) + LAYER_MODULES:
+        sys.modules.pop(module, None)
+
+@pytest.fixture
+def common_layer(monkeypatch):
+    """Import a module of the common layer with a fresh invocation state"""
+    monkeypatch.setenv("LOG_LEVEL", "INFO")
+    monkeypatch.syspath_prepend(LAYER_PATH)
+    for module in LAYER_MODULES:
+        sys.modules.pop(module, None)
+    yield importlib.import_module
+    for module in LAYER_MODULES:
+        sys.modules.pop(module, None)
@@ -0,0 +1,134 @@
+import base64
+import hashlib
+import hmac
+import json
+
+import pytest
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+
+SECRET = "hs256-secret"
+NOW = 1_700_000_000
+METHOD_ARN = "arn:aws:execute-api:eu-west-1:123456789012:abcdef/prod/GET/geturl"
+
+RSA_KEY = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+def b64url(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+def b64url_int(value):
+    return b64url(value.to_bytes((value.bit_length() + 7) // 8, "big"))
+
+def jwt(claims, alg="HS256", kid=None, key=SECRET):
+    header = {"alg": alg, "typ": "JWT", **({"kid": kid} if kid else {})}
+    signing_input = f"{b64url(json.dumps(header).encode())}.{b64url(json.dumps(claims).encode())}"
+    if alg == "HS256":
+        signature = hmac.new(key.encode(), signing_input.encode(), hashlib.sha256).digest()
+    elif alg == "RS256":
+        signature = key.sign(signing_input.encode(), padding.PKCS1v15(), hashes.SHA256())
+    else:
+        signature = b""
+    return f"{signing_input}.{b64url(signature)}"
+
+def claims(**overrides):
+    return {"sub": "alice", "exp": NOW + 3600, "iss": "issuer", "aud": "videos", "prefixes": ["teamA/"],
+            **overrides}
+
+class Clock:
+    """Wall and monotonic clock of the authorizer, moved by the tests"""
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock(NOW)
+    monkeypatch.setattr("time.time", clock.time)
+    monkeypatch.setattr("time.monotonic", clock.monotonic)
+    return clock
+
+@pytest.fixture
+def index(auth, clock, monkeypatch):
+    public_numbers = RSA_KEY.public_key().public_numbers()
+    monkeypatch.setenv("JWT_JWKS", json.dumps({"keys": [
+        {"kty": "oct", "kid": "hs", "k": b64url(SECRET.encode())},
+        {"kty": "RSA", "kid": "rs", "n": b64url_int(public_numbers.n), "e": b64url_int(public_numbers.e)}
+    ]}))
+    monkeypatch.setenv("JWT_ISSUER", "issuer")
+    monkeypatch.setenv("JWT_AUDIENCE", "videos")
+    monkeypatch.delenv("EXPECTED_TOKEN", raising=False)
+    return auth("index")
+
+def authorize(index, token):
+    response = index.handler({"authorizationToken": f"Bearer {token}", "methodArn": METHOD_ARN}, None)
+    return response["policyDocument"]["Statement"][0]["Effect"], response
+
+@pytest.mark.parametrize("alg, kid, key", [("HS256", "hs", SECRET), ("RS256", "rs", RSA_KEY)])
+def test_valid_token_allowed_with_prefixes(index, alg, kid, key):
+    effect, response = authorize(index, jwt(claims(), alg, kid, key))
+
+    assert effect == "Allow"
+    assert response["principalId"] == "alice"
+    assert response["context"] == {"prefixes": "teamA/"}
+    # The policy is cached by token for the whole API
+    assert response["policyDocument"]["Statement"][0]["Resource"] == \
+        "arn:aws:execute-api:eu-west-1:123456789012:abcdef/prod/*"
+
+@pytest.mark.parametrize("token", [
+    # Payload changed after signing
+    jwt(claims(), "HS256", "hs").split(".")[0] + "." + b64url(json.dumps(claims(prefixes=[])).encode()) + "."
+    + jwt(claims(), "HS256", "hs").split(".")[2],
+    jwt(claims(), "RS256", "rs", RSA_KEY)[:-4] + "AAAA",
+    jwt(claims(exp=NOW - 3600)),
+    jwt(claims(nbf=NOW + 3600)),
+    jwt(claims(iss="someone-else")),
+    jwt(claims(aud=["other"])),
+    jwt(claims(), alg="none"),
+    jwt(claims(), "HS256", "unknown-kid"),
+    jwt(claims(), "HS256", "hs", "wrong-secret"),
+    jwt(claims(prefixes="teamA/")),
+    jwt(claims(prefixes=["teamA/", 1])),
+    "not-a-jwt",
+])
+def test_invalid_token_denied(index, token):
+    effect, response = authorize(index, token)
+
+    assert effect == "Deny"
+    assert "context" not in response
+
+def test_rs256_signature_of_wrong_length_rejected(index):
+    keys = index.signing_keys(None, index.os.environ["JWT_JWKS"])
+    assert not index.rsa_verify(keys[("RS256", "rs")], b"message", b"\x01" * 10)
+
+def test_allow_cached_until_token_expiry(index, clock):
+    token = jwt(claims(exp=NOW + 60))
+
+    assert authorize(index, token)[0] == "Allow"
+    expires_at, _ = next(iter(index.token_cache.values()))
+    assert expires_at == NOW + 60
+
+    clock.now += 61 + index.CLOCK_SKEW_SECONDS
+    assert authorize(index, token)[0] == "Deny"
+
+def test_deny_before_nbf_cached_until_nbf(index, clock):
+    token = jwt(claims(nbf=NOW + 60))
+
+    assert authorize(index, token)[0] == "Deny"
+    expires_at, _ = next(iter(index.token_cache.values()))
+    assert expires_at == NOW + 60 - index.CLOCK_SKEW_SECONDS
+
+    clock.now += 60
+    assert authorize(index, token)[0] == "Allow"
+
+def test_denied_token_cached(index, clock):
+    authorize(index, jwt(claims(), "HS256", "hs", "wrong-secret"))
+
+    expires_at, (effect, _, _) = next(iter(index.token_cache.values()))
+    assert effect == "Deny"
+    assert expires_at == NOW + index.TOKEN_CACHE_TTL_SECONDS
@@ -0,0 +1,337 @@
+import base64
+import json
+
+import boto3
+import pytest
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+
+from tests.unit.conftest import BUCKET, TABLE
+
+DOMAIN = "d111111abcdef8.cloudfront.net"
+
+@pytest.fixture
+def index(generate_url_pre):
+    return generate_url_pre("index")
+
+@pytest.fixture
+def playback_key(index, monkeypatch):
+    """Private key of the playback distribution, stored in Secrets Manager"""
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+                            serialization.NoEncryption()).decode("ascii")
+    boto3.client("secretsmanager").create_secret(Name="playback-key", SecretString=pem)
+    monkeypatch.setenv("PLAYBACK_DOMAIN", DOMAIN)
+    monkeypatch.setenv("PLAYBACK_KEY_PAIR_ID", "K2JCJMDEHXQW5F")
+    monkeypatch.setenv("PLAYBACK_PRIVATE_KEY_SECRET", "playback-key")
+    return key.public_key()
+
+def get(index, action, prefixes=None, headers=None, **params):
+    return index.handler({
+        "httpMethod": "GET",
+        "queryStringParameters": {"action": action, **params},
+        "headers": headers,
+        "authorizer": {"principalId": "user", "prefixes": prefixes or ""}
+    }, None)
+
+def post(index, action, body, prefixes=None):
+    """Request of an action taking a JSON body, parsed by the integration"""
+    return index.handler({
+        "httpMethod": "POST",
+        "queryStringParameters": {"action": action},
+        "body": body,
+        "authorizer": {"principalId": "user", "prefixes": prefixes or ""}
+    }, None)
+
+def add_video(key, size=1000, upload_date="2024-01-01T00:00:00+00:00"):
+    """Catalog item of a video, as written by ProcessVideoFunction"""
+    folder = key.rsplit("/", 1)[0] if "/" in key else "/"
+    boto3.client("dynamodb").put_item(TableName=TABLE, Item={
+        "videoList": {"S": f"video#{key}"}, "Date": {"S": "current"},
+        "catalog": {"S": "videos"}, "folder": {"S": folder}, "uploadDate": {"S": upload_date},
+        "fileName": {"S": key}, "size": {"N": str(size)}, "contentType": {"S": "video/mp4"}
+    })
+
+def set_catalog_version(version, last_updated="2024-01-01T00:00:00"):
+    boto3.client("dynamodb").put_item(TableName=TABLE, Item={
+        "videoList": {"S": "catalog"}, "Date": {"S": "meta"},
+        "catalogVersion": {"N": str(version)}, "lastUpdated": {"S": last_updated}
+    })
+
+@pytest.fixture
+def catalog(index):
+    for i, key in enumerate(["a.mp4", "teamA/b.mp4", "teamA/sub/c.mp4", "teamB/d.mp4"]):
+        add_video(key, size=1000 * (i + 1), upload_date=f"2024-01-0{i + 1}T00:00:00+00:00")
+    set_catalog_version(1)
+
+def listed(response):
+    assert response["statusCode"] == 200, response["body"]
+    return [video["fileName"] for video in json.loads(response["body"])["files"]]
+
+@pytest.mark.parametrize("event", [{"httpMethod": "GET", "queryStringParameters": None}, {}])
+def test_missing_action_rejected(index, event):
+    # API Gateway sends null query parameters when the request has none
+    response = index.handler(event, None)
+
+    assert response["statusCode"] == 400
+    assert json.loads(response["body"]) == {"error": "Invalid action"}
+
+def test_list_limited_to_allowed_prefixes(index, catalog):
+    assert listed(get(index, "list")) == ["teamB/d.mp4", "teamA/sub/c.mp4", "teamA/b.mp4", "a.mp4"]
+    assert listed(get(index, "list", prefixes="teamA/")) == ["teamA/sub/c.mp4", "teamA/b.mp4"]
+    # Folders are listed through their own index
+    assert listed(get(index, "list", prefixes="teamA/sub/", prefix="teamA/")) == []
+    assert listed(get(index, "list", prefixes="teamA/", prefix="teamA/sub/")) == ["teamA/sub/c.mp4"]
+    assert listed(get(index, "list", prefixes="teamB/", prefix="teamA/")) == []
+
+def test_list_etag_depends_on_allowed_prefixes(index, catalog):
+    unscoped = get(index, "list")
+    scoped = get(index, "list", prefixes="teamA/")
+
+    assert unscoped["headers"]["ETag"] != scoped["headers"]["ETag"]
+    # The cached unscoped page is not served to a scoped caller
+    assert listed(get(index, "list", prefixes="teamA/")) == ["teamA/sub/c.mp4", "teamA/b.mp4"]
+
+def test_list_pages_follow_the_cursor(index, catalog):
+    # ARRANGE
+    pages = [get(index, "list", limit="3")]
+
+    # ACT
+    while json.loads(pages[-1]["body"])["nextCursor"]:
+        pages.append(get(index, "list", limit="3", cursor=json.loads(pages[-1]["body"])["nextCursor"]))
+
+    # ASSERT
+    assert [listed(page) for page in pages] == [["teamB/d.mp4", "teamA/sub/c.mp4", "teamA/b.mp4"], ["a.mp4"]]
+
+@pytest.mark.parametrize("tamper", [
+    # Not base64 encoded JSON any more
+    lambda cursor: cursor[:-4] + "!!!!",
+    # Keys of another index
+    lambda cursor: base64.urlsafe_b64encode(json.dumps({
+        **json.loads(base64.urlsafe_b64decode(cursor)), "folder": "teamA"
+    }).encode("utf-8")).decode("ascii"),
+    lambda cursor: base64.urlsafe_b64encode(b'["a.mp4"]').decode("ascii"),
+])
+def test_tampered_cursor_rejected(index, catalog, tamper):
+    cursor = json.loads(get(index, "list", limit="1")["body"])["nextCursor"]
+
+    response = get(index, "list", limit="1", cursor=tamper(cursor))
+
+    assert response["statusCode"] == 400
+
+@pytest.mark.parametrize("params", [
+    {"limit": "0"},
+    {"limit": "1001"},
+])
+def test_invalid_list_parameters_rejected(index, catalog, params):
+    assert get(index, "list", **params)["statusCode"] == 400
+
+@pytest.mark.parametrize("params, files", [
+    ({"prefix": "teamA/"}, ["teamA/b.mp4"]),
+    ({"prefix": "/"}, ["a.mp4"]),
+    ({"from": "2024-01-02", "to": "2024-01-03"}, ["teamA/sub/c.mp4", "teamA/b.mp4"]),
+    ({"from": "2024-01-03T01:00:00+01:00"}, ["teamB/d.mp4", "teamA/sub/c.mp4"]),
+    ({"to": "2024-01-01"}, ["a.mp4"]),
+    ({"minSize": "2000", "maxSize": "3000"}, ["teamA/sub/c.mp4", "teamA/b.mp4"]),
+    ({"prefix": "teamA", "minSize": "2500"}, []),
+])
+def test_list_filters(index, catalog, params, files):
+    assert listed(get(index, "list", **params)) == files
+
+@pytest.mark.parametrize("params", [
+    {"from": "yesterday"},
+    # Timestamps need a timezone to be compared with the stored ones
+    {"to": "2024-01-02T00:00:00"},
+    {"minSize": "-1"},
+])
+def test_invalid_list_filters_rejected(index, catalog, params):
+    assert get(index, "list", **params)["statusCode"] == 400
+
+def test_legacy_video_list_served_until_migrated(index):
+    # ARRANGE
+    videos = [{"fileName": key, "size": 1, "uploadDate": "2024-01-01T00:00:00", "contentType": "video/mp4"}
+              for key in ("a.mp4", "teamA/b.mp4")]
+    boto3.client("dynamodb").put_item(TableName=TABLE, Item={
+        "videoList": {"S": "all_videos"}, "Date": {"S": "current"},
+        "videos": {"S": json.dumps(videos)}, "lastUpdated": {"S": "2024-01-01T00:00:00"}
+    })
+
+    # ACT
+    response = get(index, "list", prefixes="teamA/")
+
+    # ASSERT
+    assert listed(response) == ["teamA/b.mp4"]
+    assert json.loads(response["body"])["lastUpdated"] == "2024-01-01T00:00:00"
+
+def test_batch_urls_report_errors_per_key(index):
+    response = post(index, "get_download_urls", {"keys": ["teamA/a.mp4", "../secret", "teamB/b.mp4", ""]},
+                    prefixes="teamA/")
+
+    body = json.loads(response["body"])
+    assert response["statusCode"] == 200
+    assert [result["key"] for result in body["urls"]] == ["teamA/a.mp4", "../secret", "teamB/b.mp4", ""]
+    assert body["urls"][0]["url"].startswith(f"https://{BUCKET}.s3.eu-west-1.amazonaws.com/teamA/a.mp4?")
+    assert [result.get("error") for result in body["urls"][1:]] == [
+        "Invalid key parameter", "Key not allowed", "Missing key parameter"
+    ]
+
+@pytest.mark.parametrize("body", [None, {}, {"keys": []}, {"keys": [f"{i}.mp4" for i in range(101)]}])
+def test_invalid_batch_rejected(index, body):
+    assert post(index, "get_upload_urls", body)["statusCode"] == 400
+
+def test_multipart_upload(index):
+    # ARRANGE
+    s3 = boto3.client("s3")
+    created = json.loads(post(index, "create_multipart_upload", {"key": "teamA/big.mp4"}, prefixes="teamA/")["body"])
+    upload = {"key": "teamA/big.mp4", "uploadId": created["uploadId"]}
+    part_urls = json.loads(post(index, "get_upload_part_urls", {**upload, "partNumbers": [1]})["body"])["parts"]
+    # Clients PUT the parts to the signed URLs, uploaded here with the same parameters
+    etag = s3.upload_part(Bucket=BUCKET, Key="teamA/big.mp4", UploadId=created["uploadId"],
+                          PartNumber=1, Body=b"video")["ETag"]
+
+    # ACT
+    parts = json.loads(post(index, "list_upload_parts", upload)["body"])["parts"]
+    wrong_part = post(index, "complete_multipart_upload", {**upload, "parts": [{"partNumber": 1, "etag": '"0"'}]})
+    completed = post(index, "complete_multipart_upload", {**upload, "parts": [{"partNumber": 1, "etag": etag}]})
+
+    # ASSERT
+    assert [part["partNumber"] for part in part_urls] == [1]
+    assert f"uploadId={created['uploadId']}" in part_urls[0]["url"] and "partNumber=1" in part_urls[0]["url"]
+    assert parts == [{"partNumber": 1, "etag": etag, "size": 5}]
+    assert (wrong_part["statusCode"], json.loads(wrong_part["body"])["error"]) == (400, "InvalidPart")
+    assert completed["statusCode"] == 200
+    assert s3.get_object(Bucket=BUCKET, Key="teamA/big.mp4")["Body"].read() == b"video"
+
+def test_aborted_multipart_upload_is_gone(index):
+    # ARRANGE
+    created = json.loads(post(index, "create_multipart_upload", {"key": "big.mp4"})["body"])
+    upload = {"key": "big.mp4", "uploadId": created["uploadId"]}
+
+    # ACT
+    aborted = post(index, "abort_multipart_upload", upload)
+    listed_parts = post(index, "list_upload_parts", upload)
+
+    # ASSERT
+    assert aborted["statusCode"] == 200
+    assert (listed_parts["statusCode"], json.loads(listed_parts["body"])["error"]) == (400, "NoSuchUpload")
+
+@pytest.mark.parametrize("action, body, status_code", [
+    ("create_multipart_upload", {"key": "teamB/big.mp4"}, 403),
+    ("get_upload_part_urls", {"key": "teamA/big.mp4", "uploadId": "id", "partNumbers": [0]}, 400),
+    ("get_upload_part_urls", {"key": "teamA/big.mp4", "uploadId": "id", "partNumbers": list(range(1, 102))}, 400),
+    ("complete_multipart_upload", {"key": "teamA/big.mp4", "uploadId": "id", "parts": [{"partNumber": 1}]}, 400),
+    ("abort_multipart_upload", {"key": "teamA/big.mp4"}, 400),
+])
+def test_invalid_multipart_requests_rejected(index, action, body, status_code):
+    assert post(index, action, body, prefixes="teamA/")["statusCode"] == status_code
+
+@pytest.fixture
+def queries(index, monkeypatch):
+    """Catalog queries sent by the function"""
+    sent = []
+    query = index.dynamodb.query
+
+    def counting_query(**kwargs):
+        sent.append(kwargs)
+        return query(**kwargs)
+
+    monkeypatch.setattr(index.dynamodb, "query", counting_query)
+    return sent
+
+def test_list_not_modified(index, catalog):
+    etag = get(index, "list")["headers"]["ETag"]
+
+    response = get(index, "list", headers={"If-None-Match": f"W/{etag}"})
+
+    assert (response["statusCode"], response["body"]) == (304, "")
+    assert response["headers"]["ETag"] == etag
+
+def test_list_served_from_cache(index, catalog, queries):
+    first = get(index, "list", limit="2")
+    # The ETag only depends on the catalog version, not on the last update time
+    set_catalog_version(1, last_updated="2024-01-02T00:00:00")
+    second = get(index, "list", limit="2")
+
+    assert len(queries) == 1
+    assert second["body"] == first["body"]
+    assert second["headers"]["ETag"] == first["headers"]["ETag"]
+
+def test_list_cache_evicts_least_recently_used(index, catalog, queries, monkeypatch):
+    # ARRANGE
+    monkeypatch.setattr(index, "list_cache", index.ResponseCache(2, 1024 * 1024, 300))
+    get(index, "list", limit="1")
+    get(index, "list", limit="2")
+    get(index, "list", limit="1")
+
+    # ACT
+    get(index, "list", limit="3")
+    get(index, "list", limit="1")
+    get(index, "list", limit="2")
+
+    # ASSERT
+    assert [query["Limit"] for query in queries] == [1, 2, 3, 2]
+
+def test_list_cache_invalidated_by_catalog_update(index, catalog, queries):
+    # ARRANGE
+    before = get(index, "list")
+    add_video("teamC/e.mp4", upload_date="2024-02-01T00:00:00+00:00")
+    set_catalog_version(2)
+
+    # ACT
+    after = get(index, "list", headers={"If-None-Match": before["headers"]["ETag"]})
+
+    # ASSERT
+    assert after["statusCode"] == 200
+    assert after["headers"]["ETag"] != before["headers"]["ETag"]
+    assert listed(after)[0] == "teamC/e.mp4"
+    assert len(queries) == 2
+
+def cloudfront_b64decode(value):
+    return base64.b64decode(value.replace("-", "+").replace("_", "=").replace("~", "/"))
+
+def cookie_resources(public_key, cookie_sets):
+    """Resource of the policy of each cookie set, checking its signature"""
+    resources = {}
+    for cookie_set in cookie_sets:
+        policy = cloudfront_b64decode(cookie_set["cookies"]["CloudFront-Policy"])
+        signature = cloudfront_b64decode(cookie_set["cookies"]["CloudFront-Signature"])
+        public_key.verify(signature, policy, padding.PKCS1v15(), hashes.SHA1())
+        resources[cookie_set["path"]] = [statement["Resource"] for statement in json.loads(policy)["Statement"]]
+    return resources
+
+def test_playback_cookies_cover_the_distribution(index, playback_key):
+    response = get(index, "get_playback_cookies")
+
+    body = json.loads(response["body"])
+    assert response["statusCode"] == 200
+    assert cookie_resources(playback_key, body["cookieSets"]) == {"/": [f"https://{DOMAIN}/*"]}
+    assert body["cookies"] == body["cookieSets"][0]["cookies"]
+    assert body["playlistUrl"] == f"https://{DOMAIN}/playlist.m3u"
+
+def test_playback_cookies_scoped_to_prefixes(index, playback_key):
+    response = get(index, "get_playback_cookies", prefixes="teamB/,teamA/,teamA/sub/")
+
+    body = json.loads(response["body"])
+    assert response["statusCode"] == 200
+    assert "cookies" not in body and "playlistUrl" not in body
+    # Nested prefixes are covered by their parent, renditions are under hls/
+    assert cookie_resources(playback_key, body["cookieSets"]) == {
+        "/teamA/": [f"https://{DOMAIN}/teamA/*"],
+        "/hls/teamA/": [f"https://{DOMAIN}/hls/teamA/*"],
+        "/teamB/": [f"https://{DOMAIN}/teamB/*"],
+        "/hls/teamB/": [f"https://{DOMAIN}/hls/teamB/*"],
+    }
+    assert f"https://{DOMAIN}/teamA/index.m3u" in body["playlistUrls"]
+
+def test_playback_cookies_cached_per_prefix_set(index, playback_key):
+    scoped = json.loads(get(index, "get_playback_cookies", prefixes="teamA/")["body"])
+    unscoped = json.loads(get(index, "get_playback_cookies")["body"])
+
+    assert scoped["cookieSets"] != unscoped["cookieSets"]
+    assert json.loads(get(index, "get_playback_cookies", prefixes="teamA/")["body"]) == scoped
+
+def test_playback_cookies_refused_for_key_prefixes(index, playback_key):
+    # Cookie paths can't express a prefix within a folder
+    response = get(index, "get_playback_cookies", prefixes="teamA/intro")
+
+    assert response["statusCode"] == 403
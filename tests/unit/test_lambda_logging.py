@@ -0,0 +1,74 @@
+import io
+import json
+
+import pytest
+
+class Context:
+    aws_request_id = "request-1"
+
+@pytest.fixture
+def lambda_logging(common_layer):
+    return common_layer("lambda_logging")
+
+def test_records_buffered_until_the_invocation_ends(lambda_logging, capsys):
+    logger = lambda_logging.get_logger("test")
+    expensive = []
+
+    @logger.invocation
+    def handler(event, context):
+        logger.debug("Skipped", videos=lambda: expensive.append(1))
+        logger.info("Listed %d videos", 2, bucket="videos")
+        assert capsys.readouterr().out == ""
+        return "done"
+
+    assert handler({}, Context()) == "done"
+
+    lines = capsys.readouterr().out.splitlines()
+    assert [json.loads(line) for line in lines] == [{
+        "level": "INFO", "logger": "test", "message": "Listed 2 videos",
+        "requestId": "request-1", "bucket": "videos"
+    }]
+    # Fields of disabled records are never evaluated
+    assert expensive == []
+
+@pytest.mark.parametrize("log", [
+    lambda logger: logger.warning("No media metadata", fileName="a.mp4"),
+    lambda logger: logger.exception("Failed", ValueError("bad key"), key="a.mp4"),
+])
+def test_warnings_and_errors_written_immediately(lambda_logging, capsys, log):
+    logger = lambda_logging.get_logger("test")
+    lambda_logging.start_invocation(Context())
+    logger.info("Before the problem")
+    assert capsys.readouterr().out == ""
+
+    log(logger)
+
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == 2
+    assert json.loads(lines[0])["message"] == "Before the problem"
+    assert lambda_logging.buffer == []
+
+def test_records_written_after_buffer_max_seconds(lambda_logging, capsys, monkeypatch):
+    clock = iter([100.0, 100.5, 101.0])
+    monkeypatch.setattr(lambda_logging.time, "monotonic", lambda: next(clock))
+    logger = lambda_logging.get_logger("test")
+    lambda_logging.start_invocation(Context())
+
+    logger.info("First")
+    logger.info("Half a second later")
+    assert capsys.readouterr().out == ""
+    logger.info("A second later")
+
+    assert len(capsys.readouterr().out.splitlines()) == 3
+    assert lambda_logging.buffer == []
+
+def test_flush_writes_to_the_given_stream(lambda_logging):
+    logger = lambda_logging.get_logger("test")
+    lambda_logging.start_invocation(Context())
+    logger.info("Buffered")
+    stream = io.StringIO()
+
+    lambda_logging.flush(stream)
+
+    assert json.loads(stream.getvalue())["message"] == "Buffered"
+    assert lambda_logging.buffer == []
@@ -0,0 +1,54 @@
+import json
+import socket
+
+class Context:
+    aws_request_id = "request-1"
+
+def test_stage_metrics_written_as_emf(common_layer, monkeypatch, capsys):
+    monkeypatch.setenv("AWS_LAMBDA_FUNCTION_NAME", "GetPresignedUrlFunction")
+    lambda_logging = common_layer("lambda_logging")
+    lambda_metrics = common_layer("lambda_metrics")
+
+    @lambda_logging.get_logger("test").invocation
+    def handler(event, context):
+        for items in (10, 5):
+            with lambda_metrics.stage("QueryCatalog") as query:
+                query.count("Items", items)
+
+    handler({}, Context())
+
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert len(records) == 1
+    metrics = records[0]["_aws"]["CloudWatchMetrics"][0]
+    assert metrics["Dimensions"] == [["Service", "Stage"]]
+    assert metrics["Metrics"] == [{"Name": "Duration", "Unit": "Milliseconds"},
+                                  {"Name": "Items", "Unit": "Count"}]
+    assert records[0]["Service"] == "GetPresignedUrlFunction"
+    assert records[0]["Stage"] == "QueryCatalog"
+    assert records[0]["Items"] == [10, 5]
+    assert len(records[0]["Duration"]) == 2
+    # Values are drained once written
+    assert lambda_metrics.stage_values == {}
+
+def test_stages_traced_as_xray_subsegments(common_layer, monkeypatch):
+    daemon = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    daemon.bind(("127.0.0.1", 0))
+    daemon.settimeout(5)
+    monkeypatch.setenv("AWS_XRAY_DAEMON_ADDRESS", f"127.0.0.1:{daemon.getsockname()[1]}")
+    monkeypatch.setenv("_X_AMZN_TRACE_ID", "Root=1-5759e988-bd862e3fe1be46a994272793;Parent=53995c3f42cd8ad8;Sampled=1")
+    lambda_metrics = common_layer("lambda_metrics")
+
+    with lambda_metrics.stage("GeneratePlaylist") as outer:
+        with lambda_metrics.stage("QueryCatalog"):
+            pass
+
+    header, inner = daemon.recv(65536).decode("utf-8").split("\n")
+    _, outer_document = daemon.recv(65536).decode("utf-8").split("\n")
+    daemon.close()
+    assert json.loads(header) == {"format": "json", "version": 1}
+    inner, outer_document = json.loads(inner), json.loads(outer_document)
+    assert inner["name"] == "QueryCatalog"
+    assert inner["trace_id"] == "1-5759e988-bd862e3fe1be46a994272793"
+    assert inner["parent_id"] == outer.id
+    assert outer_document["parent_id"] == "53995c3f42cd8ad8"
+    assert outer_document["end_time"] >= inner["end_time"]
@@ -0,0 +1,115 @@
+import struct
+
+import boto3
+import pytest
+
+from tests.unit.conftest import BUCKET
+
+@pytest.fixture
+def mp4_metadata(process_video):
+    return process_video("mp4_metadata")
+
+class CountingClient:
+    """S3 client counting the ranged GETs of the reader"""
+
+    def __init__(self):
+        self.s3 = boto3.client("s3")
+        self.gets = 0
+
+    def get_object(self, **kwargs):
+        self.gets += 1
+        return self.s3.get_object(**kwargs)
+
+def box(box_type, *children):
+    payload = b"".join(children)
+    return struct.pack(">I4s", 8 + len(payload), box_type.encode("latin-1")) + payload
+
+def large_box(box_type, payload):
+    """Box with a 64-bit size, as written for an mdat over 4 GiB"""
+    return struct.pack(">I4sQ", 1, box_type.encode("latin-1"), 16 + len(payload)) + payload
+
+def mvhd(timescale, duration, version=0):
+    if version == 1:
+        times = struct.pack(">QQIQ", 0, 0, timescale, duration)
+    else:
+        times = struct.pack(">IIII", 0, 0, timescale, duration)
+    return box("mvhd", bytes([version, 0, 0, 0]), times, bytes(80))
+
+def avc1(width, height, profile, compatibility, level, *extensions):
+    entry = bytes(24) + struct.pack(">HH", width, height) + bytes(50)
+    return box("avc1", entry, box("avcC", bytes([1, profile, compatibility, level, 0xff])), *extensions)
+
+def mp4a(object_type=0x40, audio_specific_config=b"\x12\x10"):
+    decoder_config = bytes([object_type, 0x15]) + bytes(11)
+    decoder_config += bytes([0x05, len(audio_specific_config)]) + audio_specific_config
+    es_descriptor = struct.pack(">HB", 1, 0) + bytes([0x04, len(decoder_config)]) + decoder_config
+    esds = box("esds", bytes(4), bytes([0x03, len(es_descriptor)]), es_descriptor)
+    return box("mp4a", bytes(28), esds)
+
+def trak(sample_entry, chunk_offsets=b""):
+    stsd = box("stsd", struct.pack(">II", 0, 1), sample_entry)
+    # Sample tables such as the 64-bit chunk offsets are never read
+    stbl = box("stbl", stsd, box("co64", struct.pack(">II", 0, len(chunk_offsets) // 8), chunk_offsets))
+    return box("trak", box("tkhd", bytes(84)), box("mdia", box("minf", stbl)))
+
+FTYP = box("ftyp", b"isom", bytes(4), b"isomavc1")
+MOOV = box("moov", mvhd(1000, 12500),
+           trak(avc1(1280, 720, 0x64, 0x00, 0x1f), struct.pack(">QQ", 48, 5_000_000_000)),
+           trak(mp4a()))
+MDAT = box("mdat", bytes(200 * 1024))
+
+def read(mp4_metadata, key, data):
+    boto3.client("s3").put_object(Bucket=BUCKET, Key=key, Body=data)
+    client = CountingClient()
+    return mp4_metadata.read_metadata(client, BUCKET, key, len(data)), client.gets
+
+def test_faststart_read_with_one_get(mp4_metadata):
+    metadata, gets = read(mp4_metadata, "faststart.mp4", FTYP + MOOV + MDAT)
+
+    assert metadata == {"duration": 12.5, "width": 1280, "height": 720, "codecs": ["avc1.64001f", "mp4a.40.2"]}
+    assert gets == 1
+
+def test_moov_after_mdat_read_with_two_gets(mp4_metadata):
+    metadata, gets = read(mp4_metadata, "moov-last.mp4", FTYP + MDAT + MOOV)
+
+    assert metadata["codecs"] == ["avc1.64001f", "mp4a.40.2"]
+    assert gets == 2
+
+def test_64_bit_sizes(mp4_metadata):
+    # ARRANGE
+    moov = box("moov", mvhd(90000, 90000 * 7200, version=1), trak(avc1(3840, 2160, 0x64, 0x00, 0x33)))
+
+    # ACT
+    metadata, gets = read(mp4_metadata, "large.mp4", FTYP + large_box("mdat", bytes(100 * 1024)) + moov)
+
+    # ASSERT
+    assert metadata == {"duration": 7200, "width": 3840, "height": 2160, "codecs": ["avc1.640033"]}
+    assert gets == 2
+
+def test_extended_audio_object_type(mp4_metadata):
+    # Audio object types from 32 are escaped with 31, 0xf8 0x20 is type 33
+    moov = box("moov", mvhd(1000, 1000), trak(mp4a(audio_specific_config=b"\xf8\x20")))
+
+    metadata, _ = read(mp4_metadata, "audio.mp4", FTYP + moov)
+
+    assert metadata == {"duration": 1.0, "codecs": ["mp4a.40.33"]}
+
+def test_missing_moov_rejected(mp4_metadata):
+    with pytest.raises(ValueError):
+        read(mp4_metadata, "no-moov.mp4", FTYP + MDAT)
+
+def test_truncated_moov_rejected(mp4_metadata):
+    # The upload stopped in the middle of the movie header
+    data = FTYP + MOOV[:40]
+
+    with pytest.raises(ValueError):
+        read(mp4_metadata, "truncated.mp4", data)
+
+def test_long_sample_description_cut(mp4_metadata):
+    # Only the first STSD_READ_SIZE bytes of the sample description are read
+    entry = avc1(640, 360, 0x42, 0xc0, 0x1e, box("free", bytes(mp4_metadata.STSD_READ_SIZE)))
+    moov = box("moov", mvhd(1000, 2000), trak(entry))
+
+    metadata, _ = read(mp4_metadata, "long-stsd.mp4", FTYP + moov)
+
+    assert metadata["codecs"] == ["avc1.42c01e"]
@@ -0,0 +1,152 @@
+import shutil
+import subprocess
+
+import boto3
+import pytest
+
+from tests.unit.conftest import BUCKET, TABLE
+
+@pytest.fixture
+def index(package_hls):
+    return package_hls("index")
+
+def catalog_item(key):
+    return boto3.client("dynamodb").get_item(
+        TableName=TABLE, Key={"videoList": {"S": f"video#{key}"}, "Date": {"S": "current"}}
+    )["Item"]
+
+def meta_item():
+    return boto3.client("dynamodb").get_item(
+        TableName=TABLE, Key={"videoList": {"S": "catalog"}, "Date": {"S": "meta"}}
+    )["Item"]
+
+def test_renditions_parsed_from_the_tallest(index):
+    assert index.parse_renditions("360:800k, 1080:5000k,720:2800k") == [
+        (1080, "5000k"), (720, "2800k"), (360, "800k")
+    ]
+
+@pytest.mark.parametrize("source_height, heights", [
+    (1080, [1080, 720, 360]),
+    (800, [720, 360]),
+    # Sources smaller than every rendition still get the smallest one
+    (240, [360]),
+])
+def test_renditions_not_taller_than_the_source(index, source_height, heights):
+    renditions = [(1080, "5000k"), (720, "2800k"), (360, "800k")]
+
+    selected = index.select_renditions(renditions, source_height)
+
+    assert [height for height, _ in selected] == heights
+
+def option(command, name):
+    return command[command.index(name) + 1]
+
+def test_ffmpeg_command_maps_audio_to_every_rendition(index):
+    command = index.ffmpeg_command("/tmp/source.mp4", "/tmp/hls", [(720, "2800k"), (360, "800k")], True)
+
+    assert option(command, "-filter_complex") == "[0:v]split=2[v0][v1];[v0]scale=-2:720[v0out];[v1]scale=-2:360[v1out]"
+    assert option(command, "-var_stream_map") == "v:0,a:0,name:720p v:1,a:1,name:360p"
+    assert command.count("a:0") == 2
+    assert option(command, "-b:v:1") == "800k"
+    assert option(command, "-master_pl_name") == "master.m3u8"
+    assert command[-1] == "/tmp/hls/%v/index.m3u8"
+
+def test_ffmpeg_command_without_audio(index):
+    command = index.ffmpeg_command("/tmp/source.mp4", "/tmp/hls", [(480, "1400k")], False)
+
+    assert option(command, "-var_stream_map") == "v:0,name:480p"
+    assert "aac" not in command and "a:0" not in command
+
+def test_renditions_recorded_on_the_catalog(index):
+    # ARRANGE
+    dynamodb = boto3.client("dynamodb")
+    dynamodb.put_item(TableName=TABLE, Item={
+        "videoList": {"S": "video#folder/a.mp4"}, "Date": {"S": "current"}, "catalog": {"S": "videos"},
+        "folder": {"S": "folder"}, "uploadDate": {"S": "2024-01-01T00:00:00"}, "fileName": {"S": "folder/a.mp4"},
+        "size": {"N": "1"}, "contentType": {"S": "video/mp4"}
+    })
+    dynamodb.put_item(TableName=TABLE, Item={
+        "videoList": {"S": "catalog"}, "Date": {"S": "meta"}, "catalogVersion": {"N": "4"},
+        "lastUpdated": {"S": "2024-01-01T00:00:00"}
+    })
+
+    # ACT
+    recorded = index.record_renditions(TABLE, "folder/a.mp4", "hls/folder/a/master.m3u8", ["720p", "360p"])
+
+    # ASSERT
+    assert recorded
+    assert catalog_item("folder/a.mp4")["hls"] == {"M": {
+        "master": {"S": "hls/folder/a/master.m3u8"},
+        "renditions": {"L": [{"S": "720p"}, {"S": "360p"}]}
+    }}
+    # Cached listings are invalidated
+    assert meta_item()["catalogVersion"] == {"N": "5"}
+    assert meta_item()["lastUpdated"] != {"S": "2024-01-01T00:00:00"}
+
+def test_renditions_of_removed_video_not_recorded(index):
+    # ARRANGE
+    boto3.client("dynamodb").put_item(TableName=TABLE, Item={
+        "videoList": {"S": "video#a.mp4"}, "Date": {"S": "current"}, "fileName": {"S": "a.mp4"},
+        "deletedAt": {"S": "2024-01-01T00:00:00"}, "expiresAt": {"N": "1704067200"}
+    })
+
+    # ACT
+    recorded = index.record_renditions(TABLE, "a.mp4", "hls/a/master.m3u8", ["360p"])
+
+    # ASSERT
+    assert not recorded
+    assert "hls" not in catalog_item("a.mp4")
+
+def test_files_transferred_with_the_shared_client(index, tmp_path):
+    # ARRANGE
+    s3 = boto3.client("s3")
+    s3.put_object(Bucket=BUCKET, Key="a.mp4", Body=b"video")
+    for name in ("master.m3u8", "360p/index.m3u8", "360p/segment_00000.ts"):
+        (tmp_path / "hls" / name).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / "hls" / name).write_bytes(b"x")
+
+    # ACT
+    index.download_file(BUCKET, "a.mp4", str(tmp_path / "source.mp4"))
+    index.upload_directory(str(tmp_path / "hls"), BUCKET, "hls/a/")
+
+    # ASSERT
+    assert (tmp_path / "source.mp4").read_bytes() == b"video"
+    objects = {key: s3.head_object(Bucket=BUCKET, Key=key)["ContentType"]
+               for key in ("hls/a/master.m3u8", "hls/a/360p/index.m3u8", "hls/a/360p/segment_00000.ts")}
+    assert objects == {
+        "hls/a/master.m3u8": "application/vnd.apple.mpegurl",
+        "hls/a/360p/index.m3u8": "application/vnd.apple.mpegurl",
+        "hls/a/360p/segment_00000.ts": "video/mp2t"
+    }
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None or shutil.which("ffprobe") is None, reason="ffmpeg is not installed")
+def test_uploaded_video_packaged_end_to_end(package_hls, monkeypatch, tmp_path):
+    # ARRANGE
+    # Read on import, the layer binaries are not available outside Lambda
+    monkeypatch.setenv("FFMPEG_PATH", shutil.which("ffmpeg"))
+    monkeypatch.setenv("FFPROBE_PATH", shutil.which("ffprobe"))
+    monkeypatch.setenv("HLS_RENDITIONS", "240:300k,120:100k")
+    monkeypatch.setenv("HLS_WORK_DIR", str(tmp_path))
+    index = package_hls("index")
+    source = tmp_path / "source.mp4"
+    subprocess.run(["ffmpeg", "-loglevel", "error", "-f", "lavfi", "-i", "testsrc=size=320x240:rate=10",
+                    "-f", "lavfi", "-i", "sine", "-t", "2", "-pix_fmt", "yuv420p", str(source)], check=True)
+    s3 = boto3.client("s3")
+    s3.upload_file(str(source), BUCKET, "folder/a.mp4")
+    source.unlink()
+    boto3.client("dynamodb").put_item(TableName=TABLE, Item={
+        "videoList": {"S": "video#folder/a.mp4"}, "Date": {"S": "current"}, "catalog": {"S": "videos"},
+        "folder": {"S": "folder"}, "uploadDate": {"S": "2024-01-01T00:00:00"}, "fileName": {"S": "folder/a.mp4"},
+        "size": {"N": "1"}, "contentType": {"S": "video/mp4"}
+    })
+
+    # ACT
+    index.handler({"bucket": BUCKET, "key": "folder/a.mp4"}, None)
+
+    # ASSERT
+    keys = {obj["Key"] for obj in s3.list_objects_v2(Bucket=BUCKET, Prefix="hls/folder/a/")["Contents"]}
+    assert {"hls/folder/a/master.m3u8", "hls/folder/a/240p/index.m3u8", "hls/folder/a/120p/index.m3u8"} <= keys
+    assert any(key.endswith(".ts") for key in keys)
+    assert catalog_item("folder/a.mp4")["hls"]["M"]["renditions"] == {"L": [{"S": "240p"}, {"S": "120p"}]}
+    # The work directory is cleaned up
+    assert list(tmp_path.iterdir()) == []
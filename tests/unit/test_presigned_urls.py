@@ -0,0 +1,60 @@
+import datetime
+
+import botocore.auth
+import pytest
+
+NOW = datetime.datetime(2024, 3, 1, 23, 59, 59)
+
+REQUESTS = [
+    ("get_object", {"Bucket": "video-bucket", "Key": "folder/a b+c~d (1)!*'é.mp4"}, 300),
+    ("get_object", {"Bucket": "video-bucket", "Key": "//double//slash/./x.mp4"}, 86400),
+    ("put_object", {"Bucket": "video-bucket", "Key": "uploads/x.mp4", "ContentType": "video/mp4"}, 3600),
+    ("upload_part", {"Bucket": "video-bucket", "Key": "uploads/x.mp4", "UploadId": "a/b+c=", "PartNumber": 7}, 3600),
+]
+
+@pytest.fixture
+def presigned_urls(common_layer, monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "AKIDEXAMPLE")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY")
+    monkeypatch.setattr(botocore.auth, "get_current_datetime", lambda: NOW)
+    module = common_layer("presigned_urls")
+    monkeypatch.setattr(module, "current_time", NOW.replace(tzinfo=datetime.timezone.utc).timestamp)
+    return module
+
+def botocore_url(presigned_urls, client_method, params, expires_in):
+    return presigned_urls.aws_clients.client("s3").generate_presigned_url(
+        client_method, Params=params, ExpiresIn=expires_in
+    )
+
+@pytest.mark.parametrize("region", ["eu-west-1", "us-east-1"])
+@pytest.mark.parametrize("token", [None, "session/token+="])
+def test_urls_match_botocore(presigned_urls, monkeypatch, region, token):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", region)
+    if token:
+        monkeypatch.setenv("AWS_SESSION_TOKEN", token)
+    else:
+        monkeypatch.delenv("AWS_SESSION_TOKEN", raising=False)
+
+    for client_method, params, expires_in in REQUESTS:
+        url = presigned_urls.generate_presigned_url(client_method, Params=params, ExpiresIn=expires_in)
+        assert url == botocore_url(presigned_urls, client_method, params, expires_in)
+        assert "X-Amz-Algorithm=AWS4-HMAC-SHA256" in url
+
+def test_signing_key_derived_once_a_day(presigned_urls, monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "eu-west-1")
+    for _ in range(3):
+        presigned_urls.generate_presigned_url("get_object", Params={"Bucket": "video-bucket", "Key": "a.mp4"})
+    assert list(presigned_urls.signing_keys) == [
+        ("wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY", "20240301", "eu-west-1")
+    ]
+
+@pytest.mark.parametrize("client_method, params", [
+    ("head_object", {"Bucket": "video-bucket", "Key": "a.mp4"}),
+    ("get_object", {"Bucket": "video.bucket", "Key": "a.mp4"}),
+    ("get_object", {"Bucket": "video-bucket", "Key": "a.mp4", "ResponseContentDisposition": "attachment"}),
+])
+def test_other_requests_signed_by_the_client(presigned_urls, monkeypatch, client_method, params):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "eu-west-1")
+    url = presigned_urls.generate_presigned_url(client_method, Params=params, ExpiresIn=60)
+    assert url == botocore_url(presigned_urls, client_method, params, 60)
+    assert presigned_urls.signing_keys == {}
@@ -0,0 +1,428 @@
+import json
+import struct
+from types import SimpleNamespace
+
+import boto3
+import pytest
+
+from tests.unit.conftest import BUCKET, TABLE
+
+class Context:
+    function_name = "ProcessVideoFunction"
+    memory_limit_in_mb = 128
+
+def upload_event(key, sequencer, event_name="ObjectCreated:Put"):
+    return {"Records": [{
+        "eventName": event_name,
+        "eventTime": "2024-01-01T00:00:00.000Z",
+        "s3": {"bucket": {"name": BUCKET}, "object": {"key": key, "size": 1, "sequencer": sequencer}}
+    }]}
+
+def sqs_event(*bodies):
+    """SQS batch of S3 notifications, one message per body"""
+    return {"Records": [
+        {"eventSource": "aws:sqs", "messageId": f"message-{i}",
+         "body": body if isinstance(body, str) else json.dumps(body)}
+        for i, body in enumerate(bodies)
+    ]}
+
+@pytest.fixture
+def index(process_video):
+    module = process_video("index")
+    # The catalog was built before, events are applied incrementally
+    module.dynamodb.put_item(TableName=TABLE, Item={
+        **module.CATALOG_META_KEY,
+        "lastUpdated": {"S": "2024-01-01T00:00:00"}
+    })
+    return module
+
+def catalog_item(key):
+    return boto3.client("dynamodb").get_item(
+        TableName=TABLE, Key={"videoList": {"S": f"video#{key}"}, "Date": {"S": "current"}}
+    )["Item"]
+
+def test_outdated_event_skipped(index):
+    # ARRANGE
+    boto3.client("s3").put_object(Bucket=BUCKET, Key="a.mp4", Body=b"a")
+    index.handler(upload_event("a.mp4", "0000000000000002"), Context())
+
+    # ACT
+    # The delete marker event was delivered after the later upload event
+    response = index.handler(upload_event("a.mp4", "0000000000000001", "ObjectRemoved:DeleteMarkerCreated"), Context())
+
+    # ASSERT
+    assert json.loads(response["body"])["removedVideos"] == []
+    assert catalog_item("a.mp4")["catalog"] == {"S": "videos"}
+    assert catalog_item("a.mp4")["sequencer"]["S"].startswith("0000000000000002")
+
+def test_legacy_catalog_migrated_by_the_first_event(index):
+    # ARRANGE
+    dynamodb = boto3.client("dynamodb")
+    dynamodb.delete_item(TableName=TABLE, Key=index.CATALOG_META_KEY)
+    dynamodb.put_item(TableName=TABLE, Item={
+        **index.LEGACY_CATALOG_KEY,
+        "videos": {"S": json.dumps([
+            {"fileName": "folder/old.mp4", "size": 5, "uploadDate": "2023-12-01T00:00:00", "contentType": "video/mp4"}
+        ])},
+        "lastUpdated": {"S": "2023-12-01T00:00:00"}
+    })
+    boto3.client("s3").put_object(Bucket=BUCKET, Key="folder/new.mp4", Body=b"n")
+
+    # ACT
+    response = index.handler(upload_event("folder/new.mp4", "0000000000000001"), Context())
+
+    # ASSERT
+    assert json.loads(response["body"])["videoCount"] == 2
+    assert catalog_item("folder/old.mp4")["size"] == {"N": "5"}
+    assert "Item" not in dynamodb.get_item(TableName=TABLE, Key=index.LEGACY_CATALOG_KEY)
+    assert index.load_catalog_meta(TABLE)["playlistKey"] == {"S": "playlist.m3u"}
+
+def test_playlists_regenerated_when_catalog_changes(index, monkeypatch):
+    # ARRANGE
+    generate_folder_playlists = index.generate_folder_playlists
+    calls = []
+
+    def concurrent_change(*args):
+        calls.append(args)
+        if len(calls) == 1:
+            # Another invocation changes the catalog while the playlists are generated
+            index.bump_catalog_version(TABLE)
+        return generate_folder_playlists(*args)
+
+    monkeypatch.setattr(index, "generate_folder_playlists", concurrent_change)
+    monkeypatch.setattr(index.time, "sleep", lambda seconds: None)
+
+    # ACT
+    index.handler(upload_event("a.mp4", "0000000000000001"), Context())
+
+    # ASSERT
+    assert len(calls) == 2
+    meta = index.load_catalog_meta(TABLE)
+    assert meta["catalogVersion"] == {"N": "2"}
+    assert meta["videoCount"] == {"N": "1"}
+
+def playlist_entries(key):
+    body = boto3.client("s3").get_object(Bucket=BUCKET, Key=key)["Body"].read().decode()
+    return [line.split(",", 1)[1] for line in body.splitlines() if line.startswith("#EXTINF:")]
+
+def test_upload_rebuilds_only_its_folder_playlist(index):
+    # ARRANGE
+    s3 = boto3.client("s3")
+    s3.put_object(Bucket=BUCKET, Key="teamB/index.m3u", Body=b"untouched")
+    s3.put_object(Bucket=BUCKET, Key="teamA/a.mp4", Body=b"a")
+
+    # ACT
+    response = index.handler(upload_event("teamA/a.mp4", "0000000000000001"), Context())
+
+    # ASSERT
+    assert json.loads(response["body"])["folderPlaylists"] == ["teamA/index.m3u"]
+    assert playlist_entries("teamA/index.m3u") == ["teamA/a.mp4"]
+    assert s3.get_object(Bucket=BUCKET, Key="teamB/index.m3u")["Body"].read() == b"untouched"
+
+def test_playlist_of_emptied_folder_deleted(index):
+    # ARRANGE
+    s3 = boto3.client("s3")
+    s3.put_object(Bucket=BUCKET, Key="teamA/a.mp4", Body=b"a")
+    index.handler(upload_event("teamA/a.mp4", "0000000000000001"), Context())
+    s3.delete_object(Bucket=BUCKET, Key="teamA/a.mp4")
+
+    # ACT
+    response = index.handler(upload_event("teamA/a.mp4", "0000000000000002", "ObjectRemoved:Delete"), Context())
+
+    # ASSERT
+    assert json.loads(response["body"])["folderPlaylists"] == []
+    assert "Contents" not in s3.list_objects_v2(Bucket=BUCKET, Prefix="teamA/")
+
+def test_playback_playlists_list_urls_relative_to_their_folder(index, monkeypatch):
+    # ARRANGE
+    monkeypatch.setenv("PLAYBACK_DOMAIN", "d111111abcdef8.cloudfront.net")
+    boto3.client("s3").put_object(Bucket=BUCKET, Key="team A/clip #1.mp4", Body=b"v")
+
+    # ACT
+    # Keys of S3 notifications are URL encoded
+    response = index.handler(upload_event("team+A/clip+%231.mp4", "0000000000000001"), Context())
+
+    # ASSERT
+    assert json.loads(response["body"])["playlistUrl"] == "https://d111111abcdef8.cloudfront.net/playlist.m3u"
+    s3 = boto3.client("s3")
+    folder_playlist = s3.get_object(Bucket=BUCKET, Key="team A/index.m3u")["Body"].read().decode()
+    assert folder_playlist.splitlines() == ["#EXTM3U", "#EXTINF:-1,team A/clip #1.mp4", "clip%20%231.mp4"]
+    playlist = s3.get_object(Bucket=BUCKET, Key="playlist.m3u")["Body"].read().decode()
+    assert playlist.splitlines()[2] == "team%20A/clip%20%231.mp4"
+
+def mp4(duration_ms):
+    """Smallest MP4 whose header gives a duration, in a 1000 units per second timescale"""
+    def box(box_type, payload):
+        return struct.pack(">I4s", 8 + len(payload), box_type.encode("latin-1")) + payload
+
+    mvhd = box("mvhd", bytes(4) + struct.pack(">IIII", 0, 0, 1000, duration_ms) + bytes(80))
+    return box("ftyp", b"isom" + bytes(4) + b"isomavc1") + box("moov", mvhd) + box("mdat", bytes(1024))
+
+def test_playlist_durations_read_from_the_mp4_header(index):
+    # ARRANGE
+    s3 = boto3.client("s3")
+    s3.put_object(Bucket=BUCKET, Key="a.mp4", Body=mp4(12600))
+    s3.put_object(Bucket=BUCKET, Key="b.mp4", Body=b"not an mp4")
+
+    # ACT
+    index.handler({"fullRescan": True}, Context())
+
+    # ASSERT
+    playlist = s3.get_object(Bucket=BUCKET, Key="playlist.m3u")["Body"].read().decode()
+    assert sorted(line for line in playlist.splitlines() if line.startswith("#EXTINF:")) == [
+        # Rounded to whole seconds, -1 when the duration could not be read
+        "#EXTINF:-1,b.mp4", "#EXTINF:13,a.mp4"
+    ]
+    assert catalog_item("a.mp4")["duration"] == {"N": "12.6"}
+
+def test_playlists_include_changes_not_indexed_yet(index, monkeypatch):
+    # ARRANGE
+    s3 = boto3.client("s3")
+    for key in ("folder/old.mp4", "folder/new.mp4", "fresh/first.mp4"):
+        s3.put_object(Bucket=BUCKET, Key=key, Body=b"v")
+    index.write_videos(TABLE, [
+        {"fileName": file_name, "size": 1, "uploadDate": upload_date, "contentType": "video/mp4"}
+        for file_name, upload_date in (("folder/old.mp4", "2024-01-01T00:00:00+00:00"),
+                                       ("folder/gone.mp4", "2024-01-01T00:00:01+00:00"))
+    ])
+    # The indexes still return the catalog as it was before the batch
+    lagging = {folder: list(index.query_catalog(TABLE, folder=folder)) for folder in (None, "folder", "fresh")}
+    monkeypatch.setattr(index, "query_catalog", lambda table_name, attributes=None, folder=None: iter(lagging[folder]))
+    event = {"Records": [
+        *upload_event("folder/new.mp4", "0000000000000001")["Records"],
+        *upload_event("fresh/first.mp4", "0000000000000002")["Records"],
+        *upload_event("folder/gone.mp4", "0000000000000003", "ObjectRemoved:Delete")["Records"]
+    ]}
+
+    # ACT
+    response = index.handler(event, Context())
+
+    # ASSERT
+    assert json.loads(response["body"])["videoCount"] == 3
+    assert playlist_entries("folder/index.m3u") == ["folder/old.mp4", "folder/new.mp4"]
+    # Not deleted as the playlist of a folder without videos
+    assert playlist_entries("fresh/index.m3u") == ["fresh/first.mp4"]
+    assert playlist_entries("playlist.m3u") == ["folder/old.mp4", "folder/new.mp4", "fresh/first.mp4"]
+
+def test_large_playlist_uploaded_in_parts(index, monkeypatch):
+    # ARRANGE
+    # S3 only accepts parts of at least 5 MB but the last one
+    monkeypatch.setattr(index, "PLAYLIST_PART_SIZE", 5 * 1024 * 1024)
+    chunks = [bytes([i]) * 1024 * 1024 for i in range(11)]
+
+    # ACT
+    index.upload_stream(BUCKET, "playlist.m3u", iter(chunks), "application/x-mpegurl")
+
+    # ASSERT
+    s3 = boto3.client("s3")
+    response = s3.get_object(Bucket=BUCKET, Key="playlist.m3u")
+    assert response["Body"].read() == b"".join(chunks)
+    assert response["ContentType"] == "application/x-mpegurl"
+    assert response["ETag"].strip('"').endswith("-3")
+    assert "Uploads" not in s3.list_multipart_uploads(Bucket=BUCKET)
+
+def test_failed_playlist_upload_aborted(index, monkeypatch):
+    # ARRANGE
+    monkeypatch.setattr(index, "PLAYLIST_PART_SIZE", 5 * 1024 * 1024)
+
+    def chunks():
+        yield b"#" * 6 * 1024 * 1024
+        raise RuntimeError("catalog query failed")
+
+    # ACT
+    with pytest.raises(RuntimeError, match="catalog query failed"):
+        index.upload_stream(BUCKET, "playlist.m3u", chunks(), "application/x-mpegurl")
+
+    # ASSERT
+    s3 = boto3.client("s3")
+    assert "Uploads" not in s3.list_multipart_uploads(Bucket=BUCKET)
+    assert "Contents" not in s3.list_objects_v2(Bucket=BUCKET)
+
+def test_rescan_keeps_event_between_diff_and_write(index, monkeypatch):
+    # ARRANGE
+    s3 = boto3.client("s3")
+    s3.put_object(Bucket=BUCKET, Key="a.mp4", Body=b"a")
+    s3.put_object(Bucket=BUCKET, Key="b.mp4", Body=b"b")
+    index.write_videos(TABLE, [
+        {"fileName": "b.mp4", "size": 1, "uploadDate": "2024-01-01T00:00:00+00:00",
+         "contentType": "video/mp4", "sequencer": "1".zfill(64)}
+    ])
+    add_media_metadata = index.add_media_metadata
+    events = [
+        # The listed a.mp4 is deleted and b.mp4 uploaded again while the headers are read
+        ([{"fileName": "a.mp4", "uploadDate": "2024-01-01T00:00:01", "sequencer": "3".zfill(64)}],
+         index.tombstone_item),
+        ([{"fileName": "b.mp4", "size": 2, "uploadDate": "2024-01-01T00:00:02+00:00",
+           "contentType": "video/mp4", "sequencer": "2".zfill(64)}], index.video_to_item)
+    ]
+
+    def read_then_events(bucket_name, video_info):
+        while events:
+            index.apply_events(TABLE, *events.pop())
+        return add_media_metadata(bucket_name, video_info)
+
+    monkeypatch.setattr(index, "add_media_metadata", read_then_events)
+
+    # ACT
+    index.sync_catalog(TABLE, BUCKET, index.get_all_videos(BUCKET))
+
+    # ASSERT
+    assert "catalog" not in catalog_item("a.mp4")
+    assert catalog_item("b.mp4")["size"] == {"N": "2"}
+    assert catalog_item("b.mp4")["sequencer"] == {"S": "2".zfill(64)}
+
+def test_events_applied_incrementally(index, monkeypatch):
+    # ARRANGE
+    s3 = boto3.client("s3")
+    s3.put_object(Bucket=BUCKET, Key="b.mp4", Body=b"b")
+    index.handler(upload_event("b.mp4", "0000000000000001"), Context())
+    s3.put_object(Bucket=BUCKET, Key="folder/a.mp4", Body=b"a")
+
+    def listing(bucket_name):
+        raise AssertionError("The bucket is listed")
+
+    monkeypatch.setattr(index, "get_all_videos", listing)
+
+    # ACT
+    response = index.handler(upload_event("folder/a.mp4", "0000000000000002"), Context())
+
+    # ASSERT
+    body = json.loads(response["body"])
+    assert [video["fileName"] for video in body["videos"]] == ["folder/a.mp4"]
+    # Sequencers stay in the catalog
+    assert "sequencer" not in body["videos"][0]
+    assert body["videoCount"] == 2
+    assert catalog_item("folder/a.mp4")["folder"] == {"S": "folder"}
+    assert catalog_item("b.mp4")["sequencer"]["S"].startswith("0000000000000001")
+
+def test_sqs_batch_keeps_the_latest_event_of_each_key(index):
+    # ARRANGE
+    s3 = boto3.client("s3")
+    s3.put_object(Bucket=BUCKET, Key="a.mp4", Body=b"a")
+    s3.put_object(Bucket=BUCKET, Key="b.mp4", Body=b"b")
+    event = sqs_event(
+        upload_event("a.mp4", "0000000000000003"),
+        # Delivered after the upload it precedes
+        upload_event("a.mp4", "0000000000000002", "ObjectRemoved:Delete"),
+        {"Service": "Amazon S3", "Event": "s3:TestEvent", "Bucket": BUCKET},
+        {"Records": upload_event("b.mp4", "0000000000000001")["Records"] * 2}
+    )
+
+    # ACT
+    response = index.handler(event, Context())
+
+    # ASSERT
+    body = json.loads(response["body"])
+    assert sorted(video["fileName"] for video in body["videos"]) == ["a.mp4", "b.mp4"]
+    assert body["removedVideos"] == []
+    assert response["batchItemFailures"] == []
+    assert catalog_item("a.mp4")["sequencer"]["S"].startswith("0000000000000003")
+
+def test_failing_messages_reported(index):
+    # ARRANGE
+    boto3.client("s3").put_object(Bucket=BUCKET, Key="a.mp4", Body=b"a")
+    malformed = upload_event("b.mp4", "0000000000000001")
+    del malformed["Records"][0]["s3"]["object"]["key"]
+    event = sqs_event(upload_event("a.mp4", "0000000000000001"), "not json", malformed)
+
+    # ACT
+    response = index.handler(event, Context())
+
+    # ASSERT
+    assert response["statusCode"] == 200
+    assert response["batchItemFailures"] == [{"itemIdentifier": "message-1"}, {"itemIdentifier": "message-2"}]
+    assert catalog_item("a.mp4")["catalog"] == {"S": "videos"}
+
+def test_failed_update_retries_the_whole_batch(index, monkeypatch):
+    # ARRANGE
+    def unavailable(*args):
+        raise RuntimeError("Catalog unavailable")
+
+    monkeypatch.setattr(index, "apply_events", unavailable)
+    event = sqs_event(upload_event("a.mp4", "0000000000000001"), upload_event("b.mp4", "0000000000000001"))
+
+    # ACT
+    response = index.handler(event, Context())
+
+    # ASSERT
+    assert response["statusCode"] == 500
+    assert response["batchItemFailures"] == [{"itemIdentifier": "message-0"}, {"itemIdentifier": "message-1"}]
+
+def test_deleted_video_tombstoned(index):
+    # ARRANGE
+    s3 = boto3.client("s3")
+    s3.put_object(Bucket=BUCKET, Key="a.mp4", Body=b"a")
+    index.handler(upload_event("a.mp4", "0000000000000001"), Context())
+    s3.delete_object(Bucket=BUCKET, Key="a.mp4")
+
+    # ACT
+    response = index.handler(upload_event("a.mp4", "0000000000000002", "ObjectRemoved:Delete"), Context())
+
+    # ASSERT
+    body = json.loads(response["body"])
+    assert body["removedVideos"] == ["a.mp4"]
+    assert body["videoCount"] == 0
+    item = catalog_item("a.mp4")
+    assert "catalog" not in item and "folder" not in item
+    assert {"deletedAt", "expiresAt"} <= set(item)
+    assert item["sequencer"]["S"].startswith("0000000000000002")
+
+def test_rescan_restores_video_uploaded_again_after_its_delete(index):
+    # ARRANGE
+    s3 = boto3.client("s3")
+    s3.put_object(Bucket=BUCKET, Key="a.mp4", Body=b"a")
+    index.handler(upload_event("a.mp4", "0000000000000001"), Context())
+    s3.delete_object(Bucket=BUCKET, Key="a.mp4")
+    index.handler(upload_event("a.mp4", "0000000000000002", "ObjectRemoved:DeleteMarkerCreated"), Context())
+    # Uploaded again, its event is lost
+    s3.put_object(Bucket=BUCKET, Key="a.mp4", Body=b"again")
+
+    # ACT
+    response = index.handler({"fullRescan": True}, Context())
+
+    # ASSERT
+    assert json.loads(response["body"])["videoCount"] == 1
+    item = catalog_item("a.mp4")
+    assert (item["catalog"], item["size"]) == ({"S": "videos"}, {"N": "5"})
+    assert "deletedAt" not in item
+    # Delete events delivered late are still skipped
+    assert item["sequencer"]["S"].startswith("0000000000000002")
+
+def test_upload_event_replaces_tombstone(index):
+    # ARRANGE
+    s3 = boto3.client("s3")
+    s3.put_object(Bucket=BUCKET, Key="folder/a.mp4", Body=b"a")
+    index.handler(upload_event("folder/a.mp4", "0000000000000001"), Context())
+    s3.delete_object(Bucket=BUCKET, Key="folder/a.mp4")
+    index.handler(upload_event("folder/a.mp4", "0000000000000002", "ObjectRemoved:Delete"), Context())
+    s3.put_object(Bucket=BUCKET, Key="folder/a.mp4", Body=b"again")
+
+    # ACT
+    response = index.handler(upload_event("folder/a.mp4", "0000000000000003"), Context())
+
+    # ASSERT
+    assert json.loads(response["body"])["videoCount"] == 1
+    item = catalog_item("folder/a.mp4")
+    assert (item["catalog"], item["folder"]) == ({"S": "videos"}, {"S": "folder"})
+    assert "deletedAt" not in item and "expiresAt" not in item
+    assert item["sequencer"]["S"].startswith("0000000000000003")
+
+def test_rescan_requests_packaging_of_rewritten_videos(index, monkeypatch):
+    # ARRANGE
+    s3 = boto3.client("s3")
+    s3.put_object(Bucket=BUCKET, Key="a.mp4", Body=b"a")
+    s3.put_object(Bucket=BUCKET, Key="b.mp4", Body=b"b")
+    index.handler({"fullRescan": True}, Context())
+    # Changed without its event being delivered
+    s3.put_object(Bucket=BUCKET, Key="a.mp4", Body=b"changed")
+    payloads = []
+    monkeypatch.setattr(index, "lambda_client", SimpleNamespace(
+        invoke=lambda FunctionName, InvocationType, Payload: payloads.append(json.loads(Payload))
+    ))
+    monkeypatch.setenv("HLS_FUNCTION_NAME", "PackageVideoFunction")
+
+    # ACT
+    index.handler({"fullRescan": True}, Context())
+
+    # ASSERT
+    assert payloads == [{"bucket": BUCKET, "key": "a.mp4"}]
@@ -0,0 +1,188 @@
+import gzip
+import json
+import os
+from types import SimpleNamespace
+
+import boto3
+import pytest
+
+from tests.unit.conftest import BUCKET, TABLE
+
+FIXTURE = os.path.join(os.path.dirname(__file__), "fixtures", "inventory.csv")
+
+INVENTORY_BUCKET = "video-inventory"
+PREFIX = f"inventory/{BUCKET}/VideoCatalog/"
+
+@pytest.fixture
+def reconcile(process_video, monkeypatch):
+    monkeypatch.setenv("INVENTORY_BUCKET", INVENTORY_BUCKET)
+    monkeypatch.setenv("INVENTORY_PREFIX", PREFIX)
+    boto3.client("s3").create_bucket(Bucket=INVENTORY_BUCKET, CreateBucketConfiguration={"LocationConstraint": "eu-west-1"})
+    return process_video("reconcile")
+
+def deliver_inventory(delivery, creation_timestamp, complete=True):
+    s3 = boto3.client("s3")
+    with open(FIXTURE, "rb") as f:
+        report = gzip.compress(f.read())
+    data_key = f"{PREFIX}data/{delivery}.csv.gz"
+    s3.put_object(Bucket=INVENTORY_BUCKET, Key=data_key, Body=report)
+    manifest = {
+        "sourceBucket": BUCKET,
+        "destinationBucket": f"arn:aws:s3:::{INVENTORY_BUCKET}",
+        "fileFormat": "CSV",
+        "fileSchema": "Bucket, Key, Size, LastModifiedDate",
+        "creationTimestamp": str(creation_timestamp),
+        "files": [{"key": data_key, "size": len(report)}]
+    }
+    s3.put_object(Bucket=INVENTORY_BUCKET, Key=f"{PREFIX}{delivery}/manifest.json", Body=json.dumps(manifest))
+    if complete:
+        s3.put_object(Bucket=INVENTORY_BUCKET, Key=f"{PREFIX}{delivery}/manifest.checksum", Body=b"0")
+    return f"{PREFIX}{delivery}/manifest.json"
+
+def catalog(reconcile):
+    return {item["fileName"]["S"]: item for item in reconcile.index.query_catalog(TABLE)}
+
+def test_latest_complete_manifest_found(reconcile):
+    # ARRANGE
+    deliver_inventory("2024-01-01T00-00Z", 1704067200000)
+    latest = deliver_inventory("2024-01-02T00-00Z", 1704153600000)
+    deliver_inventory("2024-01-03T00-00Z", 1704240000000, complete=False)
+
+    # ACT
+    manifest_key = reconcile.find_latest_manifest(INVENTORY_BUCKET, PREFIX)
+
+    # ASSERT
+    assert manifest_key == latest
+
+def test_inventory_videos_streamed(reconcile):
+    # ARRANGE
+    manifest_key = deliver_inventory("2024-01-02T00-00Z", 1704153600000)
+
+    # ACT
+    videos = list(reconcile.inventory_videos(reconcile.load_manifest(INVENTORY_BUCKET, manifest_key)))
+
+    # ASSERT
+    assert videos == [
+        {"fileName": "kept.mp4", "size": 100, "uploadDate": "2024-01-01T10:00:00+00:00", "contentType": "video/mp4"},
+        {"fileName": "missing one.mp4", "size": 3, "uploadDate": "2024-01-01T11:00:00+00:00", "contentType": "video/mp4"}
+    ]
+
+def test_only_differences_applied(reconcile):
+    # ARRANGE
+    s3 = boto3.client("s3")
+    s3.put_object(Bucket=BUCKET, Key="kept.mp4", Body=b"k" * 100)
+    s3.put_object(Bucket=BUCKET, Key="missing one.mp4", Body=b"new")
+    reconcile.index.write_videos(TABLE, [
+        {"fileName": "kept.mp4", "size": 100, "uploadDate": "2024-01-01T10:00:00+00:00", "contentType": "video/mp4"},
+        # Removed from the bucket without its event being processed
+        {"fileName": "stale.mp4", "size": 7, "uploadDate": "2023-12-31T10:00:00+00:00", "contentType": "video/mp4"},
+        # Uploaded after the inventory snapshot
+        {"fileName": "recent.mp4", "size": 9, "uploadDate": "2024-01-02T10:00:00+00:00", "contentType": "video/mp4"}
+    ])
+    boto3.client("dynamodb").put_item(TableName=TABLE, Item={
+        **reconcile.index.CATALOG_META_KEY,
+        "lastUpdated": {"S": "2024-01-02T10:00:00"}
+    })
+    manifest_key = deliver_inventory("2024-01-02T00-00Z", 1704153600000)
+
+    # ACT
+    response = reconcile.handler({}, None)
+    repeated = reconcile.handler({}, None)
+
+    # ASSERT
+    body = json.loads(response["body"])
+    assert (body["manifestKey"], body["written"], body["removed"]) == (manifest_key, 1, 1)
+    assert sorted(catalog(reconcile)) == ["kept.mp4", "missing one.mp4", "recent.mp4"]
+    assert catalog(reconcile)["missing one.mp4"]["size"] == {"N": "3"}
+    meta = reconcile.index.load_catalog_meta(TABLE)
+    assert meta["reconciledManifest"] == {"S": manifest_key}
+    assert json.loads(repeated["body"])["message"] == "Inventory already reconciled"
+
+def test_event_between_diff_and_write_kept(reconcile, monkeypatch):
+    # ARRANGE
+    s3 = boto3.client("s3")
+    s3.put_object(Bucket=BUCKET, Key="kept.mp4", Body=b"k" * 100)
+    s3.put_object(Bucket=BUCKET, Key="missing one.mp4", Body=b"new")
+    reconcile.index.write_videos(TABLE, [
+        {"fileName": "kept.mp4", "size": 100, "uploadDate": "2024-01-01T10:00:00+00:00", "contentType": "video/mp4"},
+        {"fileName": "stale.mp4", "size": 7, "uploadDate": "2023-12-31T10:00:00+00:00", "contentType": "video/mp4"}
+    ])
+    boto3.client("dynamodb").put_item(TableName=TABLE, Item={
+        **reconcile.index.CATALOG_META_KEY,
+        "lastUpdated": {"S": "2024-01-02T10:00:00"}
+    })
+    deliver_inventory("2024-01-02T00-00Z", 1704153600000)
+    current_video = reconcile.index.current_video
+    reupload = {"fileName": "stale.mp4", "size": 8, "uploadDate": "2024-01-02T11:00:00+00:00",
+                "contentType": "video/mp4", "sequencer": "2".zfill(64)}
+
+    def head_then_event(bucket_name, file_name):
+        video_info = current_video(bucket_name, file_name)
+        if file_name == "stale.mp4":
+            # The video is uploaded again once the HEAD found it missing
+            reconcile.index.apply_events(TABLE, [reupload], reconcile.index.video_to_item)
+        return video_info
+
+    monkeypatch.setattr(reconcile.index, "current_video", head_then_event)
+
+    # ACT
+    response = reconcile.handler({}, None)
+
+    # ASSERT
+    body = json.loads(response["body"])
+    assert (body["written"], body["removed"]) == (1, 0)
+    item = catalog(reconcile)["stale.mp4"]
+    assert (item["size"], item["sequencer"]) == ({"N": "8"}, {"S": "2".zfill(64)})
+
+def test_video_uploaded_again_after_its_delete_restored(reconcile):
+    # ARRANGE
+    s3 = boto3.client("s3")
+    s3.put_object(Bucket=BUCKET, Key="kept.mp4", Body=b"k" * 100)
+    s3.put_object(Bucket=BUCKET, Key="missing one.mp4", Body=b"new")
+    reconcile.index.write_videos(TABLE, [
+        {"fileName": "kept.mp4", "size": 100, "uploadDate": "2024-01-01T10:00:00+00:00", "contentType": "video/mp4"}
+    ])
+    # Its delete was processed, the event of the upload that followed was lost
+    reconcile.index.tombstone_videos(TABLE, [
+        {"fileName": "missing one.mp4", "uploadDate": "2024-01-01T09:00:00+00:00", "sequencer": "1".zfill(64)}
+    ])
+    boto3.client("dynamodb").put_item(TableName=TABLE, Item={
+        **reconcile.index.CATALOG_META_KEY,
+        "lastUpdated": {"S": "2024-01-02T10:00:00"}
+    })
+    deliver_inventory("2024-01-02T00-00Z", 1704153600000)
+
+    # ACT
+    response = reconcile.handler({}, None)
+
+    # ASSERT
+    body = json.loads(response["body"])
+    assert (body["written"], body["removed"]) == (1, 0)
+    item = catalog(reconcile)["missing one.mp4"]
+    assert item["size"] == {"N": "3"} and "deletedAt" not in item
+    assert item["sequencer"] == {"S": "1".zfill(64)}
+
+def test_packaging_requested_for_written_videos(reconcile, monkeypatch):
+    # ARRANGE
+    s3 = boto3.client("s3")
+    s3.put_object(Bucket=BUCKET, Key="kept.mp4", Body=b"k" * 100)
+    s3.put_object(Bucket=BUCKET, Key="missing one.mp4", Body=b"new")
+    reconcile.index.write_videos(TABLE, [
+        {"fileName": "kept.mp4", "size": 100, "uploadDate": "2024-01-01T10:00:00+00:00", "contentType": "video/mp4"}
+    ])
+    boto3.client("dynamodb").put_item(TableName=TABLE, Item={
+        **reconcile.index.CATALOG_META_KEY,
+        "lastUpdated": {"S": "2024-01-02T10:00:00"}
+    })
+    deliver_inventory("2024-01-02T00-00Z", 1704153600000)
+    payloads = []
+    monkeypatch.setattr(reconcile.index, "lambda_client", SimpleNamespace(
+        invoke=lambda FunctionName, InvocationType, Payload: payloads.append(json.loads(Payload))
+    ))
+    monkeypatch.setenv("HLS_FUNCTION_NAME", "PackageVideoFunction")
+
+    # ACT
+    reconcile.handler({}, None)
+
+    # ASSERT
+    assert payloads == [{"bucket": BUCKET, "key": "missing one.mp4"}]
@@ -1,3 +1,4 @@
+import pytest
 import aws_cdk as core
 import aws_cdk.assertions as assertions
 from video_content_delivery.video_content_delivery_stack import VideoContentDeliveryStack
@@ -26,6 +27,33 @@ def test_s3_bucket_created():
         }
     })
 
+def test_multipart_uploads_processed():
+    # ARRANGE
+    app = core.App()
+    stack = VideoContentDeliveryStack(app, "video-content-delivery")
+    
+    # ACT
+    template = assertions.Template.from_stack(stack)
+
+    # ASSERT
+    template.has_resource_properties("Custom::S3BucketNotifications", {
+        "NotificationConfiguration": {
+            "LambdaFunctionConfigurations": [
+                assertions.Match.object_like({"Events": ["s3:ObjectCreated:Put"]}),
+                assertions.Match.object_like({"Events": ["s3:ObjectCreated:CompleteMultipartUpload"]}),
+                assertions.Match.object_like({"Events": ["s3:ObjectRemoved:Delete"]}),
+                assertions.Match.object_like({"Events": ["s3:ObjectRemoved:DeleteMarkerCreated"]})
+            ]
+        }
+    })
+    template.has_resource_properties("AWS::S3::Bucket", {
+        "LifecycleConfiguration": {
+            "Rules": [assertions.Match.object_like({
+                "AbortIncompleteMultipartUpload": {"DaysAfterInitiation": 7}
+            })]
+        }
+    })
+
 def test_dynamodb_table_created():
     # ARRANGE
     app = core.App()
@@ -40,6 +68,50 @@ def test_dynamodb_table_created():
         "BillingMode": "PAY_PER_REQUEST"
     })
 
+def test_dynamodb_tombstones_expire():
+    # ARRANGE
+    app = core.App()
+    stack = VideoContentDeliveryStack(app, "video-content-delivery")
+    
+    # ACT
+    template = assertions.Template.from_stack(stack)
+
+    # ASSERT
+    template.has_resource_properties("AWS::DynamoDB::Table", {
+        "TimeToLiveSpecification": {
+            "AttributeName": "expiresAt",
+            "Enabled": True
+        }
+    })
+
+def test_dynamodb_catalog_index_created():
+    # ARRANGE
+    app = core.App()
+    stack = VideoContentDeliveryStack(app, "video-content-delivery")
+    
+    # ACT
+    template = assertions.Template.from_stack(stack)
+
+    # ASSERT
+    template.has_resource_properties("AWS::DynamoDB::Table", {
+        "TableName": "listOfVideoFiles",
+        "GlobalSecondaryIndexes": [{
+            "IndexName": "byUploadDate",
+            "KeySchema": [
+                {"AttributeName": "catalog", "KeyType": "HASH"},
+                {"AttributeName": "uploadDate", "KeyType": "RANGE"}
+            ],
+            "Projection": {"ProjectionType": "ALL"}
+        }, {
+            "IndexName": "byFolder",
+            "KeySchema": [
+                {"AttributeName": "folder", "KeyType": "HASH"},
+                {"AttributeName": "uploadDate", "KeyType": "RANGE"}
+            ],
+            "Projection": {"ProjectionType": "ALL"}
+        }]
+    })
+
 def test_lambda_functions_created():
     # ARRANGE
     app = core.App()
@@ -50,7 +122,7 @@ def test_lambda_functions_created():
 
     # ASSERT
     # Verificar que se crean las funciones Lambda (includes CloudWatch log group functions)
-    template.resource_count_is("AWS::Lambda::Function", 5)  # Verifica que hay 5 funciones Lambda
+    template.resource_count_is("AWS::Lambda::Function", 6)  # Verifica que hay 6 funciones Lambda
     
     # Verificar la función GetPresignedUrl
     template.has_resource_properties("AWS::Lambda::Function", {
@@ -88,6 +160,93 @@ def test_api_gateway_created():
         "AuthorizationType": "CUSTOM"
     })
 
+def test_list_query_parameters_mapped():
+    # ARRANGE
+    app = core.App()
+    stack = VideoContentDeliveryStack(app, "video-content-delivery")
+    
+    # ACT
+    template = assertions.Template.from_stack(stack)
+
+    # ASSERT
+    template.has_resource_properties("AWS::ApiGateway::Method", {
+        "HttpMethod": "GET",
+        "RequestParameters": assertions.Match.object_like({
+            "method.request.querystring.action": True,
+            "method.request.querystring.limit": False,
+            "method.request.querystring.cursor": False,
+            "method.request.querystring.prefix": False,
+            "method.request.querystring.from": False,
+            "method.request.querystring.to": False,
+            "method.request.querystring.minSize": False,
+            "method.request.querystring.maxSize": False
+        }),
+        "Integration": assertions.Match.object_like({
+            "RequestParameters": assertions.Match.object_like({
+                "integration.request.querystring.limit": "method.request.querystring.limit",
+                "integration.request.querystring.cursor": "method.request.querystring.cursor",
+                "integration.request.querystring.prefix": "method.request.querystring.prefix"
+            })
+        })
+    })
+
+def test_list_conditional_get_supported():
+    # ARRANGE
+    app = core.App()
+    stack = VideoContentDeliveryStack(app, "video-content-delivery")
+    
+    # ACT
+    template = assertions.Template.from_stack(stack)
+
+    # ASSERT
+    template.has_resource_properties("AWS::ApiGateway::Method", {
+        "HttpMethod": "GET",
+        "RequestParameters": assertions.Match.object_like({
+            "method.request.header.If-None-Match": False
+        }),
+        "Integration": assertions.Match.object_like({
+            "RequestTemplates": {
+                "application/json": assertions.Match.string_like_regexp("If-None-Match")
+            },
+            "IntegrationResponses": [assertions.Match.object_like({
+                "StatusCode": "200",
+                "ResponseTemplates": {
+                    "application/json": assertions.Match.string_like_regexp("responseOverride.status = 304")
+                }
+            })]
+        }),
+        "MethodResponses": assertions.Match.array_with([
+            assertions.Match.object_like({
+                "StatusCode": "304",
+                "ResponseParameters": assertions.Match.object_like({
+                    "method.response.header.ETag": True
+                })
+            })
+        ])
+    })
+
+def test_batch_url_method_created():
+    # ARRANGE
+    app = core.App()
+    stack = VideoContentDeliveryStack(app, "video-content-delivery")
+    
+    # ACT
+    template = assertions.Template.from_stack(stack)
+
+    # ASSERT
+    template.has_resource_properties("AWS::ApiGateway::Method", {
+        "HttpMethod": "POST",
+        "AuthorizationType": "CUSTOM",
+        "RequestParameters": {
+            "method.request.querystring.action": True
+        },
+        "Integration": assertions.Match.object_like({
+            "RequestTemplates": {
+                "application/json": assertions.Match.string_like_regexp("input.json")
+            }
+        })
+    })
+
 def test_authorizer_created():
     # ARRANGE
     app = core.App()
@@ -101,3 +260,323 @@ def test_authorizer_created():
         "Type": "TOKEN",
         "IdentitySource": "method.request.header.Authorization"
     })
+
+def test_playlist_batch_queue_created():
+    # ARRANGE
+    app = core.App()
+    stack = VideoContentDeliveryStack(app, "video-content-delivery",
+                                      playlist_batch_window=core.Duration.seconds(30))
+    
+    # ACT
+    template = assertions.Template.from_stack(stack)
+
+    # ASSERT
+    template.resource_count_is("AWS::SQS::Queue", 2)  # Cola de eventos y DLQ
+    template.has_resource_properties("AWS::Lambda::EventSourceMapping", {
+        "BatchSize": 1000,
+        "MaximumBatchingWindowInSeconds": 30,
+        "FunctionResponseTypes": ["ReportBatchItemFailures"],
+        "ScalingConfig": {"MaximumConcurrency": 2}
+    })
+    # Sized for a batch of 1000 events, messages stay hidden for six times as long
+    template.has_resource_properties("AWS::Lambda::Function", {
+        "FunctionName": "ProcessVideoFunction",
+        "Timeout": 310,
+        "MemorySize": 1024
+    })
+    template.has_resource_properties("AWS::SQS::Queue", {"VisibilityTimeout": 6 * 310 + 30})
+    template.has_resource_properties("Custom::S3BucketNotifications", {
+        "NotificationConfiguration": {
+            "QueueConfigurations": assertions.Match.array_with([assertions.Match.object_like({
+                "Events": ["s3:ObjectCreated:Put"]
+            })])
+        }
+    })
+
+def test_playlist_batch_queue_disabled_by_default():
+    # ARRANGE
+    app = core.App()
+    stack = VideoContentDeliveryStack(app, "video-content-delivery")
+    
+    # ACT
+    template = assertions.Template.from_stack(stack)
+
+    # ASSERT
+    template.resource_count_is("AWS::SQS::Queue", 0)
+    template.resource_count_is("AWS::Lambda::EventSourceMapping", 0)
+    template.has_resource_properties("AWS::Lambda::Function", {
+        "FunctionName": "ProcessVideoFunction",
+        "Timeout": 60
+    })
+
+def test_authorizer_results_cached():
+    # ARRANGE
+    app = core.App()
+    stack = VideoContentDeliveryStack(app, "video-content-delivery")
+    uncached_stack = VideoContentDeliveryStack(app, "video-content-delivery-uncached",
+                                               authorizer_cache_ttl=core.Duration.seconds(0))
+    
+    # ACT
+    template = assertions.Template.from_stack(stack)
+    uncached_template = assertions.Template.from_stack(uncached_stack)
+
+    # ASSERT
+    template.has_resource_properties("AWS::ApiGateway::Authorizer", {
+        "AuthorizerResultTtlInSeconds": 60
+    })
+    uncached_template.has_resource_properties("AWS::ApiGateway::Authorizer", {
+        "AuthorizerResultTtlInSeconds": 0
+    })
+
+def test_playback_distribution_created():
+    # ARRANGE
+    app = core.App()
+    stack = VideoContentDeliveryStack(app, "video-content-delivery",
+                                      playback_public_key_pem="-----BEGIN PUBLIC KEY-----\nMIIB\n-----END PUBLIC KEY-----",
+                                      playback_private_key_secret_name="playback-private-key")
+    
+    # ACT
+    template = assertions.Template.from_stack(stack)
+
+    # ASSERT
+    template.resource_count_is("AWS::CloudFront::Distribution", 1)
+    template.resource_count_is("AWS::CloudFront::KeyGroup", 1)
+    template.has_resource_properties("AWS::CloudFront::Distribution", {
+        "DistributionConfig": assertions.Match.object_like({
+            "DefaultCacheBehavior": assertions.Match.object_like({
+                "TrustedKeyGroups": [assertions.Match.any_value()],
+                "ViewerProtocolPolicy": "redirect-to-https"
+            })
+        })
+    })
+    template.has_resource_properties("AWS::Lambda::Function", {
+        "FunctionName": "ProcessVideoFunction",
+        "Environment": {
+            "Variables": assertions.Match.object_like({
+                "PLAYBACK_DOMAIN": assertions.Match.any_value(),
+                "PLAYBACK_PRIVATE_KEY_SECRET": "playback-private-key"
+            })
+        }
+    })
+
+def test_playback_distribution_disabled_by_default():
+    # ARRANGE
+    app = core.App()
+    stack = VideoContentDeliveryStack(app, "video-content-delivery")
+    
+    # ACT
+    template = assertions.Template.from_stack(stack)
+
+    # ASSERT
+    template.resource_count_is("AWS::CloudFront::Distribution", 0)
+
+def test_hls_packaging_function_created():
+    # ARRANGE
+    app = core.App()
+    stack = VideoContentDeliveryStack(app, "video-content-delivery",
+                                      playback_public_key_pem="-----BEGIN PUBLIC KEY-----\nMIIB\n-----END PUBLIC KEY-----",
+                                      playback_private_key_secret_name="playback-private-key",
+                                      hls_ffmpeg_layer_arn="arn:aws:lambda:eu-west-1:123456789012:layer:ffmpeg:1",
+                                      hls_renditions="720:2800k,360:800k")
+    
+    # ACT
+    template = assertions.Template.from_stack(stack)
+
+    # ASSERT
+    template.has_resource_properties("AWS::Lambda::Function", {
+        "FunctionName": "PackageVideoFunction",
+        "Layers": [assertions.Match.any_value(), "arn:aws:lambda:eu-west-1:123456789012:layer:ffmpeg:1"],
+        "Timeout": 900,
+        "EphemeralStorage": {"Size": 10240},
+        "Environment": {
+            "Variables": assertions.Match.object_like({
+                "HLS_RENDITIONS": "720:2800k,360:800k"
+            })
+        }
+    })
+    # Packaging is requested by ProcessVideoFunction for every new upload
+    template.has_resource_properties("AWS::Lambda::Function", {
+        "FunctionName": "ProcessVideoFunction",
+        "Environment": {
+            "Variables": assertions.Match.object_like({
+                "HLS_FUNCTION_NAME": assertions.Match.any_value()
+            })
+        }
+    })
+    template.has_resource_properties("AWS::IAM::Policy", {
+        "PolicyDocument": {
+            "Statement": assertions.Match.array_with([
+                assertions.Match.object_like({"Action": "lambda:InvokeFunction"})
+            ])
+        }
+    })
+
+def test_hls_packaging_disabled_by_default():
+    # ARRANGE
+    app = core.App()
+    stack = VideoContentDeliveryStack(app, "video-content-delivery")
+    
+    # ACT
+    template = assertions.Template.from_stack(stack)
+
+    # ASSERT
+    template.resource_count_is("AWS::Lambda::Function", 6)
+    template.has_resource_properties("AWS::Lambda::Function", {
+        "FunctionName": "ProcessVideoFunction",
+        "Environment": {
+            "Variables": assertions.Match.object_like({
+                "HLS_FUNCTION_NAME": assertions.Match.absent()
+            })
+        }
+    })
+
+def test_hls_packaging_without_playback_rejected():
+    app = core.App()
+    with pytest.raises(ValueError):
+        VideoContentDeliveryStack(app, "video-content-delivery",
+                                  hls_ffmpeg_layer_arn="arn:aws:lambda:eu-west-1:123456789012:layer:ffmpeg:1")
+
+def test_playback_without_private_key_secret_rejected():
+    app = core.App()
+    with pytest.raises(ValueError):
+        VideoContentDeliveryStack(app, "video-content-delivery",
+                                  playback_public_key_pem="-----BEGIN PUBLIC KEY-----\nMIIB\n-----END PUBLIC KEY-----")
+
+def test_global_playlist_can_be_disabled():
+    # ARRANGE
+    app = core.App()
+    stack = VideoContentDeliveryStack(app, "video-content-delivery", global_playlist=False)
+    
+    # ACT
+    template = assertions.Template.from_stack(stack)
+
+    # ASSERT
+    # Folder playlists are still rebuilt, only playlist.m3u is skipped
+    template.has_resource_properties("AWS::Lambda::Function", {
+        "FunctionName": "ProcessVideoFunction",
+        "Environment": {
+            "Variables": assertions.Match.object_like({
+                "GLOBAL_PLAYLIST": "false"
+            })
+        }
+    })
+
+def test_inventory_reconciliation_scheduled():
+    # ARRANGE
+    app = core.App()
+    stack = VideoContentDeliveryStack(app, "video-content-delivery")
+    
+    # ACT
+    template = assertions.Template.from_stack(stack)
+
+    # ASSERT
+    template.has_resource_properties("AWS::S3::Bucket", {
+        "BucketName": "video-content-delivery-bucket",
+        "InventoryConfigurations": [assertions.Match.object_like({
+            "Id": "VideoCatalog",
+            "ScheduleFrequency": "Daily",
+            "IncludedObjectVersions": "Current",
+            "OptionalFields": ["Size", "LastModifiedDate"]
+        })]
+    })
+    # The catalog is diffed in memory
+    template.has_resource_properties("AWS::Lambda::Function", {
+        "Handler": "reconcile.handler",
+        "FunctionName": "ReconcileCatalogFunction",
+        "Timeout": 900,
+        "MemorySize": 2048
+    })
+    template.has_resource_properties("AWS::Events::Rule", {
+        "ScheduleExpression": "rate(1 day)"
+    })
+
+def test_inventory_reconciliation_can_be_disabled():
+    # ARRANGE
+    app = core.App()
+    stack = VideoContentDeliveryStack(app, "video-content-delivery", reconciliation_schedule=None)
+    
+    # ACT
+    template = assertions.Template.from_stack(stack)
+
+    # ASSERT
+    template.resource_count_is("AWS::Lambda::Function", 5)
+    template.resource_count_is("AWS::Events::Rule", 0)
+
+def test_common_layer_attached():
+    # ARRANGE
+    app = core.App()
+    stack = VideoContentDeliveryStack(app, "video-content-delivery", log_level="DEBUG")
+    
+    # ACT
+    template = assertions.Template.from_stack(stack)
+
+    # ASSERT
+    template.resource_count_is("AWS::Lambda::LayerVersion", 1)
+    for function_name in ("GetPresignedUrlFunction", "apigatewayAuthorizer",
+                          "ProcessVideoFunction", "ReconcileCatalogFunction"):
+        template.has_resource_properties("AWS::Lambda::Function", {
+            "FunctionName": function_name,
+            "Layers": [assertions.Match.any_value()],
+            "Environment": {
+                "Variables": assertions.Match.object_like({"LOG_LEVEL": "DEBUG"})
+            }
+        })
+
+def test_functions_traced_when_enabled():
+    # ARRANGE
+    app = core.App()
+    stack = VideoContentDeliveryStack(app, "video-content-delivery", tracing=True)
+    
+    # ACT
+    template = assertions.Template.from_stack(stack)
+
+    # ASSERT
+    for function_name in ("GetPresignedUrlFunction", "apigatewayAuthorizer",
+                          "ProcessVideoFunction", "ReconcileCatalogFunction"):
+        template.has_resource_properties("AWS::Lambda::Function", {
+            "FunctionName": function_name,
+            "TracingConfig": {"Mode": "Active"}
+        })
+
+def test_api_functions_snap_start():
+    # ARRANGE
+    app = core.App()
+    stack = VideoContentDeliveryStack(app, "video-content-delivery", api_snap_start=True)
+
+    # ACT
+    template = assertions.Template.from_stack(stack)
+
+    # ASSERT
+    for function_name in ("GetPresignedUrlFunction", "apigatewayAuthorizer"):
+        template.has_resource_properties("AWS::Lambda::Function", {
+            "FunctionName": function_name,
+            "SnapStart": {"ApplyOn": "PublishedVersions"}
+        })
+    template.resource_count_is("AWS::Lambda::Alias", 2)
+    # The API invokes the published versions through their alias
+    template.has_resource_properties("AWS::ApiGateway::Method", {
+        "HttpMethod": "GET",
+        "Integration": {"Uri": {"Fn::Join": ["", assertions.Match.array_with([
+            assertions.Match.object_like({"Ref": assertions.Match.string_like_regexp("Aliaslive")})
+        ])]}}
+    })
+
+def test_api_functions_provisioned_concurrency():
+    # ARRANGE
+    app = core.App()
+    stack = VideoContentDeliveryStack(app, "video-content-delivery", api_provisioned_concurrency=2)
+
+    # ACT
+    template = assertions.Template.from_stack(stack)
+
+    # ASSERT
+    template.resource_count_is("AWS::Lambda::Alias", 2)
+    template.has_resource_properties("AWS::Lambda::Alias", {
+        "Name": "live",
+        "ProvisionedConcurrencyConfig": {"ProvisionedConcurrentExecutions": 2}
+    })
+
+def test_snap_start_and_provisioned_concurrency_rejected():
+    app = core.App()
+    with pytest.raises(ValueError):
+        VideoContentDeliveryStack(app, "video-content-delivery", api_snap_start=True, api_provisioned_concurrency=2)
@@ -69,14 +69,19 @@ class ApiGatewayConstruct(Construct):
         print(f"Authorizer created with ID: {authorizer.ref}")
         return authorizer
     
-    def add_authorizer_v2(self, authorizer_name: str, authorizer_function: _lambda.Function) -> apigateway.RequestAuthorizer:
-        """Método para añadir un authorizer a alto nivel"""
+    def add_authorizer_v2(self, authorizer_name: str, authorizer_function: _lambda.IFunction,
+                          results_cache_ttl: Duration = Duration.seconds(0)) -> apigateway.RequestAuthorizer:
+        """Método para añadir un authorizer a alto nivel.
+
+        Con results_cache_ttl API Gateway reutiliza la política devuelta para el mismo
+        token, por lo que el authorizer debe devolver una política válida para toda la API.
+        """
         # Create Lambda Authorizer Token Type
         authorizer = apigateway.TokenAuthorizer(
             self, authorizer_name,
             handler=authorizer_function,
             identity_source="method.request.header.Authorization",
-            results_cache_ttl=Duration.seconds(0)
+            results_cache_ttl=results_cache_ttl
         )
         return authorizer
 
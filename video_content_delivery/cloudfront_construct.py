@@ -0,0 +1,48 @@
+from aws_cdk import (
+    aws_cloudfront as cloudfront,
+    aws_cloudfront_origins as origins,
+    aws_s3 as s3,
+)
+from constructs import Construct
+
+class CloudFrontConstruct(Construct):
+    """CloudFront distribution serving the video bucket to holders of signed cookies"""
+
+    def __init__(self, scope: Construct, construct_id: str, bucket: s3.IBucket,
+                 public_key_pem: str, **kwargs) -> None:
+        super().__init__(scope, construct_id, **kwargs)
+
+        # Public half of the key used by GetPresignedUrlFunction to sign cookies
+        self.public_key = cloudfront.PublicKey(
+            self, "PlaybackPublicKey",
+            encoded_key=public_key_pem,
+            comment="Verifies the signed cookies of video playback"
+        )
+        key_group = cloudfront.KeyGroup(
+            self, "PlaybackKeyGroup",
+            items=[self.public_key]
+        )
+
+        origin = origins.S3BucketOrigin.with_origin_access_control(bucket)
+
+        self.distribution = cloudfront.Distribution(
+            self, "PlaybackDistribution",
+            comment="Video playback",
+            default_behavior=cloudfront.BehaviorOptions(
+                origin=origin,
+                viewer_protocol_policy=cloudfront.ViewerProtocolPolicy.REDIRECT_TO_HTTPS,
+                cache_policy=cloudfront.CachePolicy.CACHING_OPTIMIZED,
+                origin_request_policy=cloudfront.OriginRequestPolicy.CORS_S3_ORIGIN,
+                trusted_key_groups=[key_group]
+            ),
+            additional_behaviors={
+                # Playlists change with every upload, S3 still answers conditional GETs
+                "*.m3u": cloudfront.BehaviorOptions(
+                    origin=origin,
+                    viewer_protocol_policy=cloudfront.ViewerProtocolPolicy.REDIRECT_TO_HTTPS,
+                    cache_policy=cloudfront.CachePolicy.CACHING_DISABLED,
+                    origin_request_policy=cloudfront.OriginRequestPolicy.CORS_S3_ORIGIN,
+                    trusted_key_groups=[key_group]
+                )
+            }
+        )
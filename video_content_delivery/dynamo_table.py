@@ -19,4 +19,33 @@ class DynamoTable:
             ),
             billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
             removal_policy=RemovalPolicy.DESTROY,
+            # Tombstones of removed videos expire on their own
+            time_to_live_attribute="expiresAt",
+        )
+
+        # Each video is stored as its own item ('video#<fileName>', 'current'),
+        # these indexes list them by upload date, globally or inside a folder
+        self.table.add_global_secondary_index(
+            index_name="byUploadDate",
+            partition_key=dynamodb.Attribute(
+                name="catalog",
+                type=dynamodb.AttributeType.STRING
+            ),
+            sort_key=dynamodb.Attribute(
+                name="uploadDate",
+                type=dynamodb.AttributeType.STRING
+            ),
+            projection_type=dynamodb.ProjectionType.ALL
+        )
+        self.table.add_global_secondary_index(
+            index_name="byFolder",
+            partition_key=dynamodb.Attribute(
+                name="folder",
+                type=dynamodb.AttributeType.STRING
+            ),
+            sort_key=dynamodb.Attribute(
+                name="uploadDate",
+                type=dynamodb.AttributeType.STRING
+            ),
+            projection_type=dynamodb.ProjectionType.ALL
         )
@@ -12,8 +12,17 @@ from video_content_delivery.dynamo_table import DynamoTable
 class LambdaConstruct(Construct):
     def __init__(self, scope: Construct, id: str, handler_file: str, path_l: str, 
                  function_name: str, runtime: lambda_.Runtime, table: DynamoTable = None, 
-                 environment: dict = None, **kwargs):
+                 environment: dict = None, tracing: bool = False, snap_start: bool = False,
+                 provisioned_concurrency: int = None, **kwargs):
+        """tracing turns on active X-Ray tracing, the stages timed by the
+        functions then show up as subsegments of their traces.
+        snap_start restores published versions from a snapshot taken after init,
+        provisioned_concurrency keeps that many environments initialized. Both
+        publish a version behind the 'live' alias, invoke it through target."""
         super().__init__(scope, id)
+
+        if snap_start and provisioned_concurrency:
+            raise ValueError("snap_start and provisioned_concurrency cannot be combined on a function")
     
         # Create the Lambda function
         self.lambda_function = lambda_.Function(
@@ -24,9 +33,19 @@ class LambdaConstruct(Construct):
             code=lambda_.Code.from_asset(path=path_l),
             function_name=function_name,
             environment=environment,
+            tracing=lambda_.Tracing.ACTIVE if tracing else None,
+            snap_start=lambda_.SnapStartConf.ON_PUBLISHED_VERSIONS if snap_start else None,
             **kwargs
         )
 
+        # SnapStart and provisioned concurrency only apply to published versions
+        self.alias = None
+        if snap_start or provisioned_concurrency:
+            self.alias = self.lambda_function.add_alias(
+                "live", provisioned_concurrent_executions=provisioned_concurrency
+            )
+        self.target = self.alias or self.lambda_function
+
         # Create CloudWatch Log Group
         log_group = logs.LogGroup(
             self,
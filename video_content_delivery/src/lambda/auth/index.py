@@ -1,24 +1,219 @@
 import json
 import os
+import hmac
+import time
+import base64
+import hashlib
+from functools import lru_cache
 
+from lambda_logging import get_logger
+from lambda_metrics import stage
+
+logger = get_logger('auth')
+
+# Decisions reused across warm invocations, keyed by a digest of the token
+TOKEN_CACHE_TTL_SECONDS = int(os.environ.get('TOKEN_CACHE_TTL_SECONDS', '300'))
+TOKEN_CACHE_MAX_ENTRIES = int(os.environ.get('TOKEN_CACHE_MAX_ENTRIES', '1024'))
+token_cache = {}
+
+# Tolerated clock difference when checking exp and nbf
+CLOCK_SKEW_SECONDS = 30
+
+# DER prefix of a SHA-256 DigestInfo, signed by RS256 (PKCS#1 v1.5)
+SHA256_DIGEST_INFO = bytes.fromhex('3031300d060960864801650304020105000420')
+
+@logger.invocation
 def handler(event, context):
     token = event.get('authorizationToken')
-    print('token received:', token)
-    print('Method ARN:', event.get('methodArn'))
+    logger.debug("Authorizing request", methodArn=event.get('methodArn'))
+
+    # API Gateway caches the policy by token, so it must cover every method of the API
+    resource = api_wide_resource(event.get('methodArn'))
 
     if not token:
-        print('ERROR: no token received!!')
-        return generate_policy('user', 'Deny', event.get('methodArn'))
-    
+        logger.warning("No token received")
+        return generate_policy('user', 'Deny', resource)
+
+    if token.startswith('Bearer '):
+        token = token[len('Bearer '):]
+
+    decision = cached_decision(token)
+    if decision is None:
+        with stage('VerifyToken'):
+            decision, expires_at = authorize(token)
+        cache_decision(token, decision, expires_at)
+    else:
+        logger.debug("Using cached decision", effect=decision[0])
+
+    effect, principal_id, auth_context = decision
+    return generate_policy(principal_id, effect, resource, auth_context)
+
+def authorize(token):
+    """Decide on a token, returning (effect, principal, context) and when the decision expires"""
+    now = time.time()
+    if signing_keys(os.environ.get('JWT_SECRET'), os.environ.get('JWT_JWKS')):
+        claims = verify_signature(token)
+        if claims is not None and valid_claims(claims, now):
+            auth_context = {'prefixes': ','.join(claims.get('prefixes', []))}
+            return ('Allow', claims.get('sub', 'user'), auth_context), claims['exp']
+        # Static tokens are only accepted next to signed ones when explicitly configured
+        if 'EXPECTED_TOKEN' not in os.environ:
+            return ('Deny', 'user', {}), not_before(claims)
+
     # Use environment variable for expected token, fallback to default for backwards compatibility
     expected_token = os.environ.get('EXPECTED_TOKEN', 'valid-token')
+    if hmac.compare_digest(token.encode('utf-8'), expected_token.encode('utf-8')):
+        return ('Allow', 'user', {}), None
+    return ('Deny', 'user', {}), None
+
+def b64url_decode(segment):
+    return base64.urlsafe_b64decode(segment + '=' * (-len(segment) % 4))
+
+@lru_cache(maxsize=4)
+def signing_keys(secret, jwks):
+    """Decode the key material once per container.
+
+    JWT_SECRET is a shared HS256 secret, JWT_JWKS a JSON Web Key Set holding
+    'oct' (HS256) and 'RSA' (RS256) keys. Keys are indexed by (alg, kid).
+    """
+    keys = {}
+    if secret:
+        keys[('HS256', None)] = secret.encode('utf-8')
+    if jwks:
+        for jwk in json.loads(jwks).get('keys', []):
+            if jwk.get('kty') == 'oct':
+                keys[('HS256', jwk.get('kid'))] = b64url_decode(jwk['k'])
+            elif jwk.get('kty') == 'RSA':
+                keys[('RS256', jwk.get('kid'))] = (
+                    int.from_bytes(b64url_decode(jwk['n']), 'big'),
+                    int.from_bytes(b64url_decode(jwk['e']), 'big')
+                )
+    return keys
 
-    if token == expected_token:
-        return generate_policy('user', 'Allow', event.get('methodArn'))
+def find_key(alg, kid):
+    keys = signing_keys(os.environ.get('JWT_SECRET'), os.environ.get('JWT_JWKS'))
+    if (alg, kid) in keys:
+        return keys[(alg, kid)]
+    if kid is None:
+        # Tokens without kid are accepted when a single key of the algorithm exists
+        candidates = [key for (key_alg, _), key in keys.items() if key_alg == alg]
+        if len(candidates) == 1:
+            return candidates[0]
+    return None
+
+def rsa_verify(public_key, message, signature):
+    """Verify an RSASSA-PKCS1-v1_5 SHA-256 signature"""
+    n, e = public_key
+    size = (n.bit_length() + 7) // 8
+    signature_value = int.from_bytes(signature, 'big')
+    if len(signature) != size or signature_value >= n:
+        return False
+    encoded = pow(signature_value, e, n).to_bytes(size, 'big')
+    digest = SHA256_DIGEST_INFO + hashlib.sha256(message).digest()
+    expected = b'\x00\x01' + b'\xff' * (size - len(digest) - 3) + b'\x00' + digest
+    return hmac.compare_digest(encoded, expected)
+
+def verify_signature(token):
+    """Return the claims of a validly signed token, or None"""
+    try:
+        header_b64, payload_b64, signature_b64 = token.split('.')
+        header = json.loads(b64url_decode(header_b64))
+        claims = json.loads(b64url_decode(payload_b64))
+        signature = b64url_decode(signature_b64)
+    except ValueError as e:
+        logger.info("Malformed token", reason=str(e))
+        return None
+
+    if not isinstance(header, dict) or not isinstance(claims, dict):
+        logger.info("Malformed token", reason="header and claims must be JSON objects")
+        return None
+
+    alg = header.get('alg')
+    key = find_key(alg, header.get('kid'))
+    if key is None:
+        logger.info("No key for token algorithm and kid", alg=alg, kid=header.get('kid'))
+        return None
+
+    signing_input = f"{header_b64}.{payload_b64}".encode('ascii')
+    if alg == 'HS256':
+        valid = hmac.compare_digest(hmac.new(key, signing_input, hashlib.sha256).digest(), signature)
     else:
-        return generate_policy('user', 'Deny', event.get('methodArn'))
+        valid = rsa_verify(key, signing_input, signature)
+    if not valid:
+        logger.info("Invalid token signature")
+        return None
+    return claims
+
+def not_before(claims):
+    """When a signed token denied before its nbf has to be checked again, else None"""
+    nbf = (claims or {}).get('nbf')
+    if isinstance(nbf, (int, float)) and time.time() < nbf - CLOCK_SKEW_SECONDS:
+        return nbf - CLOCK_SKEW_SECONDS
+    return None
+
+def valid_claims(claims, now):
+    """Check expiry, not-before, issuer, audience and the allowed prefixes claim"""
+    exp = claims.get('exp')
+    if not isinstance(exp, (int, float)) or now > exp + CLOCK_SKEW_SECONDS:
+        logger.info("Token expired or without exp")
+        return False
+    nbf = claims.get('nbf')
+    if isinstance(nbf, (int, float)) and now < nbf - CLOCK_SKEW_SECONDS:
+        logger.info("Token not valid yet")
+        return False
 
-def generate_policy(principal_id, effect, resource):
+    issuer = os.environ.get('JWT_ISSUER')
+    if issuer and claims.get('iss') != issuer:
+        logger.info("Unexpected token issuer", issuer=claims.get('iss'))
+        return False
+    audience = os.environ.get('JWT_AUDIENCE')
+    token_audience = claims.get('aud')
+    if audience and audience != token_audience and \
+            not (isinstance(token_audience, list) and audience in token_audience):
+        logger.info("Unexpected token audience", audience=token_audience)
+        return False
+
+    prefixes = claims.get('prefixes', [])
+    if not isinstance(prefixes, list) or not all(isinstance(prefix, str) for prefix in prefixes):
+        logger.info("Invalid prefixes claim")
+        return False
+    return True
+
+def token_digest(token):
+    return hashlib.sha256(token.encode('utf-8')).digest()
+
+def cached_decision(token):
+    """Decision taken for the token in a previous invocation, if still fresh"""
+    entry = token_cache.get(token_digest(token))
+    if entry is None:
+        return None
+    expires_at, decision = entry
+    if time.monotonic() >= expires_at:
+        del token_cache[token_digest(token)]
+        return None
+    return decision
+
+def cache_decision(token, decision, expires_at=None):
+    ttl = TOKEN_CACHE_TTL_SECONDS
+    if expires_at is not None:
+        # Never keep allowing a token past its own expiry, nor denying it past its nbf
+        ttl = min(ttl, expires_at - time.time())
+    if ttl <= 0:
+        return
+    if len(token_cache) >= TOKEN_CACHE_MAX_ENTRIES:
+        # Drop the oldest decision, dicts keep insertion order
+        del token_cache[next(iter(token_cache))]
+    token_cache[token_digest(token)] = (time.monotonic() + ttl, decision)
+
+def api_wide_resource(method_arn):
+    """Turn arn:...:api-id/stage/METHOD/path into arn:...:api-id/stage/*"""
+    if not method_arn:
+        return method_arn
+    api_arn, _, rest = method_arn.partition('/')
+    stage_name = rest.split('/', 1)[0]
+    return f"{api_arn}/{stage_name}/*"
+
+def generate_policy(principal_id, effect, resource, auth_context=None):
     auth_response = {
         'principalId': principal_id
     }
@@ -35,7 +230,11 @@ def generate_policy(principal_id, effect, resource):
             ]
         }
         auth_response['policyDocument'] = policy_document
-        print('Generated policyDocument:', json.dumps(policy_document, indent=2))
 
-    print('Return authResponse:', json.dumps(auth_response, indent=2))
-    return auth_response
\ No newline at end of file
+    if auth_context:
+        # Available to the integrations as $context.authorizer.<name>
+        auth_response['context'] = auth_context
+
+    logger.info("Authorization decided", principalId=principal_id, effect=effect)
+    logger.debug("Authorizer response", response=auth_response)
+    return auth_response
@@ -0,0 +1,79 @@
+"""Signed cookies for the CloudFront playback distribution.
+
+CloudFront verifies RSA-SHA1 (PKCS#1 v1.5) signatures of a JSON policy. The
+private key is a PEM (PKCS#1 or PKCS#8) RSA key, signing uses only the
+standard library so the function needs no extra package.
+"""
+import json
+import base64
+import hashlib
+
+# DER prefix of a SHA-1 DigestInfo
+SHA1_DIGEST_INFO = bytes.fromhex('3021300906052b0e03021a05000414')
+
+def read_der(data, offset):
+    """Read the DER element at offset, returning its value and the next offset"""
+    length = data[offset + 1]
+    offset += 2
+    if length & 0x80:
+        size = length & 0x7f
+        length = int.from_bytes(data[offset:offset + size], 'big')
+        offset += size
+    return data[offset:offset + length], offset + length
+
+def parse_private_key(pem):
+    """Return the RSA private key of a PEM as (n, d, p, q, dp, dq, qinv)"""
+    der = base64.b64decode(''.join(
+        line for line in pem.strip().splitlines() if not line.startswith('-----')
+    ))
+    body, _ = read_der(der, 0)
+    if 'BEGIN PRIVATE KEY' in pem:
+        # PKCS#8 wraps the PKCS#1 key: version, algorithm, OCTET STRING
+        _, offset = read_der(body, 0)
+        _, offset = read_der(body, offset)
+        wrapped, _ = read_der(body, offset)
+        body, _ = read_der(wrapped, 0)
+
+    integers = []
+    offset = 0
+    while offset < len(body):
+        value, offset = read_der(body, offset)
+        integers.append(int.from_bytes(value, 'big'))
+    # version, n, e, d, p, q, dp, dq, qinv
+    _, n, _, d, p, q, dp, dq, qinv = integers[:9]
+    return n, d, p, q, dp, dq, qinv
+
+def rsa_sha1_sign(private_key, message):
+    """RSASSA-PKCS1-v1_5 signature with SHA-1, using the CRT parameters of the key"""
+    n, _, p, q, dp, dq, qinv = private_key
+    size = (n.bit_length() + 7) // 8
+    digest = SHA1_DIGEST_INFO + hashlib.sha1(message).digest()
+    encoded = b'\x00\x01' + b'\xff' * (size - len(digest) - 3) + b'\x00' + digest
+    m = int.from_bytes(encoded, 'big')
+    s1 = pow(m, dp, p)
+    s2 = pow(m, dq, q)
+    h = (qinv * (s1 - s2)) % p
+    return (s2 + h * q).to_bytes(size, 'big')
+
+def cloudfront_b64(data):
+    """Base64 variant used by CloudFront in cookies and query strings"""
+    return base64.b64encode(data).decode('ascii').replace('+', '-').replace('=', '_').replace('/', '~')
+
+def signed_cookies(domain, key_pair_id, private_key, expires_at, path='/'):
+    """Cookies granting access to the objects under path until expires_at (epoch seconds).
+
+    A custom policy holds a single statement, access to several paths takes a
+    set of cookies per path, each sent by browsers only under its own path.
+    """
+    policy = json.dumps({
+        'Statement': [{
+            'Resource': f"https://{domain}{path}*",
+            'Condition': {'DateLessThan': {'AWS:EpochTime': int(expires_at)}}
+        }]
+    }, separators=(',', ':')).encode('utf-8')
+
+    return {
+        'CloudFront-Policy': cloudfront_b64(policy),
+        'CloudFront-Signature': cloudfront_b64(rsa_sha1_sign(private_key, policy)),
+        'CloudFront-Key-Pair-Id': key_pair_id
+    }
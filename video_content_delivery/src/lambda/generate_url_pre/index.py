@@ -1,52 +1,154 @@
 import os
 import json
-import boto3
+import time
+import base64
+import hashlib
+from collections import OrderedDict
 from botocore.exceptions import ClientError
-from datetime import datetime
+from datetime import datetime, timezone
 
-s3_client = boto3.client('s3')
-dynamodb = boto3.client('dynamodb')
+import cloudfront_cookies
+import presigned_urls
+from aws_clients import lazy_client
+from catalog import (
+    CATALOG_META_KEY, CATALOG_PARTITION, FOLDER_INDEX, LEGACY_CATALOG_KEY, ROOT_FOLDER, UPLOAD_DATE_INDEX,
+    item_to_video
+)
+from lambda_logging import get_logger
+from lambda_metrics import record, stage
 
+logger = get_logger('generate_url_pre')
+
+# Requests only build the clients they use
+s3_client = lazy_client('s3')
+dynamodb = lazy_client('dynamodb')
+secrets_client = lazy_client('secretsmanager')
+
+# Partition and sort key of each index, used to build and validate cursors
+INDEX_KEYS = {
+    UPLOAD_DATE_INDEX: ('catalog', 'uploadDate'),
+    FOLDER_INDEX: ('folder', 'uploadDate')
+}
+
+# Page size of action=list when no limit is requested, and the largest one allowed
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Presigned URL settings of the batch actions: client method, extra params, expiration
+BATCH_URL_OPERATIONS = {
+    'get_download_urls': ('get_object', {}, 300),
+    'get_upload_urls': ('put_object', {'ContentType': 'video/mp4'}, 3600)
+}
+MAX_BATCH_KEYS = 100
+
+# Multipart uploads: parts are numbered from 1 to 10000, URLs are signed in batches
+MAX_PART_NUMBER = 10000
+MAX_PART_URLS = 100
+PART_URL_EXPIRATION = 3600
+
+# S3 errors caused by the client request rather than by the server
+MULTIPART_CLIENT_ERRORS = ('NoSuchUpload', 'InvalidPart', 'InvalidPartOrder', 'EntityTooSmall')
+
+# Playback cookies stay valid for PLAYBACK_COOKIE_TTL_SECONDS and the same cookies
+# are handed out until half of that time has passed
+PLAYBACK_COOKIE_TTL_SECONDS = int(os.environ.get('PLAYBACK_COOKIE_TTL_SECONDS', str(12 * 3600)))
+playback_private_key = None
+# Cookies of each set of allowed prefixes
+PLAYBACK_COOKIE_CACHE_MAX_ENTRIES = 256
+playback_cookies = {}
+
+# Renditions packaged by PackageVideoFunction are stored under hls/<key without extension>/
+HLS_PREFIX = 'hls/'
+
+# Serialized list responses reused across warm invocations while the catalog is unchanged
+LIST_CACHE_MAX_ENTRIES = int(os.environ.get('LIST_CACHE_MAX_ENTRIES', '64'))
+LIST_CACHE_MAX_BYTES = int(os.environ.get('LIST_CACHE_MAX_BYTES', str(8 * 1024 * 1024)))
+LIST_CACHE_TTL_SECONDS = int(os.environ.get('LIST_CACHE_TTL_SECONDS', '300'))
+
+class ResponseCache:
+    """LRU cache of response bodies bounded by entry count, total size and age"""
+
+    def __init__(self, max_entries, max_bytes, ttl_seconds):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        stored_at, body = entry
+        if time.monotonic() - stored_at > self.ttl_seconds:
+            self.discard(key)
+            return None
+        self.entries.move_to_end(key)
+        return body
+
+    def put(self, key, body):
+        if len(body) > self.max_bytes:
+            return
+        self.discard(key)
+        self.entries[key] = (time.monotonic(), body)
+        self.size += len(body)
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            oldest = next(iter(self.entries))
+            self.discard(oldest)
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+list_cache = ResponseCache(LIST_CACHE_MAX_ENTRIES, LIST_CACHE_MAX_BYTES, LIST_CACHE_TTL_SECONDS)
+
+@logger.invocation
 def handler(event, context):
-    print("=== Lambda Execution Started ===")
-    print(f"Event received: {json.dumps(event, indent=2)}")
-    print(f"Function name: {context.function_name}")
-    print(f"Memory limit: {context.memory_limit_in_mb}MB")
-    
-    # Get the HTTP method from the event
-    http_method = event.get('httpMethod', '')
-    print(f"HTTP Method: {http_method}")
-    print(f"Query Parameters: {json.dumps(event.get('queryStringParameters'), indent=2)}")
-    
-    action = event.get("queryStringParameters", {}).get("action")
-    print(f"Requested action: {action}")
+    logger.debug("Event received", event=event)
 
-    try:
-        if action == "list":
-            return list_files()
-        elif action == 'get_download_url':
-            return generate_download_url(event)
-        elif action == 'get_upload_url':
-            return generate_upload_url(event)
-        else:
-            print(f"Invalid action requested: {action}")
-            return {
-                'statusCode': 400,
-                'headers': {
-                    'Access-Control-Allow-Origin': '*',
-                    'Content-Type': 'application/json'
-                },
-                'body': json.dumps({'error': 'Invalid action'})
-            }
-    finally:
-        print("\n=== Lambda Execution Completed ===")
-        print(f"Remaining time: {context.get_remaining_time_in_millis()}ms")
+    action = (event.get("queryStringParameters") or {}).get("action")
+    logger.info("Request received", action=action, httpMethod=event.get('httpMethod', ''))
+
+    if action == "list":
+        return list_files(event)
+    elif action == 'get_download_url':
+        return generate_download_url(event)
+    elif action == 'get_upload_url':
+        return generate_upload_url(event)
+    elif action in BATCH_URL_OPERATIONS:
+        return generate_batch_urls(event, action)
+    elif action == 'get_playback_cookies':
+        return generate_playback_cookies(event)
+    elif action == 'create_multipart_upload':
+        return create_multipart_upload(event)
+    elif action == 'get_upload_part_urls':
+        return generate_upload_part_urls(event)
+    elif action == 'list_upload_parts':
+        return list_upload_parts(event)
+    elif action == 'complete_multipart_upload':
+        return complete_multipart_upload(event)
+    elif action == 'abort_multipart_upload':
+        return abort_multipart_upload(event)
+    else:
+        logger.warning("Invalid action requested", action=action)
+        return {
+            'statusCode': 400,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Content-Type': 'application/json'
+            },
+            'body': json.dumps({'error': 'Invalid action'})
+        }
 
-def list_files():
-    print("\n=== Listing Files from DynamoDB ===")
+def list_files(event):
     table_name = os.environ.get('TABLE_NAME')
     if not table_name:
-        print("Error: TABLE_NAME environment variable not set")
+        logger.error("TABLE_NAME environment variable not set")
         return {
             "statusCode": 500,
             "body": json.dumps({"error": "Server configuration error"}),
@@ -55,52 +157,84 @@ def list_files():
                 "Access-Control-Allow-Origin": "*"
             }
         }
-    
-    print(f"Table name: {table_name}")
-    
+
+    params = event.get('queryStringParameters') or {}
+    prefixes = allowed_prefixes(event)
     try:
-        print("Querying DynamoDB for video list...")
-        response = dynamodb.get_item(
-            TableName=table_name,
-            Key={
-                'videoList': {'S': 'all_videos'},
-                'Date': {'S': 'current'}
+        query_params = build_list_query(table_name, params, prefixes)
+    except ValueError as e:
+        logger.warning("Invalid list parameters", errorMessage=str(e))
+        return {
+            "statusCode": 400,
+            "body": json.dumps({"error": "Invalid list parameters"}),
+            "headers": {
+                "Content-Type": "application/json",
+                "Access-Control-Allow-Origin": "*"
             }
-        )
-        
-        if 'Item' not in response:
-            print("No video list found in DynamoDB")
+        }
+    
+    try:
+        with stage('CatalogVersion'):
+            meta = dynamodb.get_item(
+                TableName=table_name,
+                Key=CATALOG_META_KEY,
+                ProjectionExpression='catalogVersion, lastUpdated'
+            )
+
+        if 'Item' not in meta:
+            # Catalog not migrated yet to one item per video
+            return list_legacy_files(table_name, prefixes)
+
+        # Every catalog update bumps catalogVersion, invalidating the cached pages
+        catalog_version = meta['Item'].get('catalogVersion', {}).get('N', '0')
+        last_updated = meta['Item'].get('lastUpdated', {}).get('S')
+        # Pages of callers limited to different prefixes hold different videos
+        cache_key = (catalog_version, tuple(prefixes), json.dumps(query_params, sort_keys=True))
+        etag = list_etag(cache_key)
+
+        if etag_matches(event, etag):
+            logger.info("List unchanged since the catalog version, returning 304", catalogVersion=catalog_version)
             return {
-                "statusCode": 200,
-                "body": json.dumps({"files": []}),
+                "statusCode": 304,
+                "body": "",
                 "headers": {
-                    "Content-Type": "application/json",
+                    "ETag": etag,
                     "Access-Control-Allow-Origin": "*"
                 }
             }
-        
-        # Parse the JSON string from DynamoDB
-        videos_json = response['Item']['videos']['S']
-        videos = json.loads(videos_json)
-        
-        print(f"Found {len(videos)} videos in DynamoDB")
-        print(f"Videos: {json.dumps(videos, indent=2)}")
+
+        body = list_cache.get(cache_key)
+        record('ListCache', 'Hits', int(body is not None))
+
+        if body is not None:
+            logger.info("Serving cached list page", catalogVersion=catalog_version)
+        else:
+            with stage('QueryCatalog') as query:
+                page = dynamodb.query(**query_params)
+                query.count('Items', len(page.get('Items', [])))
+            videos = [item_to_video(item) for item in page.get('Items', [])]
+            logger.info("Listed videos from DynamoDB", videos=len(videos), catalogVersion=catalog_version)
+
+            with stage('SerializeList') as serialize:
+                body = json.dumps({
+                    "files": videos,
+                    "lastUpdated": last_updated,
+                    "nextCursor": encode_cursor(page.get('LastEvaluatedKey'))
+                })
+                serialize.count('PayloadBytes', len(body))
+            list_cache.put(cache_key, body)
 
         return {
             "statusCode": 200,
-            "body": json.dumps({
-                "files": videos,
-                "lastUpdated": response['Item']['lastUpdated']['S']
-            }),
+            "body": body,
             "headers": {
                 "Content-Type": "application/json",
+                "ETag": etag,
                 "Access-Control-Allow-Origin": "*"
             }
         }
     except Exception as e:
-        print(f"\n=== Error in list_files ===")
-        print(f"Error type: {type(e).__name__}")
-        print(f"Error message: {str(e)}")
+        logger.exception("Error listing the videos", e)
         return {
             "statusCode": 500,
             "body": json.dumps({"error": "Failed to retrieve video list"}),
@@ -110,12 +244,196 @@ def list_files():
             }
         }
 
-def generate_upload_url(event):
-    print("\n=== Generating Upload URL ===")
-    print(f"Event parameters: {json.dumps(event.get('queryStringParameters'), indent=2)}")
+def list_etag(cache_key):
+    """Strong ETag of a list page, derived from the catalog version and the query"""
+    digest = hashlib.sha256(json.dumps(cache_key).encode('utf-8')).hexdigest()
+    return f'"{digest[:32]}"'
+
+def etag_matches(event, etag):
+    """Whether the If-None-Match header of the request matches the given ETag"""
+    if_none_match = (event.get('headers') or {}).get('If-None-Match')
+    if not if_none_match:
+        return False
+    # If-None-Match uses the weak comparison, W/ prefixes are ignored
+    candidates = [candidate.strip() for candidate in if_none_match.split(',')]
+    return any(
+        candidate == '*' or candidate.removeprefix('W/') == etag
+        for candidate in candidates
+    )
+
+def parse_limit(value):
+    """Page size requested through the limit parameter"""
+    # Mapping templates send an empty string for missing parameters
+    if not value:
+        return DEFAULT_PAGE_SIZE
+    limit = int(value)
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    return limit
+
+def parse_date(value):
+    """Normalize an ISO 8601 date or timestamp to the format of the stored upload dates"""
+    if not value:
+        return None
+    parsed = datetime.fromisoformat(value)
+    if 'T' not in value:
+        # Plain dates are compared as prefixes of the stored timestamps
+        return parsed.date().isoformat()
+    if parsed.tzinfo is None:
+        raise ValueError(f"timestamp without timezone: {value}")
+    return parsed.astimezone(timezone.utc).replace(microsecond=0).isoformat()
+
+def parse_size(value):
+    """Size in bytes used to filter the listing"""
+    if not value:
+        return None
+    size = int(value)
+    if size < 0:
+        raise ValueError("sizes must not be negative")
+    return size
+
+def build_list_query(table_name, params, allowed=()):
+    """Build the catalog query for action=list.
+
+    prefix lists the videos directly inside a folder through the byFolder index,
+    from/to bound the upload date (both inclusive, plain dates cover the whole day)
+    in the key condition, and minSize/maxSize filter by size in DynamoDB.
+    allowed are the key prefixes granted to the caller, other videos are
+    filtered out in DynamoDB.
+    """
+    prefix = params.get('prefix')
+    if prefix:
+        index_name = FOLDER_INDEX
+        partition = prefix.strip('/') or ROOT_FOLDER
+    else:
+        index_name = UPLOAD_DATE_INDEX
+        partition = CATALOG_PARTITION
+
+    # 'catalog' and 'size' are DynamoDB reserved words
+    names = {'#partition': INDEX_KEYS[index_name][0]}
+    values = {':partition': {'S': partition}}
+    key_condition = '#partition = :partition'
+
+    date_from = parse_date(params.get('from'))
+    date_to = parse_date(params.get('to'))
+    if date_to:
+        # '~' sorts after every character of a timestamp, keeping 'to' inclusive
+        values[':to'] = {'S': date_to + '~'}
+    if date_from:
+        values[':from'] = {'S': date_from}
+    if date_from and date_to:
+        key_condition += ' AND uploadDate BETWEEN :from AND :to'
+    elif date_from:
+        key_condition += ' AND uploadDate >= :from'
+    elif date_to:
+        key_condition += ' AND uploadDate <= :to'
+
+    query_params = {
+        'TableName': table_name,
+        'IndexName': index_name,
+        'KeyConditionExpression': key_condition,
+        'ScanIndexForward': False,  # Newest uploads first
+        'Limit': parse_limit(params.get('limit'))
+    }
+
+    filters = []
+    min_size = parse_size(params.get('minSize'))
+    max_size = parse_size(params.get('maxSize'))
+    if min_size is not None:
+        filters.append('#size >= :minSize')
+        values[':minSize'] = {'N': str(min_size)}
+    if max_size is not None:
+        filters.append('#size <= :maxSize')
+        values[':maxSize'] = {'N': str(max_size)}
+    if min_size is not None or max_size is not None:
+        names['#size'] = 'size'
+
+    # A folder inside an allowed prefix needs no filter
+    folder_allowed = index_name == FOLDER_INDEX and partition != ROOT_FOLDER \
+        and f"{partition}/".startswith(tuple(allowed))
+    if allowed and not folder_allowed:
+        filters.append('(' + ' OR '.join(
+            f"begins_with(fileName, :allowed{i})" for i in range(len(allowed))
+        ) + ')')
+        values.update({f":allowed{i}": {'S': prefix} for i, prefix in enumerate(allowed)})
+
+    if filters:
+        # Filtered pages may hold fewer than limit videos, nextCursor tells if more remain
+        query_params['FilterExpression'] = ' AND '.join(filters)
+
+    query_params['ExpressionAttributeNames'] = names
+    query_params['ExpressionAttributeValues'] = values
+
+    start_key = decode_cursor(params.get('cursor'), index_name)
+    if start_key:
+        query_params['ExclusiveStartKey'] = start_key
+    return query_params
+
+def cursor_attributes(index_name):
+    """Attributes making up the LastEvaluatedKey of a query on the given index"""
+    return ('videoList', 'Date') + INDEX_KEYS[index_name]
+
+def encode_cursor(last_evaluated_key):
+    """Opaque cursor for the page following last_evaluated_key, or None on the last page"""
+    if not last_evaluated_key:
+        return None
+    values = {name: value['S'] for name, value in last_evaluated_key.items()}
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor, index_name):
+    """ExclusiveStartKey encoded in a cursor returned by encode_cursor"""
+    if not cursor:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (UnicodeError, ValueError) as e:
+        raise ValueError(f"malformed cursor: {str(e)}")
+    if not isinstance(values, dict) or set(values) != set(cursor_attributes(index_name)) \
+            or not all(isinstance(value, str) for value in values.values()):
+        raise ValueError("cursor does not match the list query")
+    return {name: {'S': value} for name, value in values.items()}
+
+def list_legacy_files(table_name, allowed=()):
+    """List the videos stored in the legacy single item video list"""
+    response = dynamodb.get_item(
+        TableName=table_name,
+        Key=LEGACY_CATALOG_KEY
+    )
     
+    if 'Item' not in response:
+        logger.info("No video list found in DynamoDB")
+        return {
+            "statusCode": 200,
+            "body": json.dumps({"files": []}),
+            "headers": {
+                "Content-Type": "application/json",
+                "Access-Control-Allow-Origin": "*"
+            }
+        }
+    
+    # Parse the JSON string from DynamoDB
+    videos_json = response['Item']['videos']['S']
+    videos = [
+        video for video in json.loads(videos_json)
+        if not allowed or video.get('fileName', '').startswith(tuple(allowed))
+    ]
+    logger.info("Listed videos from the legacy video list", videos=len(videos))
+
+    return {
+        "statusCode": 200,
+        "body": json.dumps({
+            "files": videos,
+            "lastUpdated": response['Item']['lastUpdated']['S']
+        }),
+        "headers": {
+            "Content-Type": "application/json",
+            "Access-Control-Allow-Origin": "*"
+        }
+    }
+
+def generate_upload_url(event):
     if not event.get('queryStringParameters'):
-        print("Error: Missing query parameters")
+        logger.warning("Missing query parameters")
         return {
             'statusCode': 400,
             'headers': {
@@ -127,7 +445,7 @@ def generate_upload_url(event):
 
     key = event['queryStringParameters'].get('key')
     if not key:
-        print("Error: Missing key parameter")
+        logger.warning("Missing key parameter")
         return {
             'statusCode': 400,
             'headers': {
@@ -139,7 +457,7 @@ def generate_upload_url(event):
 
     # Validate key to prevent path traversal and ensure it's a valid filename
     if '..' in key or key.startswith('/') or not key.strip():
-        print(f"Error: Invalid key parameter: {key}")
+        logger.warning("Invalid key parameter", key=key)
         return {
             'statusCode': 400,
             'headers': {
@@ -149,9 +467,13 @@ def generate_upload_url(event):
             'body': json.dumps({'error': 'Invalid key parameter'})
         }
 
+    if not key_allowed(event, key):
+        logger.warning("Key outside of the allowed prefixes", key=key)
+        return json_response(403, {'error': 'Key not allowed'})
+
     bucket_name = os.environ.get('BUCKET_NAME')
     if not bucket_name:
-        print("Error: BUCKET_NAME environment variable not set")
+        logger.error("BUCKET_NAME environment variable not set")
         return {
             'statusCode': 500,
             'headers': {
@@ -161,20 +483,18 @@ def generate_upload_url(event):
             'body': json.dumps({'error': 'Server configuration error'})
         }
 
-    print(f"Generating presigned URL for bucket: {bucket_name}, key: {key}")
-
     try:
-        url = s3_client.generate_presigned_url(
-            'put_object',
-            Params={
-                'Bucket': bucket_name,
-                'Key': key,
-                'ContentType': 'video/mp4'
-            },
-            ExpiresIn=3600
-        )
-        
-        print("Successfully generated upload URL")
+        with stage('SignUrl'):
+            url = presigned_urls.generate_presigned_url(
+                'put_object',
+                Params={
+                    'Bucket': bucket_name,
+                    'Key': key,
+                    'ContentType': 'video/mp4'
+                },
+                ExpiresIn=3600
+            )
+        logger.info("Generated upload URL", key=key)
         return {
             'statusCode': 200,
             'headers': {
@@ -185,9 +505,7 @@ def generate_upload_url(event):
         }
 
     except ClientError as e:
-        print(f"\n=== Error generating upload URL ===")
-        print(f"Error type: {type(e).__name__}")
-        print(f"Error message: {str(e)}")
+        logger.exception("Error generating upload URL", e, key=key)
         return {
             'statusCode': 500,
             'headers': {
@@ -198,9 +516,6 @@ def generate_upload_url(event):
         }
 
 def generate_download_url(event):
-    print("\n=== Generating Download URL ===")
-    print(f"Event parameters: {json.dumps(event.get('queryStringParameters'), indent=2)}")
-    
     if not event.get('queryStringParameters'):
         return {
             'statusCode': 400,
@@ -224,7 +539,7 @@ def generate_download_url(event):
 
     # Validate key to prevent path traversal and ensure it's a valid filename
     if '..' in key or key.startswith('/') or not key.strip():
-        print(f"Error: Invalid key parameter: {key}")
+        logger.warning("Invalid key parameter", key=key)
         return {
             'statusCode': 400,
             'headers': {
@@ -234,9 +549,13 @@ def generate_download_url(event):
             'body': json.dumps({'error': 'Invalid key parameter'})
         }
 
+    if not key_allowed(event, key):
+        logger.warning("Key outside of the allowed prefixes", key=key)
+        return json_response(403, {'error': 'Key not allowed'})
+
     bucket_name = os.environ.get('BUCKET_NAME')
     if not bucket_name:
-        print("Error: BUCKET_NAME environment variable not set")
+        logger.error("BUCKET_NAME environment variable not set")
         return {
             'statusCode': 500,
             'headers': {
@@ -246,15 +565,14 @@ def generate_download_url(event):
             'body': json.dumps({'error': 'Server configuration error'})
         }
 
-    print('Bucket name:', bucket_name)
-
     try:
-        url = s3_client.generate_presigned_url(
-            'get_object',
-            Params={'Bucket': bucket_name, 'Key': key},
-            ExpiresIn=300
-        )
-        
+        with stage('SignUrl'):
+            url = presigned_urls.generate_presigned_url(
+                'get_object',
+                Params={'Bucket': bucket_name, 'Key': key},
+                ExpiresIn=300
+            )
+        logger.info("Generated download URL", key=key)
         return {
             'statusCode': 200,
             'headers': {
@@ -265,7 +583,7 @@ def generate_download_url(event):
         }
 
     except ClientError as e:
-        print('Error generating download URL:', e)
+        logger.exception("Error generating download URL", e, key=key)
         return {
             'statusCode': 500,
             'headers': {
@@ -273,4 +591,319 @@ def generate_download_url(event):
                 'Content-Type': 'application/json'
             },
             'body': json.dumps({'error': 'Failed to generate download URL'})
-        }
\ No newline at end of file
+        }
+
+def validate_key(key):
+    """Return why a key can't be signed, or None when it is valid"""
+    if key is None or key == '':
+        return 'Missing key parameter'
+    # Prevent path traversal and ensure it's a valid filename
+    if not isinstance(key, str) or '..' in key or key.startswith('/') or not key.strip():
+        return 'Invalid key parameter'
+    return None
+
+def allowed_prefixes(event):
+    """Key prefixes granted by the authorizer, empty when every key is allowed"""
+    return sorted({
+        prefix for prefix in ((event.get('authorizer') or {}).get('prefixes') or '').split(',')
+        if prefix
+    })
+
+def key_allowed(event, key):
+    """Whether the key is inside the prefixes granted by the authorizer (all keys when none)"""
+    prefixes = allowed_prefixes(event)
+    return not prefixes or key.startswith(tuple(prefixes))
+
+def json_response(status_code, payload):
+    """API response with a JSON body and the CORS header"""
+    return {
+        'statusCode': status_code,
+        'headers': {
+            'Access-Control-Allow-Origin': '*',
+            'Content-Type': 'application/json'
+        },
+        'body': json.dumps(payload)
+    }
+
+def generate_batch_urls(event, action):
+    """Sign one URL per key of the request body, reporting invalid keys individually"""
+    body = event.get('body')
+    keys = body.get('keys') if isinstance(body, dict) else None
+
+    if not isinstance(keys, list) or not keys:
+        logger.warning("Missing keys in request body")
+        return json_response(400, {'error': 'Missing keys in request body'})
+
+    if len(keys) > MAX_BATCH_KEYS:
+        logger.warning("Too many keys requested", keys=len(keys), maximum=MAX_BATCH_KEYS)
+        return json_response(400, {'error': f'At most {MAX_BATCH_KEYS} keys per request'})
+
+    bucket_name = os.environ.get('BUCKET_NAME')
+    if not bucket_name:
+        logger.error("BUCKET_NAME environment variable not set")
+        return json_response(500, {'error': 'Server configuration error'})
+
+    client_method, extra_params, expires_in = BATCH_URL_OPERATIONS[action]
+    results = []
+    with stage('SignUrls') as signing:
+        for key in keys:
+            error = validate_key(key)
+            if error:
+                results.append({'key': key, 'error': error})
+                continue
+            if not key_allowed(event, key):
+                results.append({'key': key, 'error': 'Key not allowed'})
+                continue
+            try:
+                url = presigned_urls.generate_presigned_url(
+                    client_method,
+                    Params={'Bucket': bucket_name, 'Key': key, **extra_params},
+                    ExpiresIn=expires_in
+                )
+                results.append({'key': key, 'url': url})
+            except ClientError as e:
+                logger.warning("Error signing a key", key=key, errorMessage=str(e))
+                results.append({'key': key, 'error': 'Failed to generate URL'})
+        signing.count('Items', sum('url' in result for result in results))
+
+    logger.info("Signed batch URLs", action=action, keys=len(results),
+                signed=sum('url' in result for result in results))
+    return json_response(200, {'urls': results})
+
+def parse_multipart_request(event, with_upload_id=True):
+    """Validate the JSON body of a multipart action.
+
+    Returns the S3 parameters identifying the upload and the request body,
+    or an error response as third value.
+    """
+    body = event.get('body')
+    if not isinstance(body, dict):
+        logger.warning("Missing request body")
+        return None, None, json_response(400, {'error': 'Missing request body'})
+
+    error = validate_key(body.get('key'))
+    if error:
+        logger.warning(error, key=body.get('key'))
+        return None, None, json_response(400, {'error': error})
+
+    if not key_allowed(event, body['key']):
+        logger.warning("Key outside of the allowed prefixes", key=body['key'])
+        return None, None, json_response(403, {'error': 'Key not allowed'})
+
+    bucket_name = os.environ.get('BUCKET_NAME')
+    if not bucket_name:
+        logger.error("BUCKET_NAME environment variable not set")
+        return None, None, json_response(500, {'error': 'Server configuration error'})
+
+    params = {'Bucket': bucket_name, 'Key': body['key']}
+    if with_upload_id:
+        upload_id = body.get('uploadId')
+        if not isinstance(upload_id, str) or not upload_id:
+            logger.warning("Missing uploadId")
+            return None, None, json_response(400, {'error': 'Missing uploadId'})
+        params['UploadId'] = upload_id
+
+    return params, body, None
+
+def valid_part_number(part_number):
+    """Part numbers are integers from 1 to MAX_PART_NUMBER"""
+    return isinstance(part_number, int) and not isinstance(part_number, bool) \
+        and 1 <= part_number <= MAX_PART_NUMBER
+
+def multipart_error_response(action, error):
+    """Map an S3 error of a multipart action to a 400 or 500 response"""
+    code = error.response.get('Error', {}).get('Code', '')
+    logger.exception("Multipart action failed", error, action=action, errorCode=code)
+    if code in MULTIPART_CLIENT_ERRORS:
+        return json_response(400, {'error': code})
+    return json_response(500, {'error': f'Failed to {action.replace("_", " ")}'})
+
+def create_multipart_upload(event):
+    """Start a multipart upload, the client then asks for part URLs with its uploadId"""
+    params, _, error_response = parse_multipart_request(event, with_upload_id=False)
+    if error_response:
+        return error_response
+
+    try:
+        response = s3_client.create_multipart_upload(**params, ContentType='video/mp4')
+    except ClientError as e:
+        return multipart_error_response('create_multipart_upload', e)
+
+    logger.info("Multipart upload created", key=params['Key'], uploadId=response['UploadId'])
+    return json_response(200, {'key': params['Key'], 'uploadId': response['UploadId']})
+
+def generate_upload_part_urls(event):
+    """Sign upload_part URLs for the requested part numbers so parts upload in parallel"""
+    params, body, error_response = parse_multipart_request(event)
+    if error_response:
+        return error_response
+
+    part_numbers = body.get('partNumbers')
+    if not isinstance(part_numbers, list) or not part_numbers \
+            or not all(valid_part_number(part_number) for part_number in part_numbers):
+        logger.warning("Invalid partNumbers", partNumbers=part_numbers)
+        return json_response(400, {'error': f'partNumbers must list part numbers from 1 to {MAX_PART_NUMBER}'})
+
+    if len(part_numbers) > MAX_PART_URLS:
+        logger.warning("Too many part URLs requested", parts=len(part_numbers), maximum=MAX_PART_URLS)
+        return json_response(400, {'error': f'At most {MAX_PART_URLS} parts per request'})
+
+    try:
+        with stage('SignUrls') as signing:
+            signing.count('Items', len(part_numbers))
+            urls = [
+                {
+                    'partNumber': part_number,
+                    'url': presigned_urls.generate_presigned_url(
+                        'upload_part',
+                        Params={**params, 'PartNumber': part_number},
+                        ExpiresIn=PART_URL_EXPIRATION
+                    )
+                }
+                for part_number in part_numbers
+            ]
+    except ClientError as e:
+        return multipart_error_response('get_upload_part_urls', e)
+
+    return json_response(200, {'key': params['Key'], 'uploadId': params['UploadId'], 'parts': urls})
+
+def list_upload_parts(event):
+    """List the parts already uploaded, letting clients resume an interrupted upload"""
+    params, _, error_response = parse_multipart_request(event)
+    if error_response:
+        return error_response
+
+    try:
+        parts = []
+        paginator = s3_client.get_paginator('list_parts')
+        for page in paginator.paginate(**params):
+            parts.extend(
+                {'partNumber': part['PartNumber'], 'etag': part['ETag'], 'size': part['Size']}
+                for part in page.get('Parts', [])
+            )
+    except ClientError as e:
+        return multipart_error_response('list_upload_parts', e)
+
+    return json_response(200, {'key': params['Key'], 'uploadId': params['UploadId'], 'parts': parts})
+
+def complete_multipart_upload(event):
+    """Assemble the uploaded parts, given as [{"partNumber": 1, "etag": "..."}]"""
+    params, body, error_response = parse_multipart_request(event)
+    if error_response:
+        return error_response
+
+    parts = body.get('parts')
+    if not isinstance(parts, list) or not parts or not all(
+        isinstance(part, dict) and valid_part_number(part.get('partNumber'))
+        and isinstance(part.get('etag'), str) and part['etag']
+        for part in parts
+    ):
+        logger.warning("Invalid parts", parts=parts)
+        return json_response(400, {'error': 'parts must list partNumber and etag of every part'})
+
+    try:
+        s3_client.complete_multipart_upload(
+            **params,
+            MultipartUpload={'Parts': [
+                {'PartNumber': part['partNumber'], 'ETag': part['etag']}
+                for part in sorted(parts, key=lambda part: part['partNumber'])
+            ]}
+        )
+    except ClientError as e:
+        return multipart_error_response('complete_multipart_upload', e)
+
+    logger.info("Multipart upload completed", key=params['Key'], uploadId=params['UploadId'])
+    return json_response(200, {'key': params['Key']})
+
+def abort_multipart_upload(event):
+    """Abort a multipart upload, freeing the storage of its parts"""
+    params, _, error_response = parse_multipart_request(event)
+    if error_response:
+        return error_response
+
+    try:
+        s3_client.abort_multipart_upload(**params)
+    except ClientError as e:
+        return multipart_error_response('abort_multipart_upload', e)
+
+    logger.info("Multipart upload aborted", key=params['Key'], uploadId=params['UploadId'])
+    return json_response(200, {'key': params['Key']})
+
+def playback_paths(prefixes):
+    """Paths of the playback cookies of the allowed prefixes, None when they can't be scoped.
+
+    Every prefix covers its videos and their HLS renditions. Cookie paths only
+    match whole folders, so prefixes must end with '/'.
+    """
+    if not prefixes:
+        return ['/']
+    if not all(prefix.endswith('/') for prefix in prefixes):
+        return None
+    # Prefixes nested in another one are already covered by it
+    roots = [
+        prefix for prefix in prefixes
+        if not any(prefix != other and prefix.startswith(other) for other in prefixes)
+    ]
+    return [f"/{base}{prefix}" for prefix in roots for base in ('', HLS_PREFIX)]
+
+def generate_playback_cookies(event):
+    """Signed cookies giving access to the videos and playlists served by CloudFront"""
+    global playback_private_key
+
+    domain = os.environ.get('PLAYBACK_DOMAIN')
+    key_pair_id = os.environ.get('PLAYBACK_KEY_PAIR_ID')
+    secret_name = os.environ.get('PLAYBACK_PRIVATE_KEY_SECRET')
+    if not (domain and key_pair_id and secret_name):
+        logger.warning("CloudFront playback is not configured")
+        return json_response(400, {'error': 'Playback through CloudFront is not enabled'})
+
+    prefixes = allowed_prefixes(event)
+    paths = playback_paths(prefixes)
+    if paths is None:
+        logger.warning("Playback cookies can't be scoped to the allowed prefixes", prefixes=prefixes)
+        return json_response(403, {'error': 'Playback cookies need folder prefixes ending with /'})
+
+    now = time.time()
+    cache_key = tuple(prefixes)
+    cached = playback_cookies.get(cache_key)
+    if cached and cached['expires'] - now > PLAYBACK_COOKIE_TTL_SECONDS / 2:
+        return json_response(200, cached)
+
+    try:
+        if playback_private_key is None:
+            # The key is read once per container, RSA signing is the expensive part
+            pem = secrets_client.get_secret_value(SecretId=secret_name)['SecretString']
+            playback_private_key = cloudfront_cookies.parse_private_key(pem)
+    except (ClientError, ValueError, IndexError) as e:
+        logger.exception("Error loading playback private key", e)
+        return json_response(500, {'error': 'Failed to generate playback cookies'})
+
+    expires = int(now) + PLAYBACK_COOKIE_TTL_SECONDS
+    with stage('SignCookies') as signing:
+        signing.count('Items', len(paths))
+        cookie_sets = [
+            {
+                'path': path,
+                'cookies': cloudfront_cookies.signed_cookies(domain, key_pair_id, playback_private_key, expires, path)
+            }
+            for path in paths
+        ]
+    if prefixes:
+        # The library wide playlist lists videos outside of the prefixes, folders have their own
+        response = {
+            'cookieSets': cookie_sets,
+            'expires': expires,
+            'playlistUrls': [f"https://{domain}/{prefix}index.m3u" for prefix in prefixes]
+        }
+    else:
+        response = {
+            'cookies': cookie_sets[0]['cookies'],
+            'cookieSets': cookie_sets,
+            'expires': expires,
+            'playlistUrl': f"https://{domain}/playlist.m3u"
+        }
+
+    if len(playback_cookies) >= PLAYBACK_COOKIE_CACHE_MAX_ENTRIES:
+        playback_cookies.pop(next(iter(playback_cookies)))
+    playback_cookies[cache_key] = response
+    return json_response(200, response)
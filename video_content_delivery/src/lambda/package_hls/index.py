@@ -0,0 +1,202 @@
+import json
+import os
+import subprocess
+import tempfile
+from datetime import datetime
+from botocore.exceptions import ClientError
+from s3transfer.manager import TransferManager
+
+from aws_clients import lazy_client
+from catalog import CATALOG_META_KEY, video_key
+from lambda_logging import get_logger
+from lambda_metrics import stage
+
+logger = get_logger('package_hls')
+
+# Files are transferred with s3transfer, the shared clients are botocore ones
+s3_client = lazy_client('s3')
+dynamodb = lazy_client('dynamodb')
+
+# Renditions of a video are written under hls/<key without extension>/
+HLS_PREFIX = 'hls/'
+MASTER_PLAYLIST = 'master.m3u8'
+
+# Rendition ladder as height:video bitrate, renditions taller than the source are skipped
+DEFAULT_RENDITIONS = '1080:5000k,720:2800k,480:1400k,360:800k'
+AUDIO_BITRATE = '128k'
+SEGMENT_SECONDS = 6
+
+# ffmpeg and ffprobe are provided by a Lambda layer
+FFMPEG = os.environ.get('FFMPEG_PATH', '/opt/bin/ffmpeg')
+FFPROBE = os.environ.get('FFPROBE_PATH', '/opt/bin/ffprobe')
+
+CONTENT_TYPES = {
+    '.m3u8': 'application/vnd.apple.mpegurl',
+    '.ts': 'video/mp2t'
+}
+
+def parse_renditions(value):
+    """Parse 'height:bitrate,...' into [(height, bitrate)] sorted from the tallest"""
+    renditions = []
+    for entry in value.split(','):
+        height, bitrate = entry.strip().split(':')
+        renditions.append((int(height), bitrate))
+    return sorted(renditions, reverse=True)
+
+def select_renditions(renditions, source_height):
+    """Renditions not taller than the source, keeping at least the smallest one"""
+    selected = [rendition for rendition in renditions if rendition[0] <= source_height]
+    return selected or renditions[-1:]
+
+def hls_prefix(key):
+    """Prefix holding the renditions of a video"""
+    base, _ = os.path.splitext(key)
+    return f"{HLS_PREFIX}{base}/"
+
+def probe(path):
+    """Return the height of the first video stream and whether the file has audio"""
+    output = subprocess.run(
+        [FFPROBE, '-v', 'error', '-show_entries', 'stream=codec_type,height', '-of', 'json', path],
+        check=True, capture_output=True
+    ).stdout
+    streams = json.loads(output).get('streams', [])
+    video = [stream for stream in streams if stream.get('codec_type') == 'video']
+    if not video:
+        raise ValueError("No video stream found")
+    has_audio = any(stream.get('codec_type') == 'audio' for stream in streams)
+    return int(video[0]['height']), has_audio
+
+def ffmpeg_command(source, output_dir, renditions, has_audio):
+    """Single ffmpeg run encoding every rendition with aligned keyframes and a master playlist"""
+    count = len(renditions)
+    filters = [f"[0:v]split={count}" + ''.join(f"[v{i}]" for i in range(count))]
+    filters += [f"[v{i}]scale=-2:{height}[v{i}out]" for i, (height, _) in enumerate(renditions)]
+
+    command = [FFMPEG, '-hide_banner', '-loglevel', 'error', '-y', '-i', source,
+               '-filter_complex', ';'.join(filters)]
+    stream_map = []
+    for i, (height, bitrate) in enumerate(renditions):
+        command += ['-map', f"[v{i}out]", f"-c:v:{i}", 'libx264', f"-b:v:{i}", bitrate,
+                    f"-maxrate:v:{i}", bitrate, f"-bufsize:v:{i}", bitrate]
+        if has_audio:
+            command += ['-map', 'a:0', f"-c:a:{i}", 'aac', f"-b:a:{i}", AUDIO_BITRATE]
+            stream_map.append(f"v:{i},a:{i},name:{height}p")
+        else:
+            stream_map.append(f"v:{i},name:{height}p")
+
+    command += [
+        '-preset', 'veryfast',
+        # Keyframes at every segment boundary so players can switch renditions cleanly
+        '-force_key_frames', f"expr:gte(t,n_forced*{SEGMENT_SECONDS})", '-sc_threshold', '0',
+        '-f', 'hls',
+        '-hls_time', str(SEGMENT_SECONDS),
+        '-hls_playlist_type', 'vod',
+        '-hls_segment_filename', os.path.join(output_dir, '%v', 'segment_%05d.ts'),
+        '-master_pl_name', MASTER_PLAYLIST,
+        '-var_stream_map', ' '.join(stream_map),
+        os.path.join(output_dir, '%v', 'index.m3u8')
+    ]
+    return command
+
+def download_file(bucket_name, key, path):
+    with TransferManager(s3_client) as manager:
+        manager.download(bucket_name, key, path).result()
+
+def upload_directory(output_dir, bucket_name, prefix):
+    """Upload the packaged files, segments first so playlists never point to missing files"""
+    paths = []
+    for root, _, files in os.walk(output_dir):
+        paths.extend(os.path.join(root, name) for name in files)
+    segments = [path for path in paths if not path.endswith('.m3u8')]
+    playlists = [path for path in paths if path.endswith('.m3u8')]
+
+    with TransferManager(s3_client) as manager:
+        for batch in (segments, playlists):
+            uploads = []
+            for path in batch:
+                key = prefix + os.path.relpath(path, output_dir).replace(os.sep, '/')
+                content_type = CONTENT_TYPES.get(os.path.splitext(path)[1], 'application/octet-stream')
+                uploads.append(manager.upload(path, bucket_name, key, extra_args={'ContentType': content_type}))
+            for upload in uploads:
+                upload.result()
+    logger.info("Uploaded HLS files", prefix=prefix, files=len(paths))
+
+def record_renditions(table_name, key, master_key, names):
+    """Record the available renditions on the catalog item of the video"""
+    try:
+        dynamodb.update_item(
+            TableName=table_name,
+            Key=video_key(key),
+            UpdateExpression='SET hls = :hls',
+            # The video may have been removed while it was packaged, tombstones have no catalog
+            ConditionExpression='attribute_exists(#catalog)',
+            # 'catalog' is a DynamoDB reserved word
+            ExpressionAttributeNames={'#catalog': 'catalog'},
+            ExpressionAttributeValues={':hls': {'M': {
+                'master': {'S': master_key},
+                'renditions': {'L': [{'S': name} for name in names]}
+            }}}
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        logger.info("Video is no longer in the catalog", key=key)
+        return False
+
+    # Listings are cached by the catalog version, bumped by every change as ProcessVideoFunction does
+    dynamodb.update_item(
+        TableName=table_name,
+        Key=CATALOG_META_KEY,
+        UpdateExpression='SET lastUpdated = :now ADD catalogVersion :one',
+        ExpressionAttributeValues={':now': {'S': datetime.now().isoformat()}, ':one': {'N': '1'}}
+    )
+    return True
+
+@logger.invocation
+def handler(event, context):
+    """Package one uploaded MP4 into HLS renditions.
+
+    Invoked asynchronously by ProcessVideoFunction with {'bucket': ..., 'key': ...}.
+    """
+    logger.debug("Event received", event=event)
+    bucket = event.get('bucket') or os.environ.get('BUCKET_NAME')
+    key = event['key']
+    table_name = os.environ['TABLE_NAME']
+    renditions = parse_renditions(os.environ.get('HLS_RENDITIONS', DEFAULT_RENDITIONS))
+
+    # Lambda only allows writing under /tmp
+    with tempfile.TemporaryDirectory(dir=os.environ.get('HLS_WORK_DIR', '/tmp')) as work_dir:
+        source = os.path.join(work_dir, 'source.mp4')
+        with stage('Download') as download:
+            download_file(bucket, key, source)
+            download.count('PayloadBytes', os.path.getsize(source))
+
+        with stage('Probe'):
+            source_height, has_audio = probe(source)
+        selected = select_renditions(renditions, source_height)
+        logger.info("Packaging video", key=key, sourceHeight=source_height,
+                    renditions=[height for height, _ in selected])
+
+        output_dir = os.path.join(work_dir, 'hls')
+        with stage('Encode') as encode:
+            encode.count('Items', len(selected))
+            subprocess.run(ffmpeg_command(source, output_dir, selected, has_audio), check=True)
+        os.remove(source)
+
+        prefix = hls_prefix(key)
+        with stage('Upload'):
+            upload_directory(output_dir, bucket, prefix)
+
+    names = [f"{height}p" for height, _ in selected]
+    master_key = prefix + MASTER_PLAYLIST
+    recorded = record_renditions(table_name, key, master_key, names)
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps({
+            'key': key,
+            'master': master_key,
+            'renditions': names,
+            'recorded': recorded
+        })
+    }
@@ -1,21 +1,74 @@
+import heapq
 import json
 import os
-import boto3
+import time
+import random
+import posixpath
+import struct
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from datetime import datetime
+from urllib.parse import quote, unquote_plus
 
-s3_client = boto3.client('s3')
-dynamodb = boto3.client('dynamodb')
+import mp4_metadata
+import presigned_urls
+from aws_clients import lazy_client
+from catalog import (
+    CATALOG_META_KEY, CATALOG_PARTITION, FOLDER_INDEX, LEGACY_CATALOG_KEY, ROOT_FOLDER, UPLOAD_DATE_INDEX,
+    folder_of, item_to_video, video_key
+)
+from lambda_logging import get_logger
+from lambda_metrics import stage, timed, timed_pages
+
+logger = get_logger('process_video')
+
+s3_client = lazy_client('s3')
+dynamodb = lazy_client('dynamodb')
+# Only used when HLS packaging is enabled
+lambda_client = lazy_client('lambda')
+
+# Every folder gets a playlist of the videos it directly holds
+FOLDER_PLAYLIST_NAME = 'index.m3u'
+PLAYLIST_WORKERS = 8
+
+# Playlists are regenerated when the catalog changes while they are published
+PUBLISH_MAX_RETRIES = 5
+
+# The playlist is uploaded in parts of this size once it outgrows a single part,
+# bounding the memory used regardless of the library size (S3 minimum is 5 MiB)
+PLAYLIST_PART_SIZE = 8 * 1024 * 1024
+
+# Width used to compare S3 event sequencers of different lengths
+SEQUENCER_WIDTH = 64
+
+# Parallel ranged GETs reading the MP4 headers of new videos
+METADATA_WORKERS = 16
+
+# Maximum number of keys accepted by batch_get_item
+BATCH_GET_SIZE = 100
+BATCH_GET_MAX_RETRIES = 5
+
+# Removed videos leave a tombstone item, out of the indexes, until DynamoDB TTL expires it
+TOMBSTONE_TTL_SECONDS = 7 * 24 * 3600
+
+# HLS renditions of a video are stored under hls/<key without extension>/
+HLS_PREFIX = 'hls/'
+
+# Event times and LastModified of the same upload may differ slightly
+UPLOAD_DATE_TOLERANCE_SECONDS = 5
 
 def get_all_videos(bucket_name):
-    """List all MP4 files in the bucket and format them for JSON"""
-    videos = []
-    print(f"Starting to list videos from bucket: {bucket_name}")
-    
+    """Yield all MP4 files in the bucket formatted for JSON, one listing page at a time"""
+    video_count = 0
+    logger.info("Listing videos of the bucket", bucket=bucket_name)
+
     try:
         paginator = s3_client.get_paginator('list_objects_v2')
-        for page in paginator.paginate(Bucket=bucket_name):
+        pages = paginator.paginate(Bucket=bucket_name)
+        for page in timed_pages('ListObjects', pages, lambda page: page.get('Contents', [])):
             contents = page.get('Contents', [])
-            print(f"Found {len(contents)} objects in current page")
+            logger.debug("Listed a page of objects", objects=len(contents))
             
             for obj in contents:
                 if obj['Key'].lower().endswith('.mp4'):
@@ -26,133 +79,834 @@ def get_all_videos(bucket_name):
                         'uploadDate': obj['LastModified'].isoformat(),
                         'contentType': 'video/mp4'
                     }
-                    videos.append(video_info)
-                    print(f"Added video: {obj['Key']}, Size: {obj['Size']} bytes")
+                    video_count += 1
+                    yield video_info
                 
     except Exception as e:
-        print(f"Error listing objects: {str(e)}")
+        logger.exception("Error listing objects", e, bucket=bucket_name)
         raise e
     
-    print(f"Total MP4 files found: {len(videos)}")
-    return videos
+    logger.info("Listed the videos of the bucket", videos=video_count)
 
-def generate_m3u_playlist(videos, bucket_name):
-    """Generate M3U playlist from video list"""
-    print("\n=== Generating M3U Playlist ===")
-    
+def video_to_item(video_info):
+    """Convert a video entry into its DynamoDB catalog item"""
+    item = {
+        **video_key(video_info['fileName']),
+        'catalog': {'S': CATALOG_PARTITION},
+        'folder': {'S': folder_of(video_info['fileName'])},
+        'fileName': {'S': video_info['fileName']},
+        'size': {'N': str(video_info['size'])},
+        'uploadDate': {'S': video_info['uploadDate']},
+        'contentType': {'S': video_info['contentType']}
+    }
+    # Media metadata, when it could be read from the MP4 header
+    for name in ('duration', 'width', 'height'):
+        if name in video_info:
+            item[name] = {'N': str(video_info[name])}
+    if video_info.get('codecs'):
+        item['codecs'] = {'L': [{'S': codec} for codec in video_info['codecs']]}
+    if video_info.get('sequencer'):
+        # S3 event that wrote the item, later events of the key only may replace it
+        item['sequencer'] = {'S': video_info['sequencer']}
+    return item
+
+def add_media_metadata(bucket_name, video_info):
+    """Return the video with the duration, dimensions and codecs of its MP4 header"""
     try:
-        # Create M3U content
-        m3u_content = "#EXTM3U\n"
-        
-        for video in videos:
-            filename = video['fileName']
-            # Generate pre-signed URL for each video with 24h expiration
-            url = s3_client.generate_presigned_url(
-                'get_object',
-                Params={
-                    'Bucket': bucket_name,
-                    'Key': filename
-                },
-                ExpiresIn=86400  # 24 hours
+        metadata = mp4_metadata.read_metadata(s3_client, bucket_name, video_info['fileName'], video_info['size'])
+    except (ClientError, ValueError, IndexError, struct.error) as e:
+        # Videos are still cataloged, players probe them as before
+        logger.warning("No media metadata", fileName=video_info['fileName'],
+                       errorType=type(e).__name__, errorMessage=str(e))
+        return video_info
+    return {**video_info, **metadata}
+
+def with_media_metadata(bucket_name, videos):
+    """Yield the videos with their media metadata, reading METADATA_WORKERS headers at a time"""
+    videos = iter(videos)
+    with ThreadPoolExecutor(max_workers=METADATA_WORKERS) as executor:
+        while True:
+            chunk = list(islice(videos, METADATA_WORKERS * 4))
+            if not chunk:
+                return
+            with stage('ReadMetadata') as read:
+                read.count('Items', len(chunk))
+                chunk = list(executor.map(lambda video_info: add_media_metadata(bucket_name, video_info), chunk))
+            yield from chunk
+
+def unchanged_since(seen):
+    """Condition of a write applied only if the item still holds the sequencer seen when it was read"""
+    if seen is None:
+        return {'ConditionExpression': 'attribute_not_exists(sequencer)'}
+    return {
+        'ConditionExpression': 'sequencer = :seen',
+        'ExpressionAttributeValues': {':seen': {'S': seen}}
+    }
+
+def write_if_unchanged(table_name, file_name, seen, item=None):
+    """Put item, or delete the item of file_name when None, unless an event changed it since it was read.
+
+    seen is the sequencer the item held when the catalog was read, None
+    when it held none or did not exist. A put keeps it on the item so that
+    the events it already reflects are still skipped when delivered late.
+    Returns whether the write was applied.
+    """
+    try:
+        if item is None:
+            dynamodb.delete_item(TableName=table_name, Key=video_key(file_name), **unchanged_since(seen))
+        else:
+            if seen is not None and 'sequencer' not in item:
+                item = {**item, 'sequencer': {'S': seen}}
+            dynamodb.put_item(TableName=table_name, Item=item, **unchanged_since(seen))
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        logger.info("Skipping video changed by an event", fileName=file_name)
+        return False
+    return True
+
+def write_unchanged(table_name, writes):
+    """Apply (fileName, seen sequencer, item or None) writes in parallel, METADATA_WORKERS at a time.
+
+    writes may be any iterable, it is consumed one chunk at a time.
+    Returns the file names whose write was applied.
+    """
+    writes = iter(writes)
+    applied = []
+    with ThreadPoolExecutor(max_workers=METADATA_WORKERS) as executor:
+        while True:
+            chunk = list(islice(writes, METADATA_WORKERS * 4))
+            if not chunk:
+                return applied
+            with stage('ConditionalWrite') as write:
+                write.count('Items', len(chunk))
+                results = executor.map(lambda args: write_if_unchanged(table_name, *args), chunk)
+                applied += [file_name for (file_name, _, _), written in zip(chunk, results) if written]
+
+def write_videos(table_name, videos, seen=None):
+    """Store or overwrite one catalog item per video, returning the file names stored.
+
+    seen maps file names to the sequencer read from the catalog, items
+    changed by an event since then are left alone. It is looked up as the
+    videos are streamed, so it may be filled while they are produced.
+    """
+    seen = {} if seen is None else seen
+    stored = write_unchanged(table_name, (
+        (video_info['fileName'], seen.get(video_info['fileName']), video_to_item(video_info))
+        for video_info in videos
+    ))
+    logger.info("Stored videos in the catalog", videos=len(stored))
+    return stored
+
+def tombstone_item(video_info):
+    """Catalog item of a removed video, without the attributes of the indexes"""
+    item = {
+        **video_key(video_info['fileName']),
+        'fileName': {'S': video_info['fileName']},
+        'deletedAt': {'S': video_info['uploadDate']},
+        'expiresAt': {'N': str(int(time.time()) + TOMBSTONE_TTL_SECONDS)}
+    }
+    if video_info.get('sequencer'):
+        item['sequencer'] = {'S': video_info['sequencer']}
+    return item
+
+def tombstone_videos(table_name, videos, seen=None):
+    """Replace the catalog items of removed videos with tombstones, returning the file names replaced"""
+    seen = {} if seen is None else seen
+    removed = write_unchanged(table_name, (
+        (video_info['fileName'], seen.get(video_info['fileName']), tombstone_item(video_info))
+        for video_info in videos
+    ))
+    logger.info("Tombstoned removed videos in the catalog", videos=len(removed))
+    return removed
+
+def tombstone_sequencers(table_name, file_names):
+    """Sequencers of the tombstones among the catalog items of the given keys.
+
+    Rescans read them before checking the bucket: a tombstoned video still in
+    the bucket is restored with the tombstone sequencer as seen, so that only
+    a delete event processed since the read keeps it removed.
+    """
+    file_names = list(file_names)
+    tombstones = {}
+    for start in range(0, len(file_names), BATCH_GET_SIZE):
+        pending = {table_name: {
+            'Keys': [video_key(file_name) for file_name in file_names[start:start + BATCH_GET_SIZE]],
+            'ConsistentRead': True,
+            # 'catalog' is a DynamoDB reserved word
+            'ProjectionExpression': 'fileName, #sequencer, #catalog',
+            'ExpressionAttributeNames': {'#sequencer': 'sequencer', '#catalog': 'catalog'}
+        }}
+        for attempt in range(BATCH_GET_MAX_RETRIES + 1):
+            response = dynamodb.batch_get_item(RequestItems=pending)
+            for item in response['Responses'].get(table_name, []):
+                if 'catalog' not in item and 'sequencer' in item:
+                    tombstones[item['fileName']['S']] = item['sequencer']['S']
+            pending = response.get('UnprocessedKeys')
+            if not pending:
+                break
+            if attempt == BATCH_GET_MAX_RETRIES:
+                raise RuntimeError(f"Unprocessed catalog reads after {attempt + 1} attempts")
+            time.sleep(0.05 * 2 ** attempt)
+    return tombstones
+
+def put_if_newer(table_name, item):
+    """Put a catalog item unless the catalog already holds a later event of the same key"""
+    if 'sequencer' not in item:
+        dynamodb.put_item(TableName=table_name, Item=item)
+        return True
+    try:
+        dynamodb.put_item(
+            TableName=table_name,
+            Item=item,
+            # Concurrent invocations may process the events of a key out of order
+            ConditionExpression='attribute_not_exists(sequencer) OR sequencer < :sequencer',
+            ExpressionAttributeValues={':sequencer': item['sequencer']}
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        logger.info("Skipping outdated event", fileName=item['fileName']['S'])
+        return False
+    return True
+
+def apply_events(table_name, videos, to_item):
+    """Write the items of event videos in parallel, returning the videos actually written"""
+    with stage('ApplyEvents') as apply, ThreadPoolExecutor(max_workers=METADATA_WORKERS) as executor:
+        apply.count('Items', len(videos))
+        written = list(executor.map(lambda video_info: put_if_newer(table_name, to_item(video_info)), videos))
+    return [video_info for video_info, applied in zip(videos, written) if applied]
+
+def delete_videos(table_name, file_names, seen=None):
+    """Remove the catalog items of the given videos, returning the file names removed"""
+    seen = {} if seen is None else seen
+    removed = write_unchanged(table_name, ((file_name, seen.get(file_name), None) for file_name in file_names))
+    logger.info("Removed videos from the catalog", videos=len(removed))
+    return removed
+
+def query_catalog(table_name, attributes=None, folder=None):
+    """Yield the catalog items in upload date order, following the query pages.
+
+    attributes limits the returned item attributes to the given names,
+    folder limits the items to the videos directly in that folder.
+    """
+    # 'catalog' and 'size' are DynamoDB reserved words
+    if folder is None:
+        index_name, partition_name, partition = UPLOAD_DATE_INDEX, 'catalog', CATALOG_PARTITION
+    else:
+        index_name, partition_name, partition = FOLDER_INDEX, 'folder', folder
+    names = {'#partition': partition_name}
+    kwargs = {}
+    if attributes:
+        projection = {f"#p{i}": name for i, name in enumerate(attributes)}
+        names.update(projection)
+        kwargs['ProjectionExpression'] = ', '.join(projection)
+
+    paginator = dynamodb.get_paginator('query')
+    pages = paginator.paginate(
+        TableName=table_name,
+        IndexName=index_name,
+        KeyConditionExpression='#partition = :partition',
+        ExpressionAttributeNames=names,
+        ExpressionAttributeValues={':partition': {'S': partition}},
+        **kwargs
+    )
+    for page in timed_pages('QueryCatalog', pages, lambda page: page.get('Items', [])):
+        yield from page.get('Items', [])
+
+def load_catalog_meta(table_name):
+    """Return the catalog meta item, or None when the catalog has not been built yet"""
+    response = dynamodb.get_item(TableName=table_name, Key=CATALOG_META_KEY)
+    return response.get('Item')
+
+def migrate_legacy_catalog(table_name):
+    """Move the videos of the legacy single item video list to one item per video.
+
+    Returns False when there is no legacy video list that can be migrated.
+    """
+    response = dynamodb.get_item(TableName=table_name, Key=LEGACY_CATALOG_KEY)
+    if 'Item' not in response:
+        logger.info("No legacy video list found in DynamoDB")
+        return False
+
+    try:
+        videos = json.loads(response['Item']['videos']['S'])
+    except (KeyError, ValueError) as e:
+        logger.warning("Legacy video list is unreadable", errorMessage=str(e))
+        return False
+
+    logger.info("Migrating the legacy video list", videos=len(videos))
+    write_videos(table_name, videos)
+    dynamodb.delete_item(TableName=table_name, Key=LEGACY_CATALOG_KEY)
+    return True
+
+def same_upload(entry, video_info):
+    """Whether a stored (size, uploadDate) describes the listed video"""
+    size, upload_date = entry
+    if size != video_info['size']:
+        return False
+    try:
+        delta = datetime.fromisoformat(upload_date) - datetime.fromisoformat(video_info['uploadDate'])
+    except (TypeError, ValueError):
+        # Unparseable or mixed naive and aware dates, rewrite the item
+        return False
+    return abs(delta.total_seconds()) <= UPLOAD_DATE_TOLERANCE_SECONDS
+
+@timed('SyncCatalog')
+def sync_catalog(table_name, bucket_name, videos):
+    """Make the catalog match a full bucket listing, streaming the listed videos.
+
+    Only new or changed videos are written, with their media metadata, so
+    unchanged items keep the attributes set after they were cataloged (HLS
+    renditions) and their headers are not read again.
+    Returns the folders that held or hold videos, and the changes applied as
+    a mapping of file names to the video written, or None when removed.
+    """
+    stored, seen = {}, {}
+    for item in query_catalog(table_name, attributes=['fileName', 'size', 'uploadDate', 'sequencer']):
+        stored[item['fileName']['S']] = (int(item['size']['N']), item['uploadDate']['S'])
+        if 'sequencer' in item:
+            seen[item['fileName']['S']] = item['sequencer']['S']
+
+    folders = set()
+
+    def changed(videos):
+        for video_info in videos:
+            folders.add(folder_of(video_info['fileName']))
+            entry = stored.pop(video_info['fileName'], None)
+            if entry is None or not same_upload(entry, video_info):
+                yield video_info
+
+    def restorable(videos):
+        """Videos to write, tombstoned ones only when they still exist once their tombstone was read"""
+        videos = iter(videos)
+        while True:
+            chunk = list(islice(videos, BATCH_GET_SIZE))
+            if not chunk:
+                return
+            tombstones = tombstone_sequencers(
+                table_name, [video_info['fileName'] for video_info in chunk if video_info['fileName'] not in seen]
             )
-            m3u_content += f"#EXTINF:-1,{filename}\n{url}\n"
-        
-        # Upload M3U file to S3
-        playlist_key = 'playlist.m3u'
-        s3_client.put_object(
+            for video_info in chunk:
+                if video_info['fileName'] in tombstones:
+                    # Uploaded again after its delete event, the upload event was lost
+                    video_info = current_video(bucket_name, video_info['fileName'])
+                    if video_info is None:
+                        continue
+                    seen[video_info['fileName']] = tombstones[video_info['fileName']]
+                yield video_info
+
+    written = {}
+
+    def recorded(videos):
+        for video_info in videos:
+            written[video_info['fileName']] = video_info
+            yield video_info
+
+    # Events processed since the catalog was read win over the listing
+    videos = recorded(with_media_metadata(bucket_name, restorable(changed(videos))))
+    changes = {file_name: written[file_name] for file_name in write_videos(table_name, videos, seen)}
+    # Whatever the listing did not pop is no longer in the bucket
+    changes.update(dict.fromkeys(delete_videos(table_name, list(stored), seen)))
+    folders.update(folder_of(file_name) for file_name in stored)
+    # A rescan supersedes any legacy video list left behind
+    dynamodb.delete_item(TableName=table_name, Key=LEGACY_CATALOG_KEY)
+    return folders, changes
+
+def collect_records(event):
+    """Unpack the S3 records of a direct S3 notification or of an SQS batch of them.
+
+    Returns the S3 records paired with the id of the SQS message they came from
+    (None for direct S3 invocations) and the ids of the messages that could not be read.
+    """
+    records = []
+    failed_message_ids = []
+
+    for record in event.get('Records', []):
+        if record.get('eventSource') != 'aws:sqs':
+            records.append((None, record))
+            continue
+
+        message_id = record['messageId']
+        try:
+            body = json.loads(record['body'])
+        except (KeyError, ValueError) as e:
+            logger.warning("Unreadable SQS message", messageId=message_id, errorMessage=str(e))
+            failed_message_ids.append(message_id)
+            continue
+
+        # S3 sends a test message when the notification is configured
+        if body.get('Event') == 's3:TestEvent':
+            logger.info("Ignoring S3 test event", messageId=message_id)
+            continue
+
+        for s3_record in body.get('Records', []):
+            records.append((message_id, s3_record))
+
+    return records, failed_message_ids
+
+def video_from_record(record):
+    """Build a video entry from an S3 event record, matching the format of get_all_videos"""
+    s3_object = record['s3']['object']
+    # Keys in S3 event notifications are URL-encoded
+    key = unquote_plus(s3_object['key'])
+    upload_date = datetime.fromisoformat(record['eventTime']).replace(microsecond=0)
+
+    return {
+        'fileName': key,
+        'size': s3_object.get('size', 0),
+        'uploadDate': upload_date.isoformat(),
+        'contentType': 'video/mp4'
+    }
+
+def latest_videos(records):
+    """Parse the event records keeping only the latest event for each key.
+
+    S3 sequencers of the same key are ordered once right padded with zeros.
+    Returns the created videos, the removed ones and the ids of the SQS
+    messages holding bad records.
+    """
+    latest = {}
+    failed_message_ids = []
+
+    for message_id, record in records:
+        try:
+            video_info = video_from_record(record)
+            sequencer = record['s3']['object'].get('sequencer', '').ljust(SEQUENCER_WIDTH, '0')
+        except (KeyError, TypeError, ValueError) as e:
+            logger.warning("Skipping malformed record", messageId=message_id,
+                           errorType=type(e).__name__, errorMessage=str(e))
+            if message_id:
+                failed_message_ids.append(message_id)
+            continue
+
+        if not video_info['fileName'].lower().endswith('.mp4'):
+            logger.debug("Skipping non MP4 object", fileName=video_info['fileName'])
+            continue
+
+        if record['s3']['object'].get('sequencer'):
+            video_info['sequencer'] = sequencer
+        # Deletions and delete markers of versioned buckets are both ObjectRemoved events
+        removed = record.get('eventName', '').startswith('ObjectRemoved')
+        current = latest.get(video_info['fileName'])
+        if current is None or sequencer >= current[0]:
+            latest[video_info['fileName']] = (sequencer, video_info, removed)
+
+    created = [video_info for _, video_info, removed in latest.values() if not removed]
+    removed = [video_info for _, video_info, removed in latest.values() if removed]
+    return created, removed, failed_message_ids
+
+def current_video(bucket_name, file_name):
+    """Video entry of the current version of a key, or None when it no longer exists"""
+    try:
+        response = s3_client.head_object(Bucket=bucket_name, Key=file_name)
+    except ClientError as e:
+        # Also the answer for keys whose current version is a delete marker
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            return None
+        raise
+    return {
+        'fileName': file_name,
+        'size': response['ContentLength'],
+        'uploadDate': response['LastModified'].replace(microsecond=0).isoformat(),
+        'contentType': 'video/mp4'
+    }
+
+def resolve_removals(bucket_name, removed_videos):
+    """Split removed videos into those really gone and those still readable.
+
+    Deleting a specific version of a versioned object exposes the previous
+    version, and the key may have been uploaded again since the event.
+    """
+    gone = []
+    restored = []
+    for video_info in removed_videos:
+        current = current_video(bucket_name, video_info['fileName'])
+        if current is None:
+            gone.append(video_info)
+        else:
+            logger.info("Removed video still has a current version", fileName=video_info['fileName'])
+            if video_info.get('sequencer'):
+                current['sequencer'] = video_info['sequencer']
+            restored.append(current)
+    return gone, restored
+
+def delete_renditions(bucket_name, file_names):
+    """Remove the HLS renditions of removed videos, when HLS packaging is enabled"""
+    if not os.environ.get('HLS_FUNCTION_NAME'):
+        return
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for file_name in file_names:
+        prefix = f"{HLS_PREFIX}{posixpath.splitext(file_name)[0]}/"
+        # Pages hold at most 1000 keys, the limit of delete_objects
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+            objects = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+            if objects:
+                s3_client.delete_objects(Bucket=bucket_name, Delete={'Objects': objects, 'Quiet': True})
+
+def batch_failures(message_ids):
+    """Partial batch response understood by SQS event source mappings"""
+    return [{'itemIdentifier': message_id} for message_id in sorted(set(message_ids))]
+
+def is_full_rescan_requested(event):
+    """Full rescans run when asked for in the event or forced through CATALOG_MODE"""
+    if event.get('fullRescan'):
+        return True
+    return os.environ.get('CATALOG_MODE', 'incremental') == 'full'
+
+def upload_stream(bucket_name, key, chunks, content_type):
+    """Upload an iterable of byte chunks without holding the whole object in memory.
+
+    Small objects go in a single put_object, larger ones switch to a multipart
+    upload of PLAYLIST_PART_SIZE parts, aborted if anything fails.
+    """
+    buffer = bytearray()
+    upload_id = None
+    parts = []
+
+    def upload_part():
+        response = s3_client.upload_part(
             Bucket=bucket_name,
-            Key=playlist_key,
-            Body=m3u_content.encode('utf-8'),
-            ContentType='application/x-mpegurl'
+            Key=key,
+            UploadId=upload_id,
+            PartNumber=len(parts) + 1,
+            Body=bytes(buffer)
         )
-        
-        print(f"Playlist generated and uploaded as {playlist_key}")
-        return playlist_key
-        
+        parts.append({'PartNumber': len(parts) + 1, 'ETag': response['ETag']})
+        buffer.clear()
+
+    try:
+        for chunk in chunks:
+            buffer += chunk
+            if len(buffer) >= PLAYLIST_PART_SIZE:
+                if upload_id is None:
+                    upload_id = s3_client.create_multipart_upload(
+                        Bucket=bucket_name, Key=key, ContentType=content_type
+                    )['UploadId']
+                upload_part()
+
+        if upload_id is None:
+            s3_client.put_object(Bucket=bucket_name, Key=key, Body=bytes(buffer), ContentType=content_type)
+            return
+
+        if buffer:
+            upload_part()
+        s3_client.complete_multipart_upload(
+            Bucket=bucket_name,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={'Parts': parts}
+        )
+        logger.debug("Uploaded in parts", key=key, parts=len(parts))
+    except Exception:
+        if upload_id is not None:
+            s3_client.abort_multipart_upload(Bucket=bucket_name, Key=key, UploadId=upload_id)
+        raise
+
+def request_hls_packaging(bucket_name, videos):
+    """Hand the videos written to the catalog to PackageVideoFunction, when HLS packaging is enabled"""
+    function_name = os.environ.get('HLS_FUNCTION_NAME')
+    if not function_name:
+        return
+
+    for video_info in videos:
+        # Asynchronous invocations are queued and retried by Lambda
+        lambda_client.invoke(
+            FunctionName=function_name,
+            InvocationType='Event',
+            Payload=json.dumps({'bucket': bucket_name, 'key': video_info['fileName']})
+        )
+    logger.info("Requested HLS packaging", videos=len(videos))
+
+def generate_m3u_playlist(videos, bucket_name, playlist_key='playlist.m3u'):
+    """Generate M3U playlist from an iterable of videos, streaming it to S3.
+
+    Returns the playlist key and the number of videos it lists.
+    """
+    video_count = 0
+    payload_bytes = 0
+    signing_seconds = 0
+    playlist_dir = posixpath.dirname(playlist_key) or '.'
+    # Behind CloudFront, signed cookies grant access and URLs stay relative to the playlist
+    playback_domain = os.environ.get('PLAYBACK_DOMAIN')
+
+    def m3u_lines():
+        nonlocal video_count, payload_bytes, signing_seconds
+        yield b"#EXTM3U\n"
+        for video in videos:
+            filename = video['fileName']
+            if playback_domain:
+                url = quote(posixpath.relpath(filename, playlist_dir))
+            else:
+                signing_started = time.perf_counter()
+                # Generate pre-signed URL for each video with 24h expiration
+                url = presigned_urls.generate_presigned_url(
+                    'get_object',
+                    Params={
+                        'Bucket': bucket_name,
+                        'Key': filename
+                    },
+                    ExpiresIn=86400  # 24 hours
+                )
+                signing_seconds += time.perf_counter() - signing_started
+            video_count += 1
+            # -1 when the duration could not be read from the MP4 header
+            duration = round(video['duration']) if 'duration' in video else -1
+            line = f"#EXTINF:{duration},{filename}\n{url}\n".encode('utf-8')
+            payload_bytes += len(line)
+            yield line
+
+    try:
+        # Includes reading the catalog pages, timed as nested QueryCatalog stages
+        with stage('GeneratePlaylist') as generate:
+            upload_stream(bucket_name, playlist_key, m3u_lines(), 'application/x-mpegurl')
+            generate.count('Items', video_count)
+            generate.count('PayloadBytes', payload_bytes)
+            generate.count('SigningDuration', round(signing_seconds * 1000, 3))
+        logger.info("Playlist uploaded", playlistKey=playlist_key, videos=video_count)
+        return playlist_key, video_count
+
     except Exception as e:
-        print(f"Error generating playlist: {str(e)}")
+        logger.exception("Error generating playlist", e, playlistKey=playlist_key)
         raise e
 
+def folder_playlist_key(folder):
+    """Key of the playlist of a folder, stored next to its videos"""
+    if folder == ROOT_FOLDER:
+        return FOLDER_PLAYLIST_NAME
+    return f"{folder}/{FOLDER_PLAYLIST_NAME}"
+
+def with_changes(items, changes, written):
+    """Yield the videos of catalog index items in upload date order, with the changes just applied.
+
+    The indexes are only eventually consistent and may not show the changes
+    of this invocation yet: changes holds the file names written or removed,
+    written the videos written among the listed ones, in upload date order.
+    """
+    listed = (item_to_video(item) for item in items if item['fileName']['S'] not in changes)
+    return heapq.merge(listed, written, key=lambda video_info: video_info['uploadDate'])
+
+def written_videos(changes):
+    """Videos written by the given changes, in upload date order"""
+    videos = (video_info for video_info in changes.values() if video_info is not None)
+    return sorted(videos, key=lambda video_info: video_info['uploadDate'])
+
+def generate_folder_playlist(table_name, bucket_name, folder, changes=None, written=()):
+    """Rebuild the playlist of one folder from the folder index and the changes just applied"""
+    videos = with_changes(query_catalog(table_name, folder=folder), changes or {}, written)
+    playlist_key, video_count = generate_m3u_playlist(videos, bucket_name, folder_playlist_key(folder))
+    if not video_count:
+        # The folder no longer holds any video
+        s3_client.delete_object(Bucket=bucket_name, Key=playlist_key)
+        return None
+    return playlist_key
+
+def generate_folder_playlists(table_name, bucket_name, folders, changes=None):
+    """Rebuild the playlists of the given folders only, returning the keys written"""
+    changes = changes or {}
+    written = {}
+    for video_info in written_videos(changes):
+        written.setdefault(folder_of(video_info['fileName']), []).append(video_info)
+    with ThreadPoolExecutor(max_workers=PLAYLIST_WORKERS) as executor:
+        keys = executor.map(
+            lambda folder: generate_folder_playlist(table_name, bucket_name, folder, changes, written.get(folder, [])),
+            sorted(folders)
+        )
+        return [key for key in keys if key]
+
+def is_global_playlist_enabled():
+    """The library wide playlist.m3u can be turned off to only keep folder playlists"""
+    return os.environ.get('GLOBAL_PLAYLIST', 'true').lower() != 'false'
+
+def bump_catalog_version(table_name):
+    """Record a change of the catalog, returning the new catalog version"""
+    response = dynamodb.update_item(
+        TableName=table_name,
+        Key=CATALOG_META_KEY,
+        UpdateExpression='ADD catalogVersion :one',
+        ExpressionAttributeValues={':one': {'N': '1'}},
+        ReturnValues='UPDATED_NEW'
+    )
+    return response['Attributes']['catalogVersion']['N']
+
+def current_catalog_version(table_name):
+    response = dynamodb.get_item(
+        TableName=table_name,
+        Key=CATALOG_META_KEY,
+        ProjectionExpression='catalogVersion',
+        ConsistentRead=True
+    )
+    return response['Item']['catalogVersion']['N']
+
+@timed('PublishPlaylists')
+def publish_playlists(table_name, bucket_name, folders, meta_attributes=None, changes=None):
+    """Rebuild the playlists of the touched folders and the global one, then the meta item.
+
+    meta_attributes are extra string attributes stored on the meta item.
+    changes maps the file names written or removed by the caller to the video
+    written, or None when removed. The playlists are read from the catalog
+    indexes, which may not show them yet, and are merged with them.
+    Returns the folder playlist keys, the global playlist key and the number
+    of videos in the catalog (both None when the global playlist is disabled).
+
+    Every change bumps the catalogVersion of the meta item. The meta item is
+    only updated if no other change happened while the playlists were
+    generated, otherwise they may have overwritten newer ones and are
+    generated again, at most PUBLISH_MAX_RETRIES times.
+    """
+    changes = changes or {}
+    version = bump_catalog_version(table_name)
+    for attempt in range(PUBLISH_MAX_RETRIES + 1):
+        # Only the playlists of the touched folders are rebuilt
+        folder_playlists = generate_folder_playlists(table_name, bucket_name, folders, changes)
+        logger.info("Rebuilt folder playlists", playlists=len(folder_playlists))
+
+        values = {':now': {'S': datetime.now().isoformat()}, ':version': {'N': version}}
+        updates = ['lastUpdated = :now']
+        playlist_key, video_count = None, None
+        if is_global_playlist_enabled():
+            # Generate M3U playlist, streaming the catalog in upload date order
+            catalog_videos = with_changes(query_catalog(table_name), changes, written_videos(changes))
+            playlist_key, video_count = generate_m3u_playlist(catalog_videos, bucket_name)
+            values.update({':count': {'N': str(video_count)}, ':playlist': {'S': playlist_key}})
+            updates += ['videoCount = :count', 'playlistKey = :playlist']
+        for i, (name, value) in enumerate((meta_attributes or {}).items()):
+            values[f":meta{i}"] = {'S': value}
+            updates.append(f"{name} = :meta{i}")
+
+        try:
+            # Updated in place, attributes written by other functions are kept
+            response = dynamodb.update_item(
+                TableName=table_name,
+                Key=CATALOG_META_KEY,
+                UpdateExpression='SET ' + ', '.join(updates),
+                ConditionExpression='catalogVersion = :version',
+                ExpressionAttributeValues=values
+            )
+            break
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            if attempt == PUBLISH_MAX_RETRIES:
+                raise RuntimeError(f"Catalog kept changing while publishing playlists, gave up after {attempt + 1} attempts")
+        version = current_catalog_version(table_name)
+        logger.info("Catalog changed while publishing playlists, regenerating them", catalogVersion=version)
+        time.sleep(0.1 * 2 ** attempt * random.uniform(0.5, 1.5))
+
+    logger.info("Catalog published", catalogVersion=version, videos=video_count)
+    logger.debug("Catalog meta update", response=response)
+    return folder_playlists, playlist_key, video_count
+
+@logger.invocation
 def handler(event, context):
-    print("=== Lambda Execution Started ===")
-    print(f"Event received: {json.dumps(event, indent=2)}")
-    print(f"Function name: {context.function_name}")
-    print(f"Memory limit: {context.memory_limit_in_mb}MB")
-    
-    record = event['Records'][0]
-    bucket = record['s3']['bucket']['name']
-    key = record['s3']['object']['key']
-    
-    print(f"\n=== Processing Upload ===")
-    print(f"Bucket: {bucket}")
-    print(f"File: {key}")
+    logger.debug("Event received", event=event)
+
+    full_rescan = is_full_rescan_requested(event)
+    records, failed_message_ids = collect_records(event)
+    message_ids = {message_id for message_id, _ in records if message_id}
+    new_videos, removed_videos, malformed_message_ids = latest_videos(records)
+    failed_message_ids.extend(malformed_message_ids)
+
+    # Rescans invoked on demand carry no S3 record
+    bucket = os.environ.get('BUCKET_NAME')
+    for _, record in records:
+        if 'bucket' in record.get('s3', {}):
+            bucket = record['s3']['bucket']['name']
+            break
+
+    logger.info("Processing events", bucket=bucket, records=len(records),
+                created=len(new_videos), removed=len(removed_videos))
+    logger.debug("Event videos",
+                 created=lambda: [video_info['fileName'] for video_info in new_videos],
+                 removed=lambda: [video_info['fileName'] for video_info in removed_videos])
+
+    if not new_videos and not removed_videos and not full_rescan:
+        logger.info("No videos to process")
+        return {
+            'statusCode': 200,
+            'body': json.dumps({
+                'message': 'No videos to process'
+            }),
+            'batchItemFailures': batch_failures(failed_message_ids)
+        }
     
     try:
-        print("\n=== Getting Video List ===")
-        video_list = get_all_videos(bucket)
-        
-        # Generate M3U playlist
-        playlist_key = generate_m3u_playlist(video_list, bucket)
-        
         table_name = os.environ.get('TABLE_NAME')
         if not table_name:
-            print("Error: TABLE_NAME environment variable not set")
+            logger.error("TABLE_NAME environment variable not set")
             return {
                 'statusCode': 500,
                 'body': json.dumps({
                     'error': 'Server configuration error'
-                })
-            }
-        print(f"\n=== Updating DynamoDB ===")
-        print(f"Table: {table_name}")
-        print(f"Number of videos to update: {len(video_list)}")
-        
-        # Convert the video list to JSON string
-        video_list_json = json.dumps(video_list)
-        
-        response = dynamodb.put_item(
-            TableName=table_name,
-            Item={
-                'videoList': {'S': 'all_videos'},
-                'Date': {'S': 'current'},
-                'videos': {'S': video_list_json},
-                'lastUpdated': {'S': datetime.now().isoformat()},
-                'playlistKey': {'S': playlist_key}  # Add playlist key to DynamoDB
+                }),
+                'batchItemFailures': batch_failures(list(message_ids) + failed_message_ids)
             }
+
+        needs_rescan = full_rescan
+        if not full_rescan and load_catalog_meta(table_name) is None:
+            # The catalog was never built, or still uses the legacy single item layout
+            needs_rescan = not migrate_legacy_catalog(table_name)
+
+        if needs_rescan:
+            logger.info("Performing full bucket rescan")
+            touched_folders, changes = sync_catalog(table_name, bucket, get_all_videos(bucket))
+        else:
+            removed_videos, restored_videos = resolve_removals(bucket, removed_videos)
+            new_videos = list(with_media_metadata(bucket, new_videos + restored_videos))
+            new_videos = apply_events(table_name, new_videos, video_to_item)
+            logger.info("Stored videos in the catalog", videos=len(new_videos))
+            removed_videos = apply_events(table_name, removed_videos, tombstone_item)
+            logger.info("Tombstoned removed videos in the catalog", videos=len(removed_videos))
+            delete_renditions(bucket, [video_info['fileName'] for video_info in removed_videos])
+            touched_folders = {folder_of(video_info['fileName']) for video_info in new_videos + removed_videos}
+            changes = {video_info['fileName']: None for video_info in removed_videos}
+            changes.update((video_info['fileName'], video_info) for video_info in new_videos)
+        # Written items no longer carry the renditions of the content they replaced
+        request_hls_packaging(bucket, written_videos(changes))
+
+        folder_playlists, playlist_key, video_count = publish_playlists(
+            table_name, bucket, touched_folders, changes=changes
         )
         
         # Generate playlist URL
-        playlist_url = s3_client.generate_presigned_url(
-            'get_object',
-            Params={
-                'Bucket': bucket,
-                'Key': playlist_key
-            },
-            ExpiresIn=86400
-        )
-        
-        print(f"\n=== DynamoDB Update Complete ===")
-        print(f"Response: {json.dumps(response, indent=2)}")
+        if playlist_key is None:
+            playlist_url = None
+        elif os.environ.get('PLAYBACK_DOMAIN'):
+            playlist_url = f"https://{os.environ['PLAYBACK_DOMAIN']}/{playlist_key}"
+        else:
+            playlist_url = presigned_urls.generate_presigned_url(
+                'get_object',
+                Params={
+                    'Bucket': bucket,
+                    'Key': playlist_key
+                },
+                ExpiresIn=86400
+            )
         
         return {
             'statusCode': 200,
             'body': json.dumps({
-                'message': 'Successfully updated video list in DynamoDB',
-                'videoCount': len(video_list),
+                'message': 'Successfully updated video catalog in DynamoDB',
+                'videoCount': video_count,
                 'lastUpdated': datetime.now().isoformat(),
-                'videos': video_list,
+                # Sequencers are internal to the catalog
+                'videos': [
+                    {name: value for name, value in video_info.items() if name != 'sequencer'}
+                    for video_info in new_videos
+                ],
+                'removedVideos': [video_info['fileName'] for video_info in removed_videos],
+                'folderPlaylists': folder_playlists,
                 'playlistUrl': playlist_url
-            })
+            }),
+            'batchItemFailures': batch_failures(failed_message_ids)
         }
     except Exception as e:
-        print(f"\n=== Error Occurred ===")
-        print(f"Error type: {type(e).__name__}")
-        print(f"Error message: {str(e)}")
+        logger.exception("Error updating the catalog", e)
         return {
             'statusCode': 500,
             'body': json.dumps({
                 'error': str(e)
-            })
-        }
-    finally:
-        print("\n=== Lambda Execution Completed ===")
\ No newline at end of file
+            }),
+            # Every message of the batch is retried when the update fails
+            'batchItemFailures': batch_failures(list(message_ids) + failed_message_ids)
+        }
\ No newline at end of file
@@ -0,0 +1,215 @@
+"""Media metadata of an MP4 stored in S3, read with small ranged GETs.
+
+Only box headers and the few boxes holding the metadata are fetched: the
+top-level boxes are walked up to moov (skipping mdat), then mvhd and the
+sample description (stsd) of every track. Sample tables are never
+downloaded, so the cost does not depend on the size of the video.
+"""
+import struct
+
+from lambda_logging import get_logger
+
+logger = get_logger('mp4_metadata')
+
+# Minimum size of every ranged GET, covers the whole header of most files
+READ_SIZE = 64 * 1024
+
+# Bytes of the sample description read to find the codec configuration
+STSD_READ_SIZE = 4096
+
+VISUAL_SAMPLE_ENTRIES = {'avc1', 'avc3', 'hvc1', 'hev1', 'av01', 'vp08', 'vp09', 'mp4v'}
+AUDIO_SAMPLE_ENTRIES = {'mp4a', 'ac-3', 'ec-3', 'Opus', 'fLaC', 'alac'}
+
+# Offset of the child boxes within visual and audio sample entries
+VISUAL_SAMPLE_ENTRY_SIZE = 78
+AUDIO_SAMPLE_ENTRY_SIZE = 28
+
+class RangeReader:
+    """Serve reads of an S3 object from ranged GETs of at least READ_SIZE bytes"""
+
+    def __init__(self, client, bucket_name, key, size):
+        self.client = client
+        self.bucket_name = bucket_name
+        self.key = key
+        self.size = size
+        self.block_start = 0
+        self.block = b''
+        self.requests = 0
+
+    def read(self, offset, length):
+        end = min(offset + length, self.size)
+        if offset >= end:
+            raise ValueError(f"Read past the end of {self.key}")
+        if offset < self.block_start or end > self.block_start + len(self.block):
+            fetch_end = min(max(end, offset + READ_SIZE), self.size)
+            response = self.client.get_object(
+                Bucket=self.bucket_name,
+                Key=self.key,
+                Range=f"bytes={offset}-{fetch_end - 1}"
+            )
+            self.block_start, self.block = offset, response['Body'].read()
+            self.requests += 1
+        data = self.block[offset - self.block_start:end - self.block_start]
+        if len(data) < end - offset:
+            raise ValueError(f"Truncated read of {self.key}")
+        return data
+
+class BytesReader:
+    """Reader over bytes already fetched"""
+
+    def __init__(self, data):
+        self.size = len(data)
+        self.data = data
+
+    def read(self, offset, length):
+        data = self.data[offset:offset + length]
+        if not data:
+            raise ValueError("Read past the end of the box")
+        return data
+
+def boxes(reader, start, end, truncated=False):
+    """Yield (type, payload offset, end) of the boxes between start and end.
+
+    A box running past end is invalid, unless truncated tells that the
+    reader only holds the first bytes of the parent box: it is then cut at end.
+    """
+    offset = start
+    while offset + 8 <= end:
+        header = reader.read(offset, 16)
+        size, box_type = struct.unpack('>I4s', header[:8])
+        header_size = 8
+        if size == 1:
+            size = struct.unpack('>Q', header[8:16])[0]
+            header_size = 16
+        elif size == 0:
+            # The last box may extend to the end of the file
+            size = end - offset
+        if size < header_size:
+            raise ValueError(f"Invalid box size {size} at offset {offset}")
+        if offset + size > end and not truncated:
+            raise ValueError(f"Truncated {box_type.decode('latin-1')} box at offset {offset}")
+        yield box_type.decode('latin-1'), offset + header_size, min(offset + size, end)
+        offset += size
+
+def find_box(reader, start, end, *path, truncated=False):
+    """Return (payload offset, end) of the box at path, or None"""
+    for box_type in path:
+        for found_type, payload, box_end in boxes(reader, start, end, truncated):
+            if found_type == box_type:
+                start, end = payload, box_end
+                break
+        else:
+            return None
+    return start, end
+
+def parse_duration(mvhd):
+    """Duration in seconds of a movie header"""
+    if mvhd[0] == 1:
+        timescale, duration = struct.unpack('>IQ', mvhd[20:32])
+    else:
+        timescale, duration = struct.unpack('>II', mvhd[12:20])
+    if not timescale:
+        return None
+    return round(duration / timescale, 3)
+
+def read_descriptor(data, offset):
+    """Read an MPEG-4 descriptor, returning its tag, payload offset and end"""
+    tag = data[offset]
+    offset += 1
+    size = 0
+    for _ in range(4):
+        byte = data[offset]
+        offset += 1
+        size = (size << 7) | (byte & 0x7f)
+        if not byte & 0x80:
+            break
+    return tag, offset, offset + size
+
+def aac_codec(esds):
+    """RFC 6381 codec of an esds box, 'mp4a.40.2' for AAC-LC"""
+    tag, offset, end = read_descriptor(esds, 4)
+    if tag != 0x03:
+        return 'mp4a'
+    flags = esds[offset + 2]
+    offset += 3
+    if flags & 0x80:
+        offset += 2
+    if flags & 0x40:
+        offset += 1 + esds[offset]
+    if flags & 0x20:
+        offset += 2
+
+    tag, offset, end = read_descriptor(esds, offset)
+    if tag != 0x04:
+        return 'mp4a'
+    object_type = esds[offset]
+    codec = f"mp4a.{object_type:02x}"
+    if offset + 13 < end:
+        tag, offset, _ = read_descriptor(esds, offset + 13)
+        if tag == 0x05:
+            audio_object_type = esds[offset] >> 3
+            if audio_object_type == 31:
+                audio_object_type = 32 + (((esds[offset] & 0x07) << 3) | (esds[offset + 1] >> 5))
+            codec += f".{audio_object_type}"
+    return codec
+
+def parse_sample_entry(stsd):
+    """Codec and, for video tracks, dimensions of the first sample description.
+
+    stsd may only hold the first STSD_READ_SIZE bytes of the box.
+    """
+    entry = BytesReader(stsd)
+    for entry_type, payload, entry_end in boxes(entry, 8, len(stsd), truncated=True):
+        if entry_type in VISUAL_SAMPLE_ENTRIES:
+            width, height = struct.unpack('>HH', stsd[payload + 24:payload + 28])
+            codec = entry_type
+            if entry_type in ('avc1', 'avc3'):
+                avcc = find_box(entry, payload + VISUAL_SAMPLE_ENTRY_SIZE, entry_end, 'avcC', truncated=True)
+                if avcc:
+                    profile, compatibility, level = stsd[avcc[0] + 1:avcc[0] + 4]
+                    codec = f"{entry_type}.{profile:02x}{compatibility:02x}{level:02x}"
+            return codec, width, height
+        if entry_type in AUDIO_SAMPLE_ENTRIES:
+            codec = entry_type
+            if entry_type == 'mp4a':
+                esds = find_box(entry, payload + AUDIO_SAMPLE_ENTRY_SIZE, entry_end, 'esds', truncated=True)
+                if esds:
+                    codec = aac_codec(stsd[esds[0]:esds[1]])
+            return codec, None, None
+        return entry_type, None, None
+    return None, None, None
+
+def read_metadata(client, bucket_name, key, size):
+    """Return the duration (seconds), dimensions and codecs of an MP4 in S3.
+
+    Keys are left out when the file does not describe them. Raises ValueError
+    when the object is not a readable MP4.
+    """
+    reader = RangeReader(client, bucket_name, key, size)
+    moov = find_box(reader, 0, size, 'moov')
+    if moov is None:
+        raise ValueError(f"No moov box in {key}")
+
+    metadata = {}
+    codecs = []
+    for box_type, payload, box_end in boxes(reader, *moov):
+        if box_type == 'mvhd':
+            duration = parse_duration(reader.read(payload, 32))
+            if duration is not None:
+                metadata['duration'] = duration
+        elif box_type == 'trak':
+            stsd = find_box(reader, payload, box_end, 'mdia', 'minf', 'stbl', 'stsd')
+            if stsd is None:
+                continue
+            codec, width, height = parse_sample_entry(
+                reader.read(stsd[0], min(stsd[1] - stsd[0], STSD_READ_SIZE))
+            )
+            if codec:
+                codecs.append(codec)
+            if width and 'width' not in metadata:
+                metadata['width'], metadata['height'] = width, height
+
+    if codecs:
+        metadata['codecs'] = codecs
+    logger.debug("Read media metadata", key=key, rangedGets=reader.requests)
+    return metadata
@@ -0,0 +1,221 @@
+"""Reconciliation of the catalog with the S3 Inventory of the video bucket.
+
+Runs on a schedule as ReconcileCatalogFunction, sharing the catalog code of
+ProcessVideoFunction. The latest CSV inventory report is streamed and diffed
+against the catalog, and only the differences are applied. An inventory is a
+snapshot taken up to a day before its delivery, so every difference is
+checked against the live bucket with a HEAD before being written.
+"""
+import csv
+import gzip
+import io
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from itertools import islice
+from urllib.parse import unquote_plus
+from botocore.exceptions import ClientError
+
+import index
+from lambda_logging import get_logger
+from lambda_metrics import stage
+
+logger = get_logger('reconcile')
+
+# Inventory deliveries are stored under <prefix><YYYY-MM-DDTHH-MMZ>/
+DELIVERY_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2}T\d{2}-\d{2}Z/$')
+
+# Differences checked against the bucket and written together
+DIFF_CHUNK_SIZE = 1000
+
+def find_latest_manifest(bucket_name, prefix):
+    """Key of the manifest of the latest complete inventory delivery under prefix, or None"""
+    paginator = index.s3_client.get_paginator('list_objects_v2')
+    deliveries = []
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, Delimiter='/'):
+        deliveries += [
+            common['Prefix'] for common in page.get('CommonPrefixes', [])
+            if DELIVERY_PATTERN.search(common['Prefix'])
+        ]
+
+    for delivery in sorted(deliveries, reverse=True):
+        # manifest.checksum is written last, once the delivery is complete
+        try:
+            index.s3_client.head_object(Bucket=bucket_name, Key=delivery + 'manifest.checksum')
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                logger.info("Skipping incomplete inventory delivery", delivery=delivery)
+                continue
+            raise
+        return delivery + 'manifest.json'
+    return None
+
+def load_manifest(bucket_name, key):
+    response = index.s3_client.get_object(Bucket=bucket_name, Key=key)
+    return json.loads(response['Body'].read())
+
+def inventory_videos(manifest):
+    """Yield the current MP4 objects listed by an inventory, one report file at a time"""
+    if manifest.get('fileFormat', 'CSV') != 'CSV':
+        raise ValueError(f"Unsupported inventory format {manifest.get('fileFormat')}, only CSV is read")
+    fields = [field.strip() for field in manifest['fileSchema'].split(',')]
+    destination_bucket = manifest['destinationBucket'].split(':::')[-1]
+
+    for report in manifest['files']:
+        body = index.s3_client.get_object(Bucket=destination_bucket, Key=report['key'])['Body']
+        with gzip.GzipFile(fileobj=body) as stream:
+            for row in csv.reader(io.TextIOWrapper(stream, encoding='utf-8')):
+                record = dict(zip(fields, row))
+                # Present when the inventory includes every object version
+                if record.get('IsLatest', 'true') != 'true' or record.get('IsDeleteMarker') == 'true':
+                    continue
+                # Keys in inventory reports are URL-encoded
+                key = unquote_plus(record['Key'])
+                if not key.lower().endswith('.mp4'):
+                    continue
+                last_modified = datetime.fromisoformat(record['LastModifiedDate'].replace('Z', '+00:00'))
+                yield {
+                    'fileName': key,
+                    'size': int(record['Size']),
+                    'uploadDate': last_modified.replace(microsecond=0).isoformat(),
+                    'contentType': 'video/mp4'
+                }
+
+def uploaded_after(upload_date, moment):
+    """Whether a catalog upload date is later than moment, dates without zone are UTC"""
+    try:
+        date = datetime.fromisoformat(upload_date)
+    except ValueError:
+        return False
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date > moment
+
+def differences(table_name, videos, snapshot_time):
+    """Yield the keys whose catalog entry may not match the inventory videos.
+
+    Each key comes with the sequencer its catalog item held, None when it
+    held none, so that events processed since are not overwritten.
+    Catalog entries newer than the inventory snapshot are left alone, the
+    inventory could not know about them.
+
+    The inventory is streamed but the catalog is held in memory, about
+    400 bytes per cataloged video: no index orders the catalog by key for a
+    merge join with the key ordered inventory. ReconcileCatalogFunction is
+    sized for it in the stack.
+    """
+    stored = {
+        item['fileName']['S']: (int(item['size']['N']), item['uploadDate']['S'], item.get('sequencer', {}).get('S'))
+        for item in index.query_catalog(table_name, attributes=['fileName', 'size', 'uploadDate', 'sequencer'])
+    }
+    logger.info("Diffing the inventory against the catalog", catalogedVideos=len(stored))
+
+    for video_info in videos:
+        entry = stored.pop(video_info['fileName'], None)
+        if entry is None:
+            yield video_info['fileName'], None
+        elif not index.same_upload(entry[:2], video_info) and not uploaded_after(entry[1], snapshot_time):
+            yield video_info['fileName'], entry[2]
+
+    # Whatever the inventory did not pop is missing from it
+    for file_name, (_, upload_date, sequencer) in stored.items():
+        if not uploaded_after(upload_date, snapshot_time):
+            yield file_name, sequencer
+
+def apply_differences(table_name, bucket_name, differences):
+    """Bring the catalog entries of the given (key, seen sequencer) pairs in line with the bucket.
+
+    Returns the changes applied, as a mapping of file names to the video
+    written or None when removed, and the touched folders.
+    """
+    differences = iter(differences)
+    changes = {}
+    folders = set()
+    with ThreadPoolExecutor(max_workers=index.METADATA_WORKERS) as executor:
+        while True:
+            seen = dict(islice(differences, DIFF_CHUNK_SIZE))
+            if not seen:
+                return changes, folders
+            # Read before the HEADs, a video uploaded again after its delete event replaces its tombstone
+            tombstones = index.tombstone_sequencers(
+                table_name, [file_name for file_name, sequencer in seen.items() if sequencer is None]
+            )
+            seen.update(tombstones)
+
+            with stage('HeadObjects') as head:
+                head.count('Items', len(seen))
+                current = list(executor.map(lambda file_name: index.current_video(bucket_name, file_name), seen))
+            videos = [video_info for video_info in current if video_info]
+            now = datetime.now(timezone.utc).replace(microsecond=0).isoformat()
+            gone = [
+                {'fileName': file_name, 'uploadDate': now}
+                for file_name, video_info in zip(seen, current)
+                if video_info is None and file_name not in tombstones
+            ]
+
+            # Events processed since the diff win over the inventory
+            videos = {
+                video_info['fileName']: video_info for video_info in index.with_media_metadata(bucket_name, videos)
+            }
+            changes.update((file_name, videos[file_name])
+                           for file_name in index.write_videos(table_name, videos.values(), seen))
+            tombstoned = index.tombstone_videos(table_name, gone, seen)
+            changes.update(dict.fromkeys(tombstoned))
+            index.delete_renditions(bucket_name, tombstoned)
+            folders.update(index.folder_of(file_name) for file_name in seen)
+
+@logger.invocation
+def handler(event, context):
+    logger.debug("Event received", event=event)
+    table_name = os.environ['TABLE_NAME']
+    bucket = os.environ['BUCKET_NAME']
+    inventory_bucket = os.environ['INVENTORY_BUCKET']
+
+    manifest_key = event.get('manifestKey') or find_latest_manifest(inventory_bucket, os.environ['INVENTORY_PREFIX'])
+    if not manifest_key:
+        logger.info("No inventory delivered yet")
+        return {'statusCode': 200, 'body': json.dumps({'message': 'No inventory available'})}
+
+    meta = index.load_catalog_meta(table_name)
+    if meta is None:
+        # Diffing against an empty catalog would HEAD every object, the first
+        # upload builds it with a bucket listing instead
+        logger.info("The catalog has not been built yet")
+        return {'statusCode': 200, 'body': json.dumps({'message': 'Catalog not built yet'})}
+    if meta.get('reconciledManifest', {}).get('S') == manifest_key and not event.get('force'):
+        logger.info("Inventory already reconciled", manifestKey=manifest_key)
+        return {'statusCode': 200, 'body': json.dumps({'message': 'Inventory already reconciled'})}
+
+    logger.info("Reconciling the catalog with the inventory", manifestKey=manifest_key)
+    manifest = load_manifest(inventory_bucket, manifest_key)
+    snapshot_time = datetime.fromtimestamp(int(manifest['creationTimestamp']) / 1000, timezone.utc)
+    changes, folders = apply_differences(
+        table_name, bucket, differences(table_name, inventory_videos(manifest), snapshot_time)
+    )
+    removed = sum(video_info is None for video_info in changes.values())
+    written = len(changes) - removed
+    logger.info("Reconciliation applied", written=written, removed=removed)
+    # Written items no longer carry the renditions of the content they replaced
+    index.request_hls_packaging(bucket, index.written_videos(changes))
+
+    if folders:
+        index.publish_playlists(table_name, bucket, folders, {'reconciledManifest': manifest_key}, changes)
+    else:
+        index.dynamodb.update_item(
+            TableName=table_name,
+            Key=index.CATALOG_META_KEY,
+            UpdateExpression='SET reconciledManifest = :manifest',
+            ExpressionAttributeValues={':manifest': {'S': manifest_key}}
+        )
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps({
+            'message': 'Catalog reconciled with the inventory',
+            'manifestKey': manifest_key,
+            'written': written,
+            'removed': removed
+        })
+    }
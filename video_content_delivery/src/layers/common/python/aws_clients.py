@@ -0,0 +1,71 @@
+"""AWS clients shared by the modules of a function, created on first use.
+
+Clients are built from a single botocore session, boto3 is not imported
+since nothing needs its resources. A request only pays for loading the
+service models it actually uses, the download URL path of the API never
+builds the DynamoDB client for instance.
+
+When the init phase is not on the request path, for SnapStart snapshots
+and provisioned concurrency, clients are built during init instead.
+Connections are still only opened by the first request.
+"""
+import os
+import threading
+
+import botocore.session
+from botocore.config import Config
+
+# Worker pools of the functions run up to 16 concurrent requests per client
+CLIENT_CONFIG = Config(
+    max_pool_connections=int(os.environ.get('AWS_MAX_POOL_CONNECTIONS', '32')),
+    tcp_keepalive=True,
+    retries={'mode': 'standard'}
+)
+
+# Presigned URLs use SigV4 on the regional endpoint, as the presigned_urls module
+SERVICE_CONFIGS = {
+    's3': CLIENT_CONFIG.merge(Config(signature_version='s3v4', s3={'addressing_style': 'virtual'}))
+}
+
+PREINITIALIZED = os.environ.get('AWS_LAMBDA_INITIALIZATION_TYPE') in ('snap-start', 'provisioned-concurrency')
+
+session = None
+clients = {}
+# Sessions and clients are not safe to create from several threads at once
+clients_lock = threading.Lock()
+
+def shared_session():
+    """Botocore session of the clients, holding their credentials and region"""
+    global session
+    if session is None:
+        with clients_lock:
+            if session is None:
+                session = botocore.session.get_session()
+    return session
+
+def client(service_name):
+    """Shared client of a service"""
+    shared = clients.get(service_name)
+    if shared is None:
+        client_session = shared_session()
+        with clients_lock:
+            if service_name not in clients:
+                clients[service_name] = client_session.create_client(
+                    service_name, config=SERVICE_CONFIGS.get(service_name, CLIENT_CONFIG)
+                )
+            shared = clients[service_name]
+    return shared
+
+class LazyClient:
+    """Stand-in for the shared client of a service, built on first attribute access"""
+
+    def __init__(self, service_name):
+        self.service_name = service_name
+
+    def __getattr__(self, name):
+        return getattr(client(self.service_name), name)
+
+def lazy_client(service_name):
+    if PREINITIALIZED:
+        client(service_name)
+    return LazyClient(service_name)
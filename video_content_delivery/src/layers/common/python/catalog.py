@@ -0,0 +1,70 @@
+"""Layout of the video catalog table, shared by the functions reading and writing it.
+
+Every video is its own item, listed by upload date through the catalog
+wide index or the index of its folder. ProcessVideoFunction writes the
+items, PackageVideoFunction adds their HLS renditions and GenerateUrlPre
+lists them.
+"""
+
+# Every video is stored as its own item keyed by 'video#<fileName>'
+VIDEO_KEY_PREFIX = 'video#'
+
+# Item holding the catalog wide attributes (last update, playlist key, count, version)
+CATALOG_META_KEY = {
+    'videoList': {'S': 'catalog'},
+    'Date': {'S': 'meta'}
+}
+
+# Legacy item holding the full video list as a single JSON string
+LEGACY_CATALOG_KEY = {
+    'videoList': {'S': 'all_videos'},
+    'Date': {'S': 'current'}
+}
+
+# Index listing the videos by upload date, all of them share the catalog partition
+UPLOAD_DATE_INDEX = 'byUploadDate'
+CATALOG_PARTITION = 'videos'
+
+# Index listing the videos of a folder by upload date
+FOLDER_INDEX = 'byFolder'
+
+# Folder of the videos stored at the root of the bucket
+ROOT_FOLDER = '/'
+
+def video_key(file_name):
+    """Key of the catalog item of a video"""
+    return {
+        'videoList': {'S': VIDEO_KEY_PREFIX + file_name},
+        'Date': {'S': 'current'}
+    }
+
+def folder_of(file_name):
+    """Folder holding a video, indexed to list the videos of a folder"""
+    if '/' not in file_name:
+        return ROOT_FOLDER
+    return file_name.rsplit('/', 1)[0]
+
+def item_to_video(item):
+    """Convert a DynamoDB catalog item into a video entry"""
+    video_info = {
+        'fileName': item['fileName']['S'],
+        'size': int(item['size']['N']),
+        'uploadDate': item['uploadDate']['S'],
+        'contentType': item['contentType']['S']
+    }
+    # Media metadata read from the MP4 header by ProcessVideoFunction
+    if 'duration' in item:
+        video_info['duration'] = float(item['duration']['N'])
+    for name in ('width', 'height'):
+        if name in item:
+            video_info[name] = int(item[name]['N'])
+    if 'codecs' in item:
+        video_info['codecs'] = [codec['S'] for codec in item['codecs']['L']]
+    if 'hls' in item:
+        # Set by PackageVideoFunction once the renditions are available
+        hls = item['hls']['M']
+        video_info['hls'] = {
+            'master': hls['master']['S'],
+            'renditions': [rendition['S'] for rendition in hls['renditions']['L']]
+        }
+    return video_info
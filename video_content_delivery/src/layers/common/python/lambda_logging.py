@@ -0,0 +1,126 @@
+"""Structured logging shared by the Lambda functions, shipped as a Lambda layer.
+
+Every record is written as one compact JSON line. Records below LOG_LEVEL
+are dropped before their message is formatted or their fields are
+serialized, and LOG_SAMPLE_RATE turns DEBUG on for that fraction of the
+invocations. Lines of every logger go to a single buffer, written out in
+one call when the invocation ends, when a warning or an error is logged,
+when the buffer is full or when its oldest line waited BUFFER_MAX_SECONDS,
+so that the lines before a timeout or a crash are not lost.
+"""
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+LEVELS = {'DEBUG': 10, 'INFO': 20, 'WARNING': 30, 'ERROR': 40}
+
+# Lines kept before writing them out in a single call, and for how long at most
+BUFFER_MAX_LINES = 100
+BUFFER_MAX_SECONDS = float(os.environ.get('LOG_BUFFER_MAX_SECONDS', '1'))
+
+# Records of this level and above are written out at once
+FLUSH_LEVEL = LEVELS['WARNING']
+
+LOG_LEVEL = LEVELS.get(os.environ.get('LOG_LEVEL', 'INFO').upper(), LEVELS['INFO'])
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', '0'))
+
+# State of the current invocation, shared by the loggers of every module
+invocation_state = {'threshold': LOG_LEVEL, 'request_id': None}
+buffer = []
+# Monotonic time the oldest buffered line was added
+buffer_state = {'started': 0.0}
+# Handlers log from worker threads too
+buffer_lock = threading.Lock()
+loggers = {}
+# Called without arguments when an invocation ends, before the buffer is written
+invocation_end_hooks = []
+
+def start_invocation(context=None):
+    """Reset the per invocation state, sampling DEBUG records for some invocations"""
+    invocation_state['request_id'] = getattr(context, 'aws_request_id', None)
+    sampled = LOG_SAMPLE_RATE and random.random() < LOG_SAMPLE_RATE
+    invocation_state['threshold'] = LEVELS['DEBUG'] if sampled else LOG_LEVEL
+
+def emit(record):
+    """Buffer a raw JSON document, such as an embedded metric record"""
+    line = json.dumps(record, separators=(',', ':'), default=str)
+    now = time.monotonic()
+    with buffer_lock:
+        if not buffer:
+            buffer_state['started'] = now
+        buffer.append(line)
+        full = len(buffer) >= BUFFER_MAX_LINES or now - buffer_state['started'] >= BUFFER_MAX_SECONDS
+    if full:
+        flush()
+
+def flush(stream=None):
+    with buffer_lock:
+        if not buffer:
+            return
+        lines = buffer[:]
+        buffer.clear()
+    stream = stream or sys.stdout
+    stream.write('\n'.join(lines) + '\n')
+    stream.flush()
+
+class Logger:
+    def __init__(self, name):
+        self.name = name
+
+    def invocation(self, handler):
+        """Decorate a Lambda handler so its records are tagged and flushed"""
+        def wrapper(event, context):
+            start_invocation(context)
+            try:
+                return handler(event, context)
+            finally:
+                for hook in invocation_end_hooks:
+                    hook()
+                flush()
+        wrapper.__name__ = handler.__name__
+        wrapper.__doc__ = handler.__doc__
+        return wrapper
+
+    def is_enabled(self, level):
+        return LEVELS[level] >= invocation_state['threshold']
+
+    def debug(self, message, *args, **fields):
+        self.log('DEBUG', message, *args, **fields)
+
+    def info(self, message, *args, **fields):
+        self.log('INFO', message, *args, **fields)
+
+    def warning(self, message, *args, **fields):
+        self.log('WARNING', message, *args, **fields)
+
+    def error(self, message, *args, **fields):
+        self.log('ERROR', message, *args, **fields)
+
+    def exception(self, message, error, *args, **fields):
+        """Log an ERROR record describing a caught exception"""
+        self.log('ERROR', message, *args, errorType=type(error).__name__, errorMessage=str(error), **fields)
+
+    def log(self, level, message, *args, **fields):
+        """Buffer a record, message is %-formatted with args only if the level is enabled.
+
+        Callable field values are evaluated lazily as well.
+        """
+        if not self.is_enabled(level):
+            return
+        record = {'level': level, 'logger': self.name, 'message': message % args if args else message}
+        if invocation_state['request_id']:
+            record['requestId'] = invocation_state['request_id']
+        for name, value in fields.items():
+            record[name] = value() if callable(value) else value
+        emit(record)
+        if LEVELS[level] >= FLUSH_LEVEL:
+            flush()
+
+def get_logger(name):
+    """Logger of a module, records of every logger share the invocation buffer"""
+    if name not in loggers:
+        loggers[name] = Logger(name)
+    return loggers[name]
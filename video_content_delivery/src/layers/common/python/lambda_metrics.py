@@ -0,0 +1,194 @@
+"""Per-stage timings of the Lambda functions, shipped in the common layer.
+
+A stage is a named step of a handler (a DynamoDB query, an S3 listing,
+signing, serializing a response). Its duration and the values counted
+while it runs (items, payload bytes) are aggregated over the invocation
+and written as CloudWatch Embedded Metric Format records when it ends,
+through the lambda_logging buffer, so CloudWatch extracts the metrics from
+the log lines without any PutMetricData call.
+
+When the function has active X-Ray tracing, every stage is also sent to
+the X-Ray daemon as a subsegment of the function segment. Subsegments are
+plain UDP datagrams, no X-Ray SDK is needed.
+"""
+import functools
+import json
+import os
+import secrets
+import socket
+import threading
+import time
+
+import lambda_logging
+
+# Namespace of the metrics, an empty namespace turns the metric records off
+NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'VideoContentDelivery')
+
+# Values of one metric in a single record, the limit of the format
+MAX_VALUES_PER_RECORD = 100
+
+UNITS = {'Duration': 'Milliseconds', 'SigningDuration': 'Milliseconds', 'PayloadBytes': 'Bytes'}
+
+# stage name -> metric name -> values recorded during the invocation
+stage_values = {}
+values_lock = threading.Lock()
+# Stages entered by the current thread, the innermost one is the X-Ray parent
+local = threading.local()
+xray_socket = None
+
+def record(stage_name, metric, value):
+    with values_lock:
+        stage_values.setdefault(stage_name, {}).setdefault(metric, []).append(value)
+
+def metric_records(timestamp_ms):
+    """Drain the recorded values into EMF records, one per stage and 100 values"""
+    with values_lock:
+        recorded = dict(stage_values)
+        stage_values.clear()
+
+    service = os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'local')
+    for stage_name, metrics in sorted(recorded.items()):
+        longest = max(len(values) for values in metrics.values())
+        for start in range(0, longest, MAX_VALUES_PER_RECORD):
+            chunk = {
+                metric: values[start:start + MAX_VALUES_PER_RECORD]
+                for metric, values in metrics.items() if values[start:start + MAX_VALUES_PER_RECORD]
+            }
+            yield {
+                '_aws': {
+                    'Timestamp': timestamp_ms,
+                    'CloudWatchMetrics': [{
+                        'Namespace': NAMESPACE,
+                        'Dimensions': [['Service', 'Stage']],
+                        'Metrics': [
+                            {'Name': metric, 'Unit': UNITS.get(metric, 'Count')} for metric in chunk
+                        ]
+                    }]
+                },
+                'Service': service,
+                'Stage': stage_name,
+                **chunk
+            }
+
+def emit_metrics():
+    """Write the metrics of the invocation, called by lambda_logging when it ends"""
+    if not NAMESPACE:
+        with values_lock:
+            stage_values.clear()
+        return
+    for metric_record in metric_records(int(time.time() * 1000)):
+        lambda_logging.emit(metric_record)
+
+lambda_logging.invocation_end_hooks.append(emit_metrics)
+
+def trace_header():
+    """Root and parent of the current trace when it is sampled, from _X_AMZN_TRACE_ID"""
+    fields = dict(
+        part.split('=', 1) for part in os.environ.get('_X_AMZN_TRACE_ID', '').split(';') if '=' in part
+    )
+    if fields.get('Sampled') != '1' or 'Root' not in fields or 'Parent' not in fields:
+        return None
+    return fields['Root'], fields['Parent']
+
+def send_subsegment(document):
+    """Send a subsegment to the X-Ray daemon, failures never reach the handler"""
+    global xray_socket
+    address = os.environ.get('AWS_XRAY_DAEMON_ADDRESS')
+    if not address:
+        return
+    host, _, port = address.rpartition(':')
+    try:
+        if xray_socket is None:
+            xray_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        payload = '{"format":"json","version":1}\n' + json.dumps(document, separators=(',', ':'), default=str)
+        xray_socket.sendto(payload.encode('utf-8'), (host, int(port)))
+    except (OSError, ValueError):
+        pass
+
+class Stage:
+    """Time a block as a stage, with values counted while it runs.
+
+        with stage('QueryCatalog') as query:
+            page = dynamodb.query(...)
+            query.count('Items', len(page['Items']))
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.values = {}
+        # Set when the block turns out to be no stage at all
+        self.discarded = False
+
+    def count(self, metric, value):
+        """Record a value of the stage, added up when counted several times"""
+        self.values[metric] = self.values.get(metric, 0) + value
+
+    def __enter__(self):
+        self.id = secrets.token_hex(8)
+        stack = getattr(local, 'stack', None)
+        if stack is None:
+            stack = local.stack = []
+        self.parent_id = stack[-1].id if stack else None
+        stack.append(self)
+        self.start_time = time.time()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        duration = time.perf_counter() - self.started
+        local.stack.pop()
+        if self.discarded:
+            return False
+        record(self.name, 'Duration', round(duration * 1000, 3))
+        for metric, value in self.values.items():
+            record(self.name, metric, value)
+
+        trace = trace_header()
+        if trace:
+            root, parent_id = trace
+            document = {
+                'name': self.name,
+                'id': self.id,
+                'trace_id': root,
+                'parent_id': self.parent_id or parent_id,
+                'type': 'subsegment',
+                'start_time': self.start_time,
+                'end_time': self.start_time + duration
+            }
+            if self.values:
+                document['metadata'] = {'default': self.values}
+            if error is not None:
+                document['fault'] = True
+            send_subsegment(document)
+        return False
+
+def stage(name):
+    return Stage(name)
+
+def timed(name):
+    """Decorate a function so each call is timed as the stage name"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with Stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def timed_pages(name, pages, items):
+    """Yield the pages of a paginator, timing the fetch of each one as the stage name.
+
+    items(page) returns the items of a page, counted as the Items of the stage.
+    """
+    pages = iter(pages)
+    while True:
+        with Stage(name) as fetch:
+            page = next(pages, None)
+            if page is None:
+                # No request is made once the last page was read
+                fetch.discarded = True
+            else:
+                fetch.count('Items', len(items(page)))
+        if page is None:
+            return
+        yield page
@@ -0,0 +1,153 @@
+"""Presigned S3 URLs signed locally, without building a botocore request.
+
+The S3 client builds a whole request for every presigned URL (parameter
+validation, endpoint rules, event handlers), which dominates the time of
+signing a playlist or a batch of URLs. The few operations the functions
+presign are signed here directly: the canonical request is formatted from
+the parameters and the SigV4 signing key, derived from the secret key for
+a day, region and service, is cached.
+
+URLs are byte for byte those of the shared S3 client of aws_clients, which
+presigns with SigV4 on the regional virtual hosted endpoint as well.
+Anything else (other operations or parameters, bucket names that are not
+a host name label, custom, FIPS or dual-stack endpoints, regions outside
+of the aws partition) is presigned by the S3 client.
+"""
+import functools
+import hashlib
+import hmac
+import os
+import re
+import time
+from urllib.parse import quote
+
+import aws_clients
+
+ALGORITHM = 'AWS4-HMAC-SHA256'
+SERVICE = 's3'
+
+# HTTP method of the client methods signed locally
+METHODS = {'get_object': 'GET', 'put_object': 'PUT', 'upload_part': 'PUT'}
+
+# Parameters sent in the query string, in the order the S3 client writes them
+QUERY_PARAMETERS = (('UploadId', 'uploadId', str), ('PartNumber', 'partNumber', int))
+HEADER_PARAMETERS = {'ContentType': 'content-type'}
+
+HOST_BUCKET = re.compile(r'^[a-z0-9][a-z0-9-]{1,61}[a-z0-9]$')
+AWS_REGION = re.compile(r'^(us|eu|ap|sa|ca|me|af|il|mx)-\w+-\d+$')
+
+# Settings changing the endpoint of the S3 client
+ENDPOINT_VARIABLES = ('AWS_ENDPOINT_URL', 'AWS_ENDPOINT_URL_S3', 'AWS_USE_FIPS_ENDPOINT',
+                      'AWS_USE_DUALSTACK_ENDPOINT', 'AWS_S3_US_EAST_1_REGIONAL_ENDPOINT')
+
+# (secret key, date, region) -> signing key, a new one is only derived once a day
+MAX_SIGNING_KEYS = 8
+signing_keys = {}
+
+# Clock of the signatures, replaced by the tests
+current_time = time.time
+
+def signing_key(secret_key, date_stamp, region):
+    cache_key = (secret_key, date_stamp, region)
+    key = signing_keys.get(cache_key)
+    if key is None:
+        key = ('AWS4' + secret_key).encode('utf-8')
+        for part in (date_stamp, region, SERVICE, 'aws4_request'):
+            key = hmac.new(key, part.encode('utf-8'), hashlib.sha256).digest()
+        if len(signing_keys) >= MAX_SIGNING_KEYS:
+            signing_keys.clear()
+        signing_keys[cache_key] = key
+    return key
+
+def bucket_host(bucket_name, region):
+    """Virtual hosted endpoint of a bucket, us-east-1 keeps the global one"""
+    if region == 'us-east-1':
+        return f"{bucket_name}.s3.amazonaws.com"
+    return f"{bucket_name}.s3.{region}.amazonaws.com"
+
+@functools.lru_cache(maxsize=1)
+def local_region(session):
+    """Region of the S3 client of the session when its URLs can be signed locally, else None"""
+    region = session.get_config_variable('region')
+    if not region or not AWS_REGION.match(region):
+        return None
+    if any(os.environ.get(variable) for variable in ENDPOINT_VARIABLES):
+        return None
+    return region
+
+def split_params(client_method, params):
+    """Host, path, query and headers of the parameters, or None when not signed locally"""
+    params = dict(params)
+    bucket_name = params.pop('Bucket', None)
+    key = params.pop('Key', None)
+    if client_method not in METHODS or not isinstance(bucket_name, str) \
+            or not HOST_BUCKET.match(bucket_name) or not isinstance(key, str) or not key:
+        return None
+
+    query = []
+    for name, query_name, value_type in QUERY_PARAMETERS:
+        if name in params:
+            value = params.pop(name)
+            if type(value) is not value_type:
+                return None
+            query.append((query_name, str(value)))
+    headers = []
+    for name, header_name in HEADER_PARAMETERS.items():
+        if name in params:
+            value = params.pop(name)
+            if not isinstance(value, str):
+                return None
+            headers.append((header_name, ' '.join(value.split())))
+    if params:
+        return None
+    return bucket_name, '/' + quote(key, safe='/~'), query, headers
+
+def generate_presigned_url(client_method, Params, ExpiresIn=3600):
+    """Presigned URL of an S3 operation, same arguments as the client method"""
+    session = aws_clients.shared_session()
+    split = split_params(client_method, Params)
+    region = local_region(session) if split else None
+    credentials = session.get_credentials() if region else None
+    if credentials is None:
+        return aws_clients.client('s3').generate_presigned_url(
+            client_method, Params=Params, ExpiresIn=ExpiresIn
+        )
+    # Refreshes temporary credentials close to their expiration
+    frozen = credentials.get_frozen_credentials()
+
+    bucket_name, path, operation_query, headers = split
+    host = bucket_host(bucket_name, region)
+    headers = sorted(headers + [('host', host)])
+    signed_headers = ';'.join(name for name, _ in headers)
+    amz_date = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime(current_time()))
+    scope = f"{amz_date[:8]}/{region}/{SERVICE}/aws4_request"
+
+    auth_query = [
+        ('X-Amz-Algorithm', ALGORITHM),
+        ('X-Amz-Credential', f"{frozen.access_key}/{scope}"),
+        ('X-Amz-Date', amz_date),
+        ('X-Amz-Expires', str(ExpiresIn)),
+        ('X-Amz-SignedHeaders', signed_headers)
+    ]
+    if frozen.token is not None:
+        auth_query.append(('X-Amz-Security-Token', frozen.token))
+    # Parameter names need no encoding
+    query = [(name, quote(value, safe='-_.~')) for name, value in operation_query + auth_query]
+
+    canonical_request = '\n'.join([
+        METHODS[client_method],
+        path,
+        '&'.join(f"{name}={value}" for name, value in sorted(query)),
+        ''.join(f"{name}:{value}\n" for name, value in headers),
+        signed_headers,
+        'UNSIGNED-PAYLOAD'
+    ])
+    string_to_sign = '\n'.join([
+        ALGORITHM, amz_date, scope, hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()
+    ])
+    signature = hmac.new(
+        signing_key(frozen.secret_key, amz_date[:8], region), string_to_sign.encode('utf-8'), hashlib.sha256
+    ).hexdigest()
+
+    query_string = '&'.join(f"{name}={value}" for name, value in query)
+    return f"https://{host}{path}?{query_string}&X-Amz-Signature={signature}"
@@ -6,27 +6,118 @@ from aws_cdk import (
     aws_apigateway as apigateway,
     aws_logs as logs,  # Add this import
     aws_s3_notifications as s3n,  # Add this import
+    aws_sqs as sqs,
+    aws_lambda_event_sources as lambda_event_sources,
+    aws_secretsmanager as secretsmanager,
+    aws_events as events,
+    aws_events_targets as events_targets,
     RemovalPolicy,
     CfnOutput,
     Duration,
+    Size,
 )
 from constructs import Construct
 
 from video_content_delivery.lambda_construct import LambdaConstruct
 from video_content_delivery.dynamo_table import DynamoTable
 from video_content_delivery.apigateway_construct import ApiGatewayConstruct
+from video_content_delivery.cloudfront_construct import CloudFrontConstruct
+
+# ProcessVideoFunction reads the header and writes the item of every video of a
+# batch, 16 at a time, then rebuilds the playlists of the touched folders. It
+# also builds the catalog from a full listing when it does not exist yet.
+PROCESS_VIDEO_BASE_SECONDS = 60
+PROCESS_VIDEO_SECONDS_PER_EVENT = 0.25
+PROCESS_VIDEO_MEMORY_MB = 1024
+
+# The reconciliation diffs the inventory against the catalog held in memory,
+# about 400 bytes per video: 2 GB leave room for some 4 million videos
+RECONCILE_CATALOG_MEMORY_MB = 2048
+
+# SQS redelivers a message still in flight after its visibility timeout, AWS
+# recommends at least six times the timeout of the function consuming it
+VISIBILITY_TIMEOUT_FACTOR = 6
 
 class VideoContentDeliveryStack(Stack):
 
-    def __init__(self, scope: Construct, construct_id: str, **kwargs) -> None:
+    def __init__(self, scope: Construct, construct_id: str,
+                 playlist_batch_window: Duration = None,
+                 playlist_batch_size: int = 1000,
+                 playlist_max_concurrency: int = 2,
+                 authorizer_cache_ttl: Duration = Duration.minutes(1),
+                 authorizer_environment: dict = None,
+                 playback_public_key_pem: str = None,
+                 playback_private_key_secret_name: str = None,
+                 hls_ffmpeg_layer_arn: str = None,
+                 hls_renditions: str = None,
+                 global_playlist: bool = True,
+                 reconciliation_schedule: events.Schedule = events.Schedule.rate(Duration.days(1)),
+                 log_level: str = "INFO",
+                 tracing: bool = False,
+                 api_snap_start: bool = False,
+                 api_provisioned_concurrency: int = None,
+                 **kwargs) -> None:
+        """playlist_batch_window buffers upload events in SQS so that the uploads
+        received within the window trigger a single playlist regeneration.
+        The timeout of ProcessVideoFunction grows with playlist_batch_size, and
+        the visibility timeout of the queue with the timeout of the function.
+        playlist_max_concurrency bounds the concurrent batches, catalog writes
+        are conditional so it can be raised to absorb larger upload bursts.
+        authorizer_cache_ttl is how long API Gateway caches the authorizer decision
+        of a token, Duration.seconds(0) invokes the authorizer on every request.
+        The cache does not know the expiry of the token: a token stays accepted
+        for up to authorizer_cache_ttl after it expires, hence the short default.
+        authorizer_environment configures the token validation of the authorizer
+        (JWT_JWKS, JWT_SECRET, JWT_ISSUER, JWT_AUDIENCE, EXPECTED_TOKEN).
+        playback_public_key_pem serves the videos through CloudFront with signed
+        cookies, signed with the PEM private key stored in the Secrets Manager
+        secret playback_private_key_secret_name.
+        hls_ffmpeg_layer_arn packages every uploaded MP4 into HLS renditions with
+        the ffmpeg and ffprobe binaries of the layer (under /opt/bin), served by
+        the playback distribution so it requires playback_public_key_pem.
+        hls_renditions overrides the rendition ladder, as 'height:bitrate,...'.
+        Every folder gets an index.m3u playlist rebuilt when its videos change,
+        global_playlist=False stops rebuilding the library wide playlist.m3u.
+        reconciliation_schedule runs the reconciliation of the catalog with the
+        daily S3 Inventory of the bucket, None disables the inventory.
+        log_level is the lowest level of the records the functions write
+        (DEBUG, INFO, WARNING or ERROR). Every function writes the duration of
+        its stages as CloudWatch metrics, tracing=True also traces them in X-Ray.
+        api_snap_start and api_provisioned_concurrency take the init of the API
+        functions (presigned URLs and authorizer) off the request path, with
+        SnapStart or that many provisioned environments per function."""
         super().__init__(scope, construct_id, **kwargs)
 
+        if bool(playback_public_key_pem) != bool(playback_private_key_secret_name):
+            raise ValueError("playback_public_key_pem and playback_private_key_secret_name go together")
+        if hls_ffmpeg_layer_arn and not playback_public_key_pem:
+            # The renditions are only reachable through the playback distribution
+            raise ValueError("hls_ffmpeg_layer_arn requires playback_public_key_pem")
+
         # Create the DynamoDB table for storing video metadata
         table_name = "listOfVideoFiles"
         video_table = DynamoTable(self, table_name)
         print(f"Table ARN: {video_table.table.table_arn}")
         print(f"Table NAME: {video_table.table.table_name}")
 
+        inventories = None
+        if reconciliation_schedule:
+            # Daily listing of the videos, cheaper than paginating the bucket at scale
+            inventory_bucket = s3.Bucket(self, "InventoryBucket",
+                                         removal_policy=RemovalPolicy.DESTROY,
+                                         auto_delete_objects=True,
+                                         block_public_access=s3.BlockPublicAccess.BLOCK_ALL,
+                                         enforce_ssl=True,
+                                         lifecycle_rules=[s3.LifecycleRule(expiration=Duration.days(14))])
+            inventories = [s3.Inventory(
+                inventory_id="VideoCatalog",
+                destination=s3.InventoryDestination(bucket=inventory_bucket, prefix="inventory"),
+                format=s3.InventoryFormat.CSV,
+                frequency=s3.InventoryFrequency.DAILY,
+                include_object_versions=s3.InventoryObjectVersion.CURRENT,
+                optional_fields=["Size", "LastModifiedDate"]
+            )]
+
         # Create S3 bucket for video storage with proper security and CORS configuration
         bucket = s3.Bucket(self, "VideoBucket",
                            versioned=True,
@@ -43,7 +134,8 @@ class VideoContentDeliveryStack(Stack):
                                ],
                                allowed_origins=["http://localhost:3000"],
                                exposed_headers=["ETag"]
-                           )]
+                           )],
+                           inventories=inventories
                            )
         
         # Environment variables for all Lambda functions
@@ -51,7 +143,27 @@ class VideoContentDeliveryStack(Stack):
             "TABLE_NAME": table_name,
             "REGION": "eu-west-1",
             "BUCKET_NAME": bucket.bucket_name,
+            "LOG_LEVEL": log_level,
         }
+
+        # Structured logging shared by every function
+        common_layer = _lambda.LayerVersion(
+            self,
+            "CommonLayer",
+            code=_lambda.Code.from_asset("video_content_delivery/src/layers/common"),
+            compatible_runtimes=[_lambda.Runtime.PYTHON_3_12]
+        )
+
+        playback = None
+        if playback_public_key_pem:
+            # Playlists list stable relative URLs instead of presigned ones
+            playback = CloudFrontConstruct(self, "Playback", bucket=bucket,
+                                           public_key_pem=playback_public_key_pem)
+            environment_l.update({
+                "PLAYBACK_DOMAIN": playback.distribution.distribution_domain_name,
+                "PLAYBACK_KEY_PAIR_ID": playback.public_key.public_key_id,
+                "PLAYBACK_PRIVATE_KEY_SECRET": playback_private_key_secret_name,
+            })
         
         # Create Lambda function for generating presigned URLs
         get_presigned_url_function = LambdaConstruct(
@@ -62,13 +174,23 @@ class VideoContentDeliveryStack(Stack):
             function_name="GetPresignedUrlFunction",
             runtime=_lambda.Runtime.PYTHON_3_12,
             table=video_table,
-            environment=environment_l
+            environment=environment_l,
+            layers=[common_layer],
+            tracing=tracing,
+            snap_start=api_snap_start,
+            provisioned_concurrency=api_provisioned_concurrency
         )
         print(f"Lambda GetPresignedUrlFunction ARN: {get_presigned_url_function.lambda_function.function_arn}")
 
         # Grant S3 permissions to the presigned URL function
         bucket.grant_read_write(get_presigned_url_function.lambda_function)
 
+        if playback:
+            # Private key signing the playback cookies
+            secretsmanager.Secret.from_secret_name_v2(
+                self, "PlaybackPrivateKey", playback_private_key_secret_name
+            ).grant_read(get_presigned_url_function.lambda_function)
+
         # Create Lambda authorizer for API Gateway authentication
         lambda_authorizer = LambdaConstruct(
             self,
@@ -76,10 +198,51 @@ class VideoContentDeliveryStack(Stack):
             handler_file="index.handler",
             path_l="video_content_delivery/src/lambda/auth",
             function_name="apigatewayAuthorizer",
-            runtime=_lambda.Runtime.PYTHON_3_12
+            runtime=_lambda.Runtime.PYTHON_3_12,
+            environment={"LOG_LEVEL": log_level, **(authorizer_environment or {})},
+            layers=[common_layer],
+            tracing=tracing,
+            snap_start=api_snap_start,
+            provisioned_concurrency=api_provisioned_concurrency
         )
         print(f"Lambda ARN: {lambda_authorizer.lambda_function.function_arn}")
 
+        package_video_function = None
+        process_environment = dict(environment_l)
+        if not global_playlist:
+            process_environment["GLOBAL_PLAYLIST"] = "false"
+        if hls_ffmpeg_layer_arn:
+            # Segment uploaded videos into HLS renditions, invoked by ProcessVideoFunction
+            package_environment = dict(environment_l)
+            if hls_renditions:
+                package_environment["HLS_RENDITIONS"] = hls_renditions
+            package_video_function = LambdaConstruct(
+                self,
+                "PackageVideoFunction",
+                handler_file="index.handler",
+                path_l="video_content_delivery/src/lambda/package_hls",
+                function_name="PackageVideoFunction",
+                runtime=_lambda.Runtime.PYTHON_3_12,
+                table=video_table,
+                environment=package_environment,
+                layers=[common_layer, _lambda.LayerVersion.from_layer_version_arn(
+                    self, "FfmpegLayer", hls_ffmpeg_layer_arn
+                )],
+                tracing=tracing,
+                # Encoding is CPU bound and works on local copies of the videos
+                memory_size=3008,
+                timeout=Duration.minutes(15),
+                ephemeral_storage_size=Size.gibibytes(10)
+            )
+            bucket.grant_read_write(package_video_function.lambda_function)
+            process_environment["HLS_FUNCTION_NAME"] = package_video_function.lambda_function.function_name
+
+        # S3 invokes the function with one event at a time, SQS with whole batches
+        events_per_invocation = playlist_batch_size if playlist_batch_window else 1
+        process_video_timeout = Duration.seconds(min(
+            900, PROCESS_VIDEO_BASE_SECONDS + int(PROCESS_VIDEO_SECONDS_PER_EVENT * events_per_invocation)
+        ))
+
         # Create Lambda function for processing uploaded videos
         process_video_function = LambdaConstruct(
             self,
@@ -89,83 +252,228 @@ class VideoContentDeliveryStack(Stack):
             function_name="ProcessVideoFunction",
             runtime=_lambda.Runtime.PYTHON_3_12,
             table=video_table,
-            environment=environment_l
+            environment=process_environment,
+            layers=[common_layer],
+            tracing=tracing,
+            memory_size=PROCESS_VIDEO_MEMORY_MB,
+            timeout=process_video_timeout
         )
 
+        if package_video_function:
+            package_video_function.lambda_function.grant_invoke(process_video_function.lambda_function)
+
+        if reconciliation_schedule:
+            # Shares the catalog code of ProcessVideoFunction
+            reconcile_catalog_function = LambdaConstruct(
+                self,
+                "ReconcileCatalogFunction",
+                handler_file="reconcile.handler",
+                path_l="video_content_delivery/src/lambda/process_video",
+                function_name="ReconcileCatalogFunction",
+                runtime=_lambda.Runtime.PYTHON_3_12,
+                table=video_table,
+                environment={
+                    **process_environment,
+                    "INVENTORY_BUCKET": inventory_bucket.bucket_name,
+                    # Deliveries land under <prefix>/<source bucket>/<inventory id>/
+                    "INVENTORY_PREFIX": f"inventory/{bucket.bucket_name}/VideoCatalog/",
+                },
+                layers=[common_layer],
+                tracing=tracing,
+                memory_size=RECONCILE_CATALOG_MEMORY_MB,
+                timeout=Duration.minutes(15)
+            )
+            bucket.grant_read_write(reconcile_catalog_function.lambda_function)
+            inventory_bucket.grant_read(reconcile_catalog_function.lambda_function)
+            events.Rule(self, "ReconcileCatalogSchedule",
+                        schedule=reconciliation_schedule,
+                        targets=[events_targets.LambdaFunction(reconcile_catalog_function.lambda_function)])
+
         # Grant S3 permissions to the video processing Lambda
         bucket.grant_read(process_video_function.lambda_function)
         
         # Grant additional S3 permissions for playlist generation
         bucket.grant_read_write(process_video_function.lambda_function)
         
-        # Configure S3 to trigger Lambda when MP4 files are uploaded
-        bucket.add_event_notification(
-            s3.EventType.OBJECT_CREATED_PUT,
-            s3n.LambdaDestination(process_video_function.lambda_function),
-            s3.NotificationKeyFilter(suffix=".mp4")  # Only trigger for MP4 files
+        if playlist_batch_window:
+            # Buffer upload events so bursts of uploads collapse into one regeneration
+            upload_events_dlq = sqs.Queue(self, "UploadEventsDLQ",
+                                          retention_period=Duration.days(14))
+            upload_events_queue = sqs.Queue(self, "UploadEventsQueue",
+                                            visibility_timeout=Duration.seconds(
+                                                VISIBILITY_TIMEOUT_FACTOR * process_video_timeout.to_seconds()
+                                                + playlist_batch_window.to_seconds()
+                                            ),
+                                            dead_letter_queue=sqs.DeadLetterQueue(
+                                                max_receive_count=5,
+                                                queue=upload_events_dlq
+                                            ))
+            process_video_function.lambda_function.add_event_source(
+                lambda_event_sources.SqsEventSource(
+                    upload_events_queue,
+                    batch_size=playlist_batch_size,
+                    max_batching_window=playlist_batch_window,
+                    report_batch_item_failures=True,
+                    max_concurrency=playlist_max_concurrency
+                )
+            )
+            upload_destination = s3n.SqsDestination(upload_events_queue)
+        else:
+            upload_destination = s3n.LambdaDestination(process_video_function.lambda_function)
+
+        # Configure S3 to notify the video processing when MP4 files are uploaded,
+        # either with a single PUT or by completing a multipart upload, and when
+        # they are deleted or hidden by a delete marker of the versioned bucket
+        for event_type in (s3.EventType.OBJECT_CREATED_PUT,
+                           s3.EventType.OBJECT_CREATED_COMPLETE_MULTIPART_UPLOAD,
+                           s3.EventType.OBJECT_REMOVED_DELETE,
+                           s3.EventType.OBJECT_REMOVED_DELETE_MARKER_CREATED):
+            bucket.add_event_notification(
+                event_type,
+                upload_destination,
+                s3.NotificationKeyFilter(suffix=".mp4")  # Only trigger for MP4 files
+            )
+
+        # Incomplete multipart uploads that are never completed nor aborted
+        bucket.add_lifecycle_rule(
+            abort_incomplete_multipart_upload_after=Duration.days(7)
         )
 
         # Create API Gateway for REST endpoints
         apigateway_video = ApiGatewayConstruct(self, "MyAPIGateway")
 
         # Add custom authorizer to API Gateway
-        authorizer = apigateway_video.add_authorizer_v2("AudioAuthorizer", lambda_authorizer.lambda_function)
+        authorizer = apigateway_video.add_authorizer_v2("AudioAuthorizer", lambda_authorizer.target,
+                                                        results_cache_ttl=authorizer_cache_ttl)
 
         # Create the /geturl resource and methods
         get_url = apigateway_video.api.root.add_resource("geturl")
 
+        # Query string parameters forwarded to GetPresignedUrlFunction, only action is required
+        geturl_query_params = [
+            "key", "action",
+            "limit", "cursor",  # Pagination of action=list
+            "prefix", "from", "to", "minSize", "maxSize"  # Filters of action=list
+        ]
+
+        # Principal and key prefixes granted by the authorizer to the caller
+        geturl_authorizer_context = {
+            "principalId": "$context.authorizer.principalId",
+            "prefixes": "$context.authorizer.prefixes"
+        }
+
+        # Lambda returns statusCode 304 when If-None-Match matches the ETag of the list,
+        # the non-proxy integration turns it into the HTTP status and ETag header
+        geturl_response_template = "\n".join([
+            "#set($response = $input.path('$'))",
+            "#if(\"$!response.headers.ETag\" != \"\")",
+            "#set($context.responseOverride.header.ETag = $response.headers.ETag)",
+            "#end",
+            "#if($response.statusCode == 304)",
+            "#set($context.responseOverride.status = 304)",
+            "#else",
+            "$input.body",
+            "#end"
+        ])
+
+        geturl_integration_responses = [
+            apigateway.IntegrationResponse(
+            status_code="200",
+            response_templates={
+                "application/json": geturl_response_template
+            },
+            response_parameters={
+                "method.response.header.Access-Control-Allow-Origin": "'*'",
+                "method.response.header.Access-Control-Allow-Headers": "'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token,If-None-Match'",
+                "method.response.header.Access-Control-Allow-Methods": "'GET,POST,OPTIONS'",
+                "method.response.header.Access-Control-Expose-Headers": "'ETag'"
+            }
+            )
+        ]
+        geturl_method_responses = [
+            apigateway.MethodResponse(
+                status_code=status_code,
+                response_models={
+                "application/json": apigateway.Model.EMPTY_MODEL
+                },
+                response_parameters={
+                "method.response.header.Access-Control-Allow-Origin": True,
+                "method.response.header.Access-Control-Allow-Headers": True,
+                "method.response.header.Access-Control-Allow-Methods": True,
+                "method.response.header.Access-Control-Expose-Headers": True,
+                "method.response.header.ETag": True
+                }
+            )
+            for status_code in ("200", "304")
+        ]
+
         get_url.add_method(
             "GET",
             apigateway.LambdaIntegration(
-            get_presigned_url_function.lambda_function,
+            get_presigned_url_function.target,
             proxy=False,
             passthrough_behavior=apigateway.PassthroughBehavior.WHEN_NO_MATCH,
             request_parameters={
-                "integration.request.querystring.key": "method.request.querystring.key",
-                "integration.request.querystring.action": "method.request.querystring.action"
+                f"integration.request.querystring.{name}": f"method.request.querystring.{name}"
+                for name in geturl_query_params
             },
             request_templates={
                 "application/json": json.dumps({
                 "httpMethod": "$context.httpMethod",
                 "queryStringParameters": {
-                    "key": "$input.params('key')",
-                    "action": "$input.params('action')"
-                }
+                    name: f"$input.params('{name}')" for name in geturl_query_params
+                },
+                "headers": {
+                    "If-None-Match": "$util.escapeJavaScript($input.params().header.get('If-None-Match'))"
+                },
+                "authorizer": geturl_authorizer_context
                 })
             },
-            integration_responses=[
-                apigateway.IntegrationResponse(
-                status_code="200",
-                response_templates={
-                    "application/json": "$input.body"
+            integration_responses=geturl_integration_responses
+            ),
+            authorization_type=apigateway.AuthorizationType.CUSTOM,
+            authorizer=authorizer,
+            request_parameters={
+                **{
+                    f"method.request.querystring.{name}": name == "action"
+                    for name in geturl_query_params
                 },
-                response_parameters={
-                    "method.response.header.Access-Control-Allow-Origin": "'*'",
-                    "method.response.header.Access-Control-Allow-Headers": "'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token'",
-                    "method.response.header.Access-Control-Allow-Methods": "'GET,OPTIONS'"
-                }
-                )
-            ]
+                "method.request.header.If-None-Match": False
+            },
+            method_responses=geturl_method_responses
+        )
+
+        # POST signs many keys at once (action=get_download_urls or get_upload_urls),
+        # the keys are sent as a JSON body: {"keys": ["a.mp4", "b.mp4"]}. It also drives
+        # multipart uploads: create_multipart_upload, get_upload_part_urls,
+        # list_upload_parts, complete_multipart_upload and abort_multipart_upload
+        get_url.add_method(
+            "POST",
+            apigateway.LambdaIntegration(
+            get_presigned_url_function.target,
+            proxy=False,
+            passthrough_behavior=apigateway.PassthroughBehavior.WHEN_NO_MATCH,
+            request_parameters={
+                "integration.request.querystring.action": "method.request.querystring.action"
+            },
+            request_templates={
+                "application/json": "\n".join([
+                    "{",
+                    '"httpMethod": "$context.httpMethod",',
+                    '"queryStringParameters": {"action": "$input.params(\'action\')"},',
+                    '"authorizer": ' + json.dumps(geturl_authorizer_context) + ',',
+                    '"body": $input.json(\'$\')',
+                    "}"
+                ])
+            },
+            integration_responses=geturl_integration_responses
             ),
             authorization_type=apigateway.AuthorizationType.CUSTOM,
             authorizer=authorizer,
             request_parameters={
-            "method.request.querystring.key": False,
-            "method.request.querystring.action": True
+                "method.request.querystring.action": True
             },
-            method_responses=[
-            apigateway.MethodResponse(
-                status_code="200",
-                response_models={
-                "application/json": apigateway.Model.EMPTY_MODEL
-                },
-                response_parameters={
-                "method.response.header.Access-Control-Allow-Origin": True,
-                "method.response.header.Access-Control-Allow-Headers": True,
-                "method.response.header.Access-Control-Allow-Methods": True
-                }
-            )
-            ]
+            method_responses=geturl_method_responses
         )
 
         # Add OPTIONS method for CORS
@@ -175,8 +483,8 @@ class VideoContentDeliveryStack(Stack):
                 integration_responses=[{
                     'statusCode': '200',
                     'responseParameters': {
-                        'method.response.header.Access-Control-Allow-Headers': "'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token'",
-                        'method.response.header.Access-Control-Allow-Methods': "'GET,OPTIONS'",
+                        'method.response.header.Access-Control-Allow-Headers': "'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token,If-None-Match'",
+                        'method.response.header.Access-Control-Allow-Methods': "'GET,POST,OPTIONS'",
                         'method.response.header.Access-Control-Allow-Origin': "'*'"
                     }
                 }],
@@ -206,4 +514,12 @@ class VideoContentDeliveryStack(Stack):
             export_name=f"{construct_id}-api-url"
         )
 
+        if playback:
+            CfnOutput(
+                self,
+                "PlaybackDomain",
+                value=playback.distribution.distribution_domain_name,
+                description="CloudFront domain serving videos and playlists"
+            )
+
 